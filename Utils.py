@@ -7,7 +7,7 @@
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
 
-import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse
+import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse,threading
 from pytorch3d.transforms import so3_log_map,so3_exp_map,se3_exp_map,se3_log_map,matrix_to_axis_angle,matrix_to_euler_angles,euler_angles_to_matrix, rotation_6d_to_matrix
 from pytorch3d.renderer import FoVPerspectiveCameras, PerspectiveCameras, look_at_view_transform, look_at_rotation, RasterizationSettings, MeshRenderer, MeshRasterizer, BlendParams, SoftSilhouetteShader, HardPhongShader, PointLights, TexturesVertex
 from pytorch3d.renderer.mesh.rasterize_meshes import barycentric_coordinates
@@ -15,11 +15,11 @@ from pytorch3d.renderer.mesh.shader import SoftDepthShader, HardFlatShader
 from pytorch3d.renderer.mesh.textures import Textures
 from pytorch3d.structures import Meshes
 from scipy.interpolate import griddata
-import nvdiffrast.torch as dr
 import torch.nn.functional as F
 import torchvision
 import torch.nn as nn
-from functools import partial
+from functools import partial, wraps
+from contextlib import contextmanager, nullcontext
 import pandas as pd
 import open3d as o3d
 from uuid import uuid4
@@ -29,15 +29,19 @@ import numpy as np
 from collections import defaultdict
 import multiprocessing as mp
 import matplotlib.pyplot as plt
-import math,glob,re,copy
+import math,glob,re,copy,warnings,json
 from transformations import *
-from scipy.spatial import cKDTree
+from scipy.spatial import cKDTree, ConvexHull, QhullError
 from collections import OrderedDict
 import ruamel.yaml
 yaml = ruamel.yaml.YAML()
 code_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(code_dir)
 # sys.path.append(f"{code_dir}/mycpp/build")
+try:
+  import nvdiffrast.torch as dr
+except:
+  dr = None
 try:
   import kornia
 except:
@@ -55,7 +59,7 @@ try:
   wp.init()
 except:
   wp = None
-enable_timer = 0
+enable_timer = int(os.environ.get('FOUNDATIONPOSE_PROFILE', 0))   # Turns on stage_profiler
 
 def NestDict():
   return defaultdict(NestDict)
@@ -101,11 +105,63 @@ set_logging_format()
 
 
 
-def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
-  mesh_tensors = {}
+def make_mesh_lods(mesh_arrays, lod_min_faces=20000, lod_ratio=4):
+  '''Quadric decimated levels of detail, each lod_ratio times fewer faces than the previous one, down to lod_min_faces/lod_ratio.
+  Colors (baked from the texture if any) are taken from the nearest full resolution vertex, so every level is vertex colored
+  @mesh_arrays: output of make_mesh_arrays without lods
+  Return: dict of lod{i}_pos/faces/vnormals/vertex_color for i>=1, and lod_edge_len (n_level,), the 90th percentile edge length of each level including the full mesh as level 0
+  '''
+  def edge_len(pos, faces):
+    edges = pos[faces[:,[1,2,0]]]-pos[faces]
+    return float(np.percentile(np.linalg.norm(edges, axis=-1), 90))
+
+  pos = mesh_arrays['pos']
+  faces = mesh_arrays['faces']
+  lods = {'lod_edge_len': [edge_len(pos, faces)]}
+  if len(faces)<=lod_min_faces:
+    lods['lod_edge_len'] = np.asarray(lods['lod_edge_len'], dtype=np.float32)
+    return lods
+
+  if 'tex' in mesh_arrays:
+    tex = mesh_arrays['tex'][0]
+    uv = mesh_arrays['uv']
+    cols = np.clip((uv[:,0]*tex.shape[1]).astype(int), 0, tex.shape[1]-1)
+    rows = np.clip((uv[:,1]*tex.shape[0]).astype(int), 0, tex.shape[0]-1)
+    colors = tex[rows, cols]
+  else:
+    colors = mesh_arrays['vertex_color']
+  kdtree = cKDTree(pos)
+
+  o3d_mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(pos.astype(np.float64)), o3d.utility.Vector3iVector(faces))
+  n_faces = len(faces)
+  i_level = 1
+  while n_faces//lod_ratio>=lod_min_faces//lod_ratio:
+    n_faces = n_faces//lod_ratio
+    o3d_mesh = o3d_mesh.simplify_quadric_decimation(target_number_of_triangles=n_faces)
+    o3d_mesh.remove_unreferenced_vertices()
+    o3d_mesh.compute_vertex_normals()
+    lod_pos = np.asarray(o3d_mesh.vertices, dtype=np.float32)
+    lod_faces = np.asarray(o3d_mesh.triangles, dtype=np.int32)
+    if len(lod_faces)==0:
+      break
+    _, nearest = kdtree.query(lod_pos)
+    lods[f'lod{i_level}_pos'] = lod_pos
+    lods[f'lod{i_level}_faces'] = lod_faces
+    lods[f'lod{i_level}_vnormals'] = np.asarray(o3d_mesh.vertex_normals, dtype=np.float32)
+    lods[f'lod{i_level}_vertex_color'] = np.asarray(colors[nearest], dtype=np.uint8)
+    lods['lod_edge_len'].append(edge_len(lod_pos, lod_faces))
+    i_level += 1
+  lods['lod_edge_len'] = np.asarray(lods['lod_edge_len'], dtype=np.float32)
+  logging.info(f"built {i_level-1} mesh lods, edge_len {lods['lod_edge_len']}")
+  return lods
+
+
+def make_mesh_arrays(mesh, max_tex_size=None, lod_min_faces=None):
+  '''Pack the mesh into the numpy arrays nvdiffrast_render needs. Texture stays uint8 so that it can be cached compactly, see mesh_arrays_to_tensors
+  @lod_min_faces: meshes with more faces also get decimated levels of detail, see make_mesh_lods. None (default) for none, the full mesh is always rendered
+  '''
+  mesh_arrays = {}
   if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
-    print()
-    
     if mesh.visual.material and mesh.visual.material.image:
       img = np.array(mesh.visual.material.image.convert('RGB'))
     else:
@@ -117,29 +173,251 @@ def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
       if max_size>max_tex_size:
         scale = 1/max_size * max_tex_size
         img = cv2.resize(img, fx=scale, fy=scale, dsize=None)
-    mesh_tensors['tex'] = torch.as_tensor(img, device=device, dtype=torch.float)[None]/255.0
-    mesh_tensors['uv_idx']  = torch.as_tensor(mesh.faces, device=device, dtype=torch.int)
+    mesh_arrays['tex'] = np.ascontiguousarray(img[None]).astype(np.uint8)
+    mesh_arrays['uv_idx'] = np.asarray(mesh.faces, dtype=np.int32)
     if mesh.visual.uv is None:
-      uv = torch.zeros((len(mesh.vertices), 2), device=device, dtype=torch.float)
+      uv = np.zeros((len(mesh.vertices), 2), dtype=np.float32)
     else:
-      uv = torch.as_tensor(mesh.visual.uv, device=device, dtype=torch.float)
+      uv = np.array(mesh.visual.uv, dtype=np.float32)
     uv[:,1] = 1 - uv[:,1]
-    mesh_tensors['uv']  = uv
+    mesh_arrays['uv'] = uv
   else:
     if mesh.visual.vertex_colors is None:
       logging.info(f"WARN: mesh doesn't have vertex_colors, assigning a pure color")
       mesh.visual.vertex_colors = np.tile(np.array([128,128,128]).reshape(1,3), (len(mesh.vertices), 1))
-    mesh_tensors['vertex_color'] = torch.as_tensor(mesh.visual.vertex_colors[...,:3], device=device, dtype=torch.float)/255.0
+    mesh_arrays['vertex_color'] = np.asarray(mesh.visual.vertex_colors[...,:3], dtype=np.uint8)
 
-  mesh_tensors.update({
-    'pos': torch.tensor(mesh.vertices, device=device, dtype=torch.float),
-    'faces': torch.tensor(mesh.faces, device=device, dtype=torch.int),
-    'vnormals': torch.tensor(mesh.vertex_normals, device=device, dtype=torch.float),
+  mesh_arrays.update({
+    'pos': np.asarray(mesh.vertices, dtype=np.float32),
+    'faces': np.asarray(mesh.faces, dtype=np.int32),
+    'vnormals': np.asarray(mesh.vertex_normals, dtype=np.float32),
   })
+  if lod_min_faces is not None:
+    mesh_arrays.update(make_mesh_lods(mesh_arrays, lod_min_faces=lod_min_faces))
+  return mesh_arrays
+
+
+def default_max_tex_size(input_resize, texels_per_pixel=4):
+  '''Texture size past which a crop of input_resize pixels only ever samples coarser mip levels. Power of two
+  '''
+  return int(2**np.ceil(np.log2(texels_per_pixel*max(input_resize))))
+
+
+def make_texture_mips(tex, device='cuda'):
+  '''Resident uint8 texture and its mip levels, down to 1x1. The base is resized to power of two sides as nvdiffrast mip filtering expects
+  @tex: (1,H,W,3) uint8 np array
+  Return: base (1,H',W',3) uint8 tensor, list of mip level tensors
+  '''
+  img = tex[0]
+  H,W = img.shape[:2]
+  H2 = int(2**np.round(np.log2(H)))
+  W2 = int(2**np.round(np.log2(W)))
+  if (H2,W2)!=(H,W):
+    img = cv2.resize(img, dsize=(W2,H2), interpolation=cv2.INTER_AREA if H2*W2<H*W else cv2.INTER_LINEAR)
+  base = torch.tensor(np.ascontiguousarray(img[None]), device=device)
+  mips = []
+  while max(img.shape[:2])>1:
+    img = cv2.resize(img, dsize=(max(img.shape[1]//2,1), max(img.shape[0]//2,1)), interpolation=cv2.INTER_AREA).reshape(max(img.shape[0]//2,1), max(img.shape[1]//2,1), -1)
+    mips.append(torch.tensor(np.ascontiguousarray(img[None]), device=device))
+  return base, mips
+
+
+_float_textures = threading.local()
+
+@contextmanager
+def float_textures():
+  '''Within this context (per thread, may be nested) sample_mesh_texture converts each uint8 texture and its mips to float once and reuses them, instead of on every render call.
+  Memory: while the context lasts, every textured mesh it renders also holds a float32 pyramid, 4x its resident uint8 one (about 4/3*12 bytes per base texel, e.g. 67MB for 2048x2048).
+  It is freed when the outermost context exits, so between calls only the uint8 copy stays resident. FoundationPose.register, register_many, track_one and MultiObjectTracker.track run under it
+  '''
+  depth = getattr(_float_textures, 'depth', 0)
+  if depth==0:
+    _float_textures.cache = {}
+  _float_textures.depth = depth+1
+  try:
+    yield
+  finally:
+    _float_textures.depth = depth
+    if depth==0:
+      _float_textures.cache = None
+
+
+def get_float_texture(mesh_tensors, with_mips):
+  '''
+  Return: float texture in [0,1], list of float mips (None if not with_mips)
+  '''
+  cache = getattr(_float_textures, 'cache', None)
+  tex_u8 = mesh_tensors['tex']
+  entry = None
+  if cache is not None:
+    entry = cache.get(id(tex_u8))
+    if entry is not None and entry[0] is not tex_u8:
+      entry = None
+  if entry is None:
+    entry = [tex_u8, tex_u8.float()/255.0, None]   # The uint8 tensor is kept so that its id is not reused during the context
+    if cache is not None:
+      cache[id(tex_u8)] = entry
+  if with_mips and entry[2] is None:
+    entry[2] = [mip.float()/255.0 for mip in mesh_tensors['tex_mips']]
+  return entry[1], entry[2]
+
+
+def sample_mesh_texture(mesh_tensors, texc, texc_da=None):
+  '''Look up the uint8 texture of mesh_arrays_to_tensors, converted to float for the lookup (once per float_textures context)
+  @texc: (B,H,W,2) uv
+  @texc_da: (B,H,W,4) screen space uv derivatives, enable mip filtering. None on cpu
+  '''
+  tex, mips = get_float_texture(mesh_tensors, with_mips=texc_da is not None)
+  if texc_da is None:
+    return texture_torch(tex, texc)
+  if len(mips)==0:
+    return dr.texture(tex, texc, filter_mode='linear')
+  return dr.texture(tex, texc, uv_da=texc_da, mip=mips, filter_mode='linear-mipmap-linear')
+
+
+def mesh_arrays_to_tensors(mesh_arrays, device='cuda'):
+  '''
+  @mesh_arrays: output of make_mesh_arrays, possibly memory-mapped
+  Texture stays uint8 on the device together with its mip levels (a float32 copy would be 4x larger), see float_textures
+  '''
+  mesh_tensors = {}
+  lods = defaultdict(dict)
+  for k in mesh_arrays:
+    if k=='lod_edge_len':
+      mesh_tensors[k] = np.asarray(mesh_arrays[k]).tolist()   # Only used on the host to pick a level
+      continue
+    if k=='tex':
+      mesh_tensors['tex'], mesh_tensors['tex_mips'] = make_texture_mips(np.asarray(mesh_arrays[k]), device=device)
+      continue
+    tensor = torch.tensor(np.asarray(mesh_arrays[k]), device=device)
+    name = k.split('_',1)[1] if k.startswith('lod') else k
+    if name=='vertex_color':
+      tensor = tensor.float()/255.0
+    if k.startswith('lod'):
+      lods[int(k.split('_',1)[0][3:])][name] = tensor
+    else:
+      mesh_tensors[k] = tensor
+  if len(lods)>0:
+    mesh_tensors['lods'] = [lods[i] for i in sorted(lods.keys())]   # Level 1, 2...
+  if 'uv_idx' in mesh_arrays and np.array_equal(mesh_arrays['uv_idx'], mesh_arrays['faces']):
+    mesh_tensors['uv_idx'] = mesh_tensors['faces']   # Lets nvdiffrast_render interpolate uv together with the other vertex attributes
   return mesh_tensors
 
 
-def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
+def make_mesh_tensors(mesh, device='cuda', max_tex_size=None, lod_min_faces=None):
+  return mesh_arrays_to_tensors(make_mesh_arrays(mesh, max_tex_size=max_tex_size, lod_min_faces=lod_min_faces), device=device)
+
+
+def mesh_tensors_to(mesh_tensors, device):
+  '''Copy of the mesh_arrays_to_tensors layout on another device. A new dict, since the original may be shared through MeshAssetCache
+  Tensors are moved, so are the tensors in the tex_mips list and in each lods level; host only entries such as lod_edge_len are kept as they are
+  '''
+  def move(v):
+    if torch.is_tensor(v):
+      return v.to(device)
+    if isinstance(v, dict):
+      return {k:move(x) for k,x in v.items()}
+    if isinstance(v, (list,tuple)) and len(v)>0 and all(torch.is_tensor(x) or isinstance(x, dict) for x in v):
+      return type(v)(move(x) for x in v)
+    return v
+  out = {k:move(v) for k,v in mesh_tensors.items()}
+  if 'uv_idx' in mesh_tensors and mesh_tensors['uv_idx'] is mesh_tensors.get('faces'):
+    out['uv_idx'] = out['faces']   # Keep the aliasing nvdiffrast_render relies on to fuse the uv interpolation
+  return out
+
+
+def crop_pix_per_meter(K, output_size, mesh_diameter, crop_ratio):
+  '''Pixels per meter at the object center in its box_3d crop window (compute_crop_window_tf_batch). The window scales with the distance like the object does,
+  so this does not depend on the pose and is known on the host before any pose is rendered
+  @output_size: (height, width) of the crops
+  @mesh_diameter: float, or list over objects
+  Return: float, or list over objects
+  '''
+  K = np.asarray(K)
+  return (output_size[1]*K[0,0]/(max(K[0,0],K[1,1])*crop_ratio)/np.asarray(mesh_diameter, dtype=np.float64)).tolist()
+
+
+def select_mesh_lod(mesh_tensors, pix_per_meter, pix_thres=1.0):
+  '''Pick the coarsest level of detail whose edges still project below pix_thres pixels. Host values only, so picking costs no device sync
+  @pix_per_meter: float, e.g. from crop_pix_per_meter
+  Return: mesh tensors of that level, mesh_tensors itself if the full mesh is needed
+  '''
+  if 'lods' not in mesh_tensors or pix_thres is None or pix_per_meter is None:
+    return mesh_tensors
+  lod = mesh_tensors
+  for i_level,edge_len in enumerate(mesh_tensors['lod_edge_len'][1:]):
+    if edge_len*pix_per_meter>pix_thres:
+      break
+    lod = mesh_tensors['lods'][i_level]
+  return lod
+
+
+def rasterize_torch(pos_clip, pos_idx, resolution):
+  '''CPU stand-in for dr.rasterize built on the pytorch3d rasterizer. Output follows the nvdiffrast layout, i.e. row 0 is y=-1 in clip space
+  @pos_clip: (B,N,4) clip space vertices
+  @pos_idx: (F,3) int
+  @resolution: (H,W)
+  Return: (B,H,W,4) with (u,v,z/w,triangle_id+1), triangle_id+1==0 being background
+  '''
+  from pytorch3d.renderer.mesh.rasterize_meshes import rasterize_meshes
+  H,W = int(resolution[0]), int(resolution[1])
+  B = len(pos_clip)
+  n_face = len(pos_idx)
+  w = pos_clip[...,3:4]
+  ndc = pos_clip[...,:2]/torch.where(w.abs()<1e-8, torch.full_like(w, 1e-8), w)
+  ########## pytorch3d NDC has +X left, +Y up, and the shorter image side spans [-1,1]
+  verts = torch.cat([-ndc[...,0:1]*max(W/H,1), -ndc[...,1:2]*max(H/W,1), w], dim=-1)
+  faces = pos_idx.long()
+  meshes = Meshes(verts=list(verts), faces=[faces]*B)
+  pix_to_face, _, bary, _ = rasterize_meshes(meshes, image_size=(H,W), blur_radius=0.0, faces_per_pixel=1, perspective_correct=True, cull_backfaces=False)
+  pix_to_face = pix_to_face[...,0]
+  bary = bary[...,0,:]   #(B,H,W,3)
+  valid = pix_to_face>=0
+  tri_id = torch.where(valid, pix_to_face-torch.arange(B, device=pos_clip.device).reshape(B,1,1)*n_face, -torch.ones_like(pix_to_face))
+  rast_out = torch.zeros((B,H,W,4), dtype=torch.float, device=pos_clip.device)
+  rast_out[...,0] = bary[...,0]
+  rast_out[...,1] = bary[...,1]
+  rast_out[...,3] = (tri_id+1).float()
+  zw = interpolate_torch(pos_clip[...,2:4], rast_out, pos_idx)
+  rast_out[...,2] = zw[...,0]/torch.where(zw[...,1]==0, torch.ones_like(zw[...,1]), zw[...,1])
+  rast_out[~valid] = 0
+  return rast_out
+
+
+def interpolate_torch(attr, rast_out, tri):
+  '''CPU stand-in for dr.interpolate
+  @attr: (N,C), (1,N,C) or (B,N,C)
+  @rast_out: (B,H,W,4) from rasterize_torch
+  @tri: (F,3) int
+  '''
+  B,H,W = rast_out.shape[:3]
+  if attr.dim()==2:
+    attr = attr[None]
+  attr = attr.expand(B,-1,-1)
+  tri_id = rast_out[...,3].long()-1
+  valid = tri_id>=0
+  face = tri.long()[tri_id.clamp(min=0)]  #(B,H,W,3)
+  b_ids = torch.arange(B, device=attr.device).reshape(B,1,1,1).expand_as(face)
+  vals = attr[b_ids, face]  #(B,H,W,3,C)
+  u = rast_out[...,0]
+  v = rast_out[...,1]
+  bary = torch.stack([u, v, 1-u-v], dim=-1)
+  out = (vals*bary[...,None]).sum(dim=-2)
+  out = out*valid[...,None]
+  return out
+
+
+def texture_torch(tex, uv):
+  '''CPU stand-in for dr.texture with linear filtering
+  @tex: (1,Ht,Wt,C)
+  @uv: (B,H,W,2) in [0,1]
+  '''
+  B = len(uv)
+  color = F.grid_sample(tex.permute(0,3,1,2).expand(B,-1,-1,-1), uv*2-1, mode='bilinear', padding_mode='border', align_corners=False)
+  return color.permute(0,2,3,1)
+
+
+def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}, device='cuda', lod_pix_per_meter=None, lod_pix_thres=1.0):
   '''Just plain rendering, not support any gradient
   @K: (3,3) np array
   @ob_in_cams: (N,4,4) torch tensor, openCV camera
@@ -148,86 +426,589 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   @bbox2d: (N,4) (umin,vmin,umax,vmax) if only roi need to render.
   @light_dir: in cam space
   @light_pos: in cam space
+  @device: on cpu the pytorch3d rasterizer is used instead of nvdiffrast, glctx is ignored
+  @lod_pix_per_meter: float, pixels a meter on the object covers in the output, e.g. from crop_pix_per_meter. If given, the coarsest level of detail of mesh_tensors whose edges project below lod_pix_thres pixels is rendered, see select_mesh_lod. None for the full mesh
   '''
-  if glctx is None:
+  device = torch.device(device)
+  use_cuda = device.type=='cuda'
+  if glctx is None and use_cuda:
     if context == 'gl':
       glctx = dr.RasterizeGLContext()
     elif context=='cuda':
-      glctx = dr.RasterizeCudaContext()
+      glctx = dr.RasterizeCudaContext(device)
     else:
       raise NotImplementedError
     logging.info("created context")
 
+  if use_cuda:
+    interpolate = lambda attr, rast_out, tri: dr.interpolate(attr, rast_out, tri)[0]
+  else:
+    interpolate = interpolate_torch
+
   if mesh_tensors is None:
-    mesh_tensors = make_mesh_tensors(mesh)
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+  ob_in_cams = torch.as_tensor(ob_in_cams, device=device, dtype=torch.float)
+  if output_size is None:
+    output_size = np.asarray([H,W])
+  mesh_tensors = select_mesh_lod(mesh_tensors, pix_per_meter=lod_pix_per_meter, pix_thres=lod_pix_thres)
   pos = mesh_tensors['pos']
   vnormals = mesh_tensors['vnormals']
   pos_idx = mesh_tensors['faces']
   has_tex = 'tex' in mesh_tensors
 
-  ob_in_glcams = torch.tensor(glcam_in_cvcam, device='cuda', dtype=torch.float)[None]@ob_in_cams
+  ob_in_glcams = torch.tensor(glcam_in_cvcam, device=device, dtype=torch.float)[None]@ob_in_cams
   if projection_mat is None:
     projection_mat = projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100)
-  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device='cuda', dtype=torch.float)
+  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device=device, dtype=torch.float)
   mtx = projection_mat@ob_in_glcams
 
-  if output_size is None:
-    output_size = np.asarray([H,W])
-
-  pts_cam = transform_pts(pos, ob_in_cams)
-  pos_homo = to_homo_torch(pos)
-  pos_clip = (mtx[:,None]@pos_homo[None,...,None])[...,0]
+  ########## Negating clip y rasterizes straight into the image layout (row 0 on top), so no output needs flipping
+  flip_y = torch.tensor([1,-1,1,1], dtype=torch.float, device=device)
   if bbox2d is not None:
     l = bbox2d[:,0]
     t = H-bbox2d[:,1]
     r = bbox2d[:,2]
     b = H-bbox2d[:,3]
-    tf = torch.eye(4, dtype=torch.float, device='cuda').reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
+    tf = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
     tf[:,0,0] = W/(r-l)
     tf[:,1,1] = H/(t-b)
     tf[:,3,0] = (W-r-l)/(r-l)
     tf[:,3,1] = (H-t-b)/(t-b)
-    pos_clip = pos_clip@tf
-  rast_out, _ = dr.rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
-  xyz_map, _ = dr.interpolate(pts_cam, rast_out, pos_idx)
+    mtx = tf.transpose(1,2)@mtx
+  mtx = flip_y.reshape(1,4,1)*mtx
+  pos_clip = to_homo_torch(pos)[None]@mtx.transpose(1,2)   #(B,N,4)
+  if use_cuda:
+    rast_out, rast_db = dr.rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
+  else:
+    rast_out = rasterize_torch(pos_clip, pos_idx, resolution=np.asarray(output_size))
+  mask = torch.clamp(rast_out[..., -1:], 0, 1)
+
+  ########## Interpolation is linear, so the object space attributes are packed and interpolated once for all poses, then moved to the camera per pixel
+  attrs = [pos]
+  if has_tex:
+    fuse_uv = mesh_tensors['uv_idx'] is pos_idx
+    if fuse_uv:
+      attrs.append(mesh_tensors['uv'])
+  else:
+    attrs.append(mesh_tensors['vertex_color'])
+  if get_normal:
+    attrs.append(vnormals)
+  texc_da = None
+  if use_cuda and has_tex and fuse_uv:
+    attr_map, texc_da = dr.interpolate(torch.cat(attrs, dim=-1)[None], rast_out, pos_idx, rast_db=rast_db, diff_attrs=[3,4])   # uv derivatives drive the mip level
+  else:
+    attr_map = interpolate(torch.cat(attrs, dim=-1)[None], rast_out, pos_idx)   #(B,H,W,C)
+  R = ob_in_cams[:,None,None,:3,:3]
+  xyz_map = ((R@attr_map[...,:3,None])[...,0] + ob_in_cams[:,None,None,:3,3])*mask   # Background has no barycentrics, keep it at 0
   depth = xyz_map[...,2]
   if has_tex:
-    texc, _ = dr.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
-    color = dr.texture(mesh_tensors['tex'], texc, filter_mode='linear')
+    if fuse_uv:
+      texc = attr_map[...,3:5]
+    elif use_cuda:
+      texc, texc_da = dr.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'], rast_db=rast_db, diff_attrs='all')
+    else:
+      texc = interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
+    color = sample_mesh_texture(mesh_tensors, texc, texc_da=texc_da)
   else:
-    color, _ = dr.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
+    color = attr_map[...,3:6]
 
-  if use_light:
-    get_normal = True
   if get_normal:
-    vnormals_cam = transform_dirs(vnormals, ob_in_cams)
-    normal_map, _ = dr.interpolate(vnormals_cam, rast_out, pos_idx)
-    normal_map = F.normalize(normal_map, dim=-1)
-    normal_map = torch.flip(normal_map, dims=[1])
+    normal_map = F.normalize((R@attr_map[...,-3:,None])[...,0], dim=-1)
   else:
     normal_map = None
 
   if use_light:
+    vnormals_unit = F.normalize(vnormals, dim=-1)
     if light_dir is not None:
-      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device='cuda')
+      ########## n.(R^T l) for every vertex and pose at once, instead of moving all normals to the camera
+      light_dir_neg = F.normalize(-torch.as_tensor(light_dir, dtype=torch.float, device=device).reshape(1,3,1), dim=1)
+      diffuse_intensity = (vnormals_unit@(ob_in_cams[:,:3,:3].transpose(1,2)@light_dir_neg)).clip(0, 1)   #(B,N,1)
     else:
-      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device='cuda').reshape(1,1,3) - pts_cam
-    diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
-    diffuse_intensity_map, _ = dr.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
+      pts_cam = transform_pts(pos, ob_in_cams)
+      vnormals_cam = transform_dirs(vnormals_unit, ob_in_cams)
+      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device).reshape(1,1,3) - pts_cam
+      diffuse_intensity = (vnormals_cam * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
+    diffuse_intensity_map = interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
     if light_color is None:
       light_color = color
     else:
-      light_color = torch.as_tensor(light_color, device='cuda', dtype=torch.float)
+      light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
     color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
 
   color = color.clip(0,1)
-  color = color * torch.clamp(rast_out[..., -1:], 0, 1) # Mask out background using alpha
-  color = torch.flip(color, dims=[1])   # Flip Y coordinates
-  depth = torch.flip(depth, dims=[1])
-  extra['xyz_map'] = torch.flip(xyz_map, dims=[1])
+  color = color * mask # Mask out background using alpha
+  extra['xyz_map'] = xyz_map
   return color, depth, normal_map
 
 
+def nvdiffrast_render_multi(ob_ids, mesh_tensors, ob_in_cams, bbox2d=None, extra=None, lod_pix_per_meter=None, **kwargs):
+  '''nvdiffrast_render for poses of several objects. Each mesh is rasterized with its own poses, outputs come back in the input order
+  @ob_ids: (N,) tensor, index into mesh_tensors
+  @mesh_tensors: list of mesh tensors
+  @ob_in_cams: (N,4,4) torch tensor
+  @lod_pix_per_meter: list over objects, or None
+  @extra: if given, 'xyz_map' is set in it
+  '''
+  if extra is None:
+    extra = {}
+  ob_ids = torch.as_tensor(ob_ids).to(ob_in_cams.device)
+  color = depth = normal_map = xyz_map = None
+  for i_ob in torch.unique(ob_ids).tolist():
+    ids = torch.where(ob_ids==i_ob)[0]
+    extra_cur = {}
+    color_cur, depth_cur, normal_cur = nvdiffrast_render(ob_in_cams=ob_in_cams[ids], mesh_tensors=mesh_tensors[i_ob], bbox2d=None if bbox2d is None else bbox2d[ids], extra=extra_cur, lod_pix_per_meter=None if lod_pix_per_meter is None else lod_pix_per_meter[i_ob], **kwargs)
+    if color is None:
+      color = torch.zeros((len(ob_ids),)+color_cur.shape[1:], dtype=color_cur.dtype, device=color_cur.device)
+      depth = torch.zeros((len(ob_ids),)+depth_cur.shape[1:], dtype=depth_cur.dtype, device=depth_cur.device)
+      xyz_map = torch.zeros((len(ob_ids),)+extra_cur['xyz_map'].shape[1:], dtype=extra_cur['xyz_map'].dtype, device=color_cur.device)
+      if normal_cur is not None:
+        normal_map = torch.zeros((len(ob_ids),)+normal_cur.shape[1:], dtype=normal_cur.dtype, device=color_cur.device)
+    color[ids] = color_cur
+    depth[ids] = depth_cur
+    xyz_map[ids] = extra_cur['xyz_map']
+    if normal_cur is not None:
+      normal_map[ids] = normal_cur
+  extra['xyz_map'] = xyz_map
+  return color, depth, normal_map
+
+
+class RenderCache:
+  '''Rendered crops keyed by object, quantized pose, crop window and render settings, so that stages of the same frame (refiner, its visualization, scorer) do not render a pose twice.
+  Renders are shared between PoseRefinePredictor and ScorePredictor when their input_resize and crop_ratio agree, since those enter the key through the crop window and resolution.
+  Only renders a later stage asks for again are stored (render_crop_batch with store=True): with get_vis the refiner's first iteration, which its visualization shows, and the refined poses, which the scorer renders next. The others are only looked up.
+  Call new_frame() when the frame changes and clear() once the frame is done, so that no crop stays on the device in between
+  '''
+  def __init__(self, trans_quant=1e-5, rot_quant=1e-5, window_quant=1e-3, max_bytes=256*1024**2):
+    '''
+    @trans_quant: meter
+    @window_quant: pixel
+    @max_bytes: least recently used renders are dropped beyond this
+    '''
+    self.trans_quant = trans_quant
+    self.rot_quant = rot_quant
+    self.window_quant = window_quant
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.n_bytes = 0
+    self.hits = 0
+    self.misses = 0
+
+
+  def clear(self):
+    self.entries.clear()
+    self.n_bytes = 0
+
+
+  def reset_stats(self):
+    self.hits = 0
+    self.misses = 0
+
+
+  def new_frame(self):
+    '''Drop the renders of the previous frame, stats() then covers this frame only
+    '''
+    self.clear()
+    self.reset_stats()
+
+
+  def stats(self):
+    n = self.hits+self.misses
+    return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/n if n>0 else 0, 'size': len(self.entries), 'bytes': self.n_bytes}
+
+
+  def make_keys(self, ob_keys, poses, tf_to_crops, settings):
+    '''
+    @ob_keys: list of hashable, one per pose
+    @poses: (B,4,4) tensor
+    @tf_to_crops: (B,3,3) tensor
+    '''
+    poses = poses.reshape(-1,16)[:,:12].data.cpu().numpy()
+    rot = np.round(poses[:,[0,1,2,4,5,6,8,9,10]]/self.rot_quant).astype(np.int64)
+    trans = np.round(poses[:,[3,7,11]]/self.trans_quant).astype(np.int64)
+    window = np.round(tf_to_crops.reshape(-1,9)[:,[0,2,4,5]].data.cpu().numpy()/self.window_quant).astype(np.int64)
+    return [(ob_keys[i], rot[i].tobytes(), trans[i].tobytes(), window[i].tobytes(), settings) for i in range(len(poses))]
+
+
+  def get(self, key):
+    if key in self.entries:
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return self.entries[key]
+    self.misses += 1
+    return None
+
+
+  def put(self, key, value):
+    '''
+    @value: tuple of tensors or None. They are copied, a view would keep the whole rendered batch alive
+    '''
+    value = tuple(None if v is None else v.clone() for v in value)
+    if key in self.entries:
+      self.n_bytes -= self.entry_bytes(self.entries.pop(key))
+    self.entries[key] = value
+    self.n_bytes += self.entry_bytes(value)
+    while self.n_bytes>self.max_bytes and len(self.entries)>0:
+      self.n_bytes -= self.entry_bytes(self.entries.popitem(last=False)[1])
+
+
+  @staticmethod
+  def entry_bytes(value):
+    return sum(v.numel()*v.element_size() for v in value if v is not None)
+
+
+def render_crop_batch(K, H, W, poses, tf_to_crops, output_size, mesh_tensors, glctx=None, get_normal=False, ob_ids=None, render_cache:RenderCache=None, store=False, lod_pix_per_meter=None, bs=512, device='cuda'):
+  '''Render the poses straight into their crop windows, as the refiner and scorer consume them
+  @poses: (B,4,4) tensor
+  @tf_to_crops: (B,3,3) tensor
+  @output_size: (H,W) of the crops
+  @ob_ids: (B,) tensor. If given, mesh_tensors is a list indexed by it
+  @render_cache: reuse the renders of poses already seen this frame
+  @store: also put the renders into render_cache, for when a later stage of the frame asks for these poses again
+  @lod_pix_per_meter: float, or list over objects with ob_ids, see crop_pix_per_meter. None renders the full meshes
+  Return: rgb (B,h,w,3) in [0,1], depth (B,h,w), normal (B,h,w,3) or None, xyz_map (B,h,w,3)
+  '''
+  B = len(poses)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, output_size[0]-1, output_size[1]-1]).reshape(2,2), device=device, dtype=torch.float)
+  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+
+  def render(ids):
+    outs = []
+    for b in range(0,len(ids),bs):
+      cur = ids[b:b+bs]
+      extra = {}
+      render_kwargs = dict(K=K, H=H, W=W, ob_in_cams=poses[cur], context='cuda', get_normal=get_normal, glctx=glctx, output_size=output_size, bbox2d=bbox2d_ori[cur], use_light=True, extra=extra, lod_pix_per_meter=lod_pix_per_meter, device=device)
+      if ob_ids is None:
+        rgb_r, depth_r, normal_r = nvdiffrast_render(mesh_tensors=mesh_tensors, **render_kwargs)
+      else:
+        rgb_r, depth_r, normal_r = nvdiffrast_render_multi(ob_ids=ob_ids[cur], mesh_tensors=mesh_tensors, **render_kwargs)
+      outs.append((rgb_r, depth_r, normal_r, extra['xyz_map']))
+    rgb_r = torch.cat([out[0] for out in outs], dim=0)
+    depth_r = torch.cat([out[1] for out in outs], dim=0)
+    normal_r = torch.cat([out[2] for out in outs], dim=0) if get_normal else None
+    xyz_map = torch.cat([out[3] for out in outs], dim=0)
+    return rgb_r, depth_r, normal_r, xyz_map
+
+  if render_cache is None:
+    return render(torch.arange(B, device=poses.device))
+  if len(render_cache.entries)==0 and not store:   # Nothing to find, skip building the keys (a copy to the host)
+    render_cache.misses += B
+    return render(torch.arange(B, device=poses.device))
+
+  if ob_ids is None:
+    ob_keys = [id(mesh_tensors)]*B
+  else:
+    ob_keys = [id(mesh_tensors[i]) for i in ob_ids.tolist()]
+  keys = render_cache.make_keys(ob_keys, poses, tf_to_crops, settings=(tuple(output_size), bool(get_normal)))
+  entries = [render_cache.get(key) for key in keys]
+  miss = OrderedDict()   # key -> first pose id, identical poses of the batch are rendered once
+  for i,entry in enumerate(entries):
+    if entry is None and keys[i] not in miss:
+      miss[keys[i]] = i
+  if len(miss)>0:
+    rendered = render(torch.as_tensor(list(miss.values()), device=poses.device))
+    for j,key in enumerate(miss.keys()):
+      miss[key] = tuple(None if out is None else out[j] for out in rendered)
+      if store:
+        render_cache.put(key, miss[key])
+    entries = [miss[key] if entry is None else entry for key,entry in zip(keys,entries)]
+  rgb_r = torch.stack([entry[0] for entry in entries], dim=0)
+  depth_r = torch.stack([entry[1] for entry in entries], dim=0)
+  normal_r = torch.stack([entry[2] for entry in entries], dim=0) if get_normal else None
+  xyz_map = torch.stack([entry[3] for entry in entries], dim=0)
+  return rgb_r, depth_r, normal_r, xyz_map
+
+
+class SyncCounter:
+  '''Counts host-device synchronizations and copies while active, so that regressions of device resident code paths are visible.
+  Synchronizations are the ones CUDA reports through torch.cuda.set_sync_debug_mode (item, nonzero, boolean indexing, copies to host, ...) plus explicit torch.cuda.synchronize.
+  Copies are those going through Tensor.to/cpu/cuda, torch.as_tensor/tensor and scalar reads (item, tolist, bool, float, int)
+    with SyncCounter() as counter:
+      est.register(...)
+    logging.info(counter.stats())
+  This patches torch and warnings process wide while active, so it is meant for benchmarks and debugging only (see bench_suite.py --count_syncs), nothing enables it by default.
+  Counters may be nested and used from several threads: patches are installed by the outermost one and restored when the last exits, both under a lock.
+  Each counter only counts what its own thread does, but other threads pay for the patched calls while it is active
+  '''
+  active = []
+  originals = {}
+  lock = threading.RLock()
+
+  def __init__(self):
+    self.thread = None
+    self.reset()
+
+
+  def reset(self):
+    self.n_syncs = 0
+    self.sync_sites = defaultdict(int)
+    self.n_d2h = 0
+    self.bytes_d2h = 0
+    self.n_h2d = 0
+    self.bytes_h2d = 0
+
+
+  def stats(self, n_sites=5):
+    sites = sorted(self.sync_sites.items(), key=lambda x: -x[1])[:n_sites]
+    return {'n_syncs': self.n_syncs, 'n_d2h': self.n_d2h, 'bytes_d2h': self.bytes_d2h, 'n_h2d': self.n_h2d, 'bytes_h2d': self.bytes_h2d, 'top_sync_sites': dict(sites)}
+
+
+  @staticmethod
+  def on_copy(src, out):
+    if not isinstance(out, torch.Tensor):
+      return
+    src_cuda = isinstance(src, torch.Tensor) and src.is_cuda
+    n_bytes = out.numel()*out.element_size()
+    for counter in SyncCounter.counters():
+      if src_cuda and not out.is_cuda:
+        counter.n_d2h += 1
+        counter.bytes_d2h += n_bytes
+      elif out.is_cuda and not src_cuda:
+        counter.n_h2d += 1
+        counter.bytes_h2d += n_bytes
+
+
+  @staticmethod
+  def counters():
+    '''Active counters of the calling thread
+    '''
+    thread = threading.get_ident()
+    return [counter for counter in SyncCounter.active if counter.thread==thread]
+
+
+  @staticmethod
+  def on_sync(site):
+    for counter in SyncCounter.counters():
+      counter.n_syncs += 1
+      counter.sync_sites[site] += 1
+
+
+  @staticmethod
+  def patch():
+    originals = SyncCounter.originals
+    for name in ['to', 'cpu', 'cuda']:
+      originals[(torch.Tensor,name)] = getattr(torch.Tensor, name)
+      def copy_method(self, *args, _ori=originals[(torch.Tensor,name)], **kwargs):
+        out = _ori(self, *args, **kwargs)
+        if out is not self:
+          SyncCounter.on_copy(self, out)
+        return out
+      setattr(torch.Tensor, name, copy_method)
+    for name in ['as_tensor', 'tensor']:
+      originals[(torch,name)] = getattr(torch, name)
+      def copy_fn(data, *args, _ori=originals[(torch,name)], **kwargs):
+        out = _ori(data, *args, **kwargs)
+        if out is not data:
+          SyncCounter.on_copy(data, out)
+        return out
+      setattr(torch, name, copy_fn)
+    for name in ['item', 'tolist', '__bool__', '__float__', '__int__']:
+      originals[(torch.Tensor,name)] = getattr(torch.Tensor, name)
+      def read_method(self, *args, _ori=originals[(torch.Tensor,name)], **kwargs):
+        if self.is_cuda:
+          for counter in SyncCounter.counters():
+            counter.n_d2h += 1
+            counter.bytes_d2h += self.numel()*self.element_size()
+        return _ori(self, *args, **kwargs)
+      setattr(torch.Tensor, name, read_method)
+    originals[(torch.cuda,'synchronize')] = torch.cuda.synchronize
+    def synchronize(*args, _ori=originals[(torch.cuda,'synchronize')], **kwargs):
+      SyncCounter.on_sync('torch.cuda.synchronize')
+      return _ori(*args, **kwargs)
+    torch.cuda.synchronize = synchronize
+
+    def showwarning(message, category, filename, lineno, file=None, line=None):
+      if 'synchronizing CUDA operation' in str(message):
+        SyncCounter.on_sync(f'{os.path.basename(filename)}:{lineno}')
+      else:
+        SyncCounter.showwarning(message, category, filename, lineno, file=file, line=line)
+    SyncCounter.warnings_ctx = warnings.catch_warnings()
+    SyncCounter.warnings_ctx.__enter__()
+    SyncCounter.showwarning = warnings.showwarning
+    warnings.showwarning = showwarning
+    warnings.filterwarnings('always', message='.*synchronizing CUDA operation')
+    if torch.cuda.is_available():
+      SyncCounter.sync_debug_mode = torch.cuda.get_sync_debug_mode()
+      torch.cuda.set_sync_debug_mode('warn')
+
+
+  @staticmethod
+  def unpatch():
+    '''Undo whatever patch() got to install, also after it failed halfway
+    '''
+    try:
+      if getattr(SyncCounter, 'sync_debug_mode', None) is not None:
+        torch.cuda.set_sync_debug_mode(SyncCounter.sync_debug_mode)
+        SyncCounter.sync_debug_mode = None
+    finally:
+      try:
+        if getattr(SyncCounter, 'warnings_ctx', None) is not None:
+          SyncCounter.warnings_ctx.__exit__(None, None, None)   # Restores showwarning and the filters
+          SyncCounter.warnings_ctx = None
+      finally:
+        for (owner,name),ori in SyncCounter.originals.items():
+          setattr(owner, name, ori)
+        SyncCounter.originals = {}
+
+
+  def __enter__(self):
+    with SyncCounter.lock:
+      if len(SyncCounter.active)==0:
+        try:
+          SyncCounter.patch()
+        except:
+          SyncCounter.unpatch()
+          raise
+      self.thread = threading.get_ident()
+      SyncCounter.active.append(self)
+    return self
+
+
+  def __exit__(self, *args):
+    with SyncCounter.lock:
+      SyncCounter.active.remove(self)
+      if len(SyncCounter.active)==0:
+        SyncCounter.unpatch()
+
+
+class StageProfiler:
+  '''Nested timing of named stages (register > refine > crop_render ...). Each stage records its CPU wall time, its GPU time through CUDA events and the peak of
+  allocated CUDA memory while it ran. Disabled, stage() hands out a shared null context so the instrumented code pays nothing.
+    stage_profiler.enabled = True
+    with stage_profiler.stage('depth_filter'):
+      ...
+    print(stage_profiler.summary_table())
+    stage_profiler.export_chrome_trace('trace.json')   # chrome://tracing or ui.perfetto.dev
+  CUDA events are read only when summarizing or exporting, so timing does not add synchronizations to the pipeline
+  '''
+  def __init__(self, enabled=False, cuda_events=True):
+    self.enabled = enabled
+    self.cuda_events = cuda_events
+    self.null_stage = nullcontext()
+    self.reset()
+
+
+  def reset(self):
+    self.records = []
+    self.stack = []
+    self.ref = None   # (cpu time, cuda event) the GPU timestamps are relative to
+
+
+  def use_cuda(self):
+    return self.cuda_events and torch.cuda.is_available()
+
+
+  def stage(self, name):
+    if not self.enabled:
+      return self.null_stage
+    return self._stage(name)
+
+
+  def wrap(self, name):
+    '''Method decorator running the whole call as one stage
+    '''
+    def decorator(func):
+      @wraps(func)
+      def wrapper(*args, **kwargs):
+        with self.stage(name):
+          return func(*args, **kwargs)
+      return wrapper
+    return decorator
+
+
+  def _update_peaks(self):
+    peak = torch.cuda.max_memory_allocated()
+    for frame in self.stack:
+      frame['peak_mem'] = max(frame['peak_mem'], peak)
+    torch.cuda.reset_peak_memory_stats()
+
+
+  @contextmanager
+  def _stage(self, name):
+    use_cuda = self.use_cuda()
+    frame = {'name': name, 'path': '/'.join([f['name'] for f in self.stack]+[name]), 'depth': len(self.stack), 'peak_mem': 0, 'events': None}
+    if use_cuda:
+      self._update_peaks()
+      frame['events'] = (torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True))
+      if self.ref is None:
+        self.ref = (time.perf_counter(), torch.cuda.Event(enable_timing=True))
+        self.ref[1].record()
+      frame['events'][0].record()
+    self.stack.append(frame)
+    frame['cpu_start'] = time.perf_counter()
+    try:
+      yield frame
+    finally:
+      frame['cpu_dur'] = time.perf_counter()-frame['cpu_start']
+      if use_cuda:
+        frame['events'][1].record()
+        self._update_peaks()
+      self.stack.pop()
+      self.records.append(frame)
+
+
+  def resolve(self):
+    '''Fill in the GPU times of the finished stages, waits for the GPU
+    '''
+    if self.ref is None:
+      return
+    self.ref[1].synchronize()
+    for frame in self.records:
+      if frame['events'] is not None and 'gpu_dur' not in frame:
+        frame['events'][1].synchronize()
+        frame['gpu_start'] = self.ref[0]+self.ref[1].elapsed_time(frame['events'][0])/1000.0
+        frame['gpu_dur'] = frame['events'][0].elapsed_time(frame['events'][1])/1000.0
+
+
+  def summary(self):
+    '''
+    Return: DataFrame with one row per stage path, in order of first occurrence. Times in ms, memory in MB. pct is the share of the parent stage's total
+    '''
+    self.resolve()
+    rows = OrderedDict()
+    for frame in sorted(self.records, key=lambda f: f['cpu_start']):
+      row = rows.setdefault(frame['path'], {'stage': '  '*frame['depth']+frame['name'], 'calls': 0, 'cpu_total_ms': 0.0, 'gpu_total_ms': 0.0, 'peak_mem_MB': 0.0})
+      row['calls'] += 1
+      row['cpu_total_ms'] += frame['cpu_dur']*1000
+      row['gpu_total_ms'] += frame.get('gpu_dur', 0)*1000
+      row['peak_mem_MB'] = max(row['peak_mem_MB'], frame['peak_mem']/1024**2)
+    has_gpu = any(frame['events'] is not None for frame in self.records)
+    time_key = 'gpu_total_ms' if has_gpu else 'cpu_total_ms'
+    for path, row in rows.items():
+      row['cpu_mean_ms'] = row['cpu_total_ms']/row['calls']
+      row['gpu_mean_ms'] = row['gpu_total_ms']/row['calls']
+      parent = path.rsplit('/',1)[0] if '/' in path else None
+      row['pct'] = 100.0*row[time_key]/rows[parent][time_key] if parent in rows and rows[parent][time_key]>0 else 100.0
+    df = pd.DataFrame(list(rows.values()), columns=['stage', 'calls', 'cpu_total_ms', 'cpu_mean_ms', 'gpu_total_ms', 'gpu_mean_ms', 'pct', 'peak_mem_MB'])
+    if not has_gpu:
+      df = df.drop(columns=['gpu_total_ms', 'gpu_mean_ms', 'peak_mem_MB'])
+    return df
+
+
+  def summary_table(self):
+    return self.summary().to_string(index=False, float_format=lambda x: f'{x:.2f}')
+
+
+  def export_chrome_trace(self, out_file):
+    '''Complete events ('X') on a CPU track and, with CUDA events, a GPU track. Timestamps in microseconds
+    '''
+    self.resolve()
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'cpu'}}]
+    if any(frame['events'] is not None for frame in self.records):
+      events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 1, 'args': {'name': 'gpu'}})
+    for frame in self.records:
+      args = {'path': frame['path']}
+      if frame['events'] is not None:
+        args['peak_mem_MB'] = frame['peak_mem']/1024**2
+      events.append({'name': frame['name'], 'cat': 'cpu', 'ph': 'X', 'pid': 0, 'tid': 0, 'ts': frame['cpu_start']*1e6, 'dur': frame['cpu_dur']*1e6, 'args': args})
+      if frame['events'] is not None:
+        events.append({'name': frame['name'], 'cat': 'gpu', 'ph': 'X', 'pid': 0, 'tid': 1, 'ts': frame['gpu_start']*1e6, 'dur': frame['gpu_dur']*1e6, 'args': args})
+    with open(out_file, 'w') as ff:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, ff)
+
+
+stage_profiler = StageProfiler(enabled=bool(enable_timer))
+
+
 def set_seed(random_seed):
   import torch,random
   np.random.seed(random_seed)
@@ -404,6 +1185,53 @@ if wp is not None:
     return depth_out
 
 
+def bilateral_filter_depth_torch(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  '''Same as the warp kernel, written with unfold so that it also runs on cpu
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  H,W = depth_t.shape[:2]
+  k = 2*radius+1
+  patches = F.unfold(depth_t[None,None], kernel_size=k, padding=radius)[0]  #(k*k,H*W)
+  inside = F.unfold(torch.ones_like(depth_t)[None,None], kernel_size=k, padding=radius)[0]>0
+  valid = inside & (patches>=0.001) & (patches<zfar)
+  num_valid = valid.sum(dim=0)
+  mean_depth = (patches*valid).sum(dim=0)/num_valid.clamp(min=1)
+  valid = valid & (torch.abs(patches-mean_depth[None])<0.01)
+  vs,us = torch.meshgrid(torch.arange(-radius,radius+1,device=device), torch.arange(-radius,radius+1,device=device), indexing='ij')
+  spatial = (vs**2+us**2).reshape(-1,1).float()
+  center = depth_t.reshape(1,-1)
+  weight = torch.exp(-spatial/(2.0*sigmaD*sigmaD) - (center-patches)**2/(2.0*sigmaR*sigmaR))*valid
+  sum_weight = weight.sum(dim=0)
+  depth_out = (weight*patches).sum(dim=0)/torch.where(sum_weight>0, sum_weight, torch.ones_like(sum_weight))
+  depth_out[(sum_weight<=0) | (num_valid==0)] = 0
+  depth_out = depth_out.reshape(H,W)
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+def erode_depth_torch(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  '''Same as the warp kernel, written with unfold so that it also runs on cpu
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  H,W = depth_t.shape[:2]
+  k = 2*radius+1
+  patches = F.unfold(depth_t[None,None], kernel_size=k, padding=radius)[0]  #(k*k,H*W)
+  inside = F.unfold(torch.ones_like(depth_t)[None,None], kernel_size=k, padding=radius)[0]>0
+  d_ori = depth_t.reshape(1,-1)
+  bad = inside & ((patches<0.001) | (patches>=zfar) | (torch.abs(patches-d_ori)>depth_diff_thres))
+  ratio = bad.sum(dim=0).float()/inside.sum(dim=0).float()
+  depth_out = torch.where(ratio>ratio_thres, torch.zeros_like(d_ori[0]), d_ori[0]).reshape(H,W)
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+if wp is None:
+  bilateral_filter_depth = bilateral_filter_depth_torch
+  erode_depth = erode_depth_torch
+
+
 
 def depth2xyzmap(depth, K, uvs=None):
   invalid_mask = (depth<0.001)
@@ -434,16 +1262,15 @@ def depth2xyzmap_batch(depths, Ks, zfar):
   bs = depths.shape[0]
   invalid_mask = (depths<0.001) | (depths>zfar)
   H,W = depths.shape[-2:]
-  vs,us = torch.meshgrid(torch.arange(0,H),torch.arange(0,W), indexing='ij')
-  vs = vs.reshape(-1).float().cuda()[None].expand(bs,-1)
-  us = us.reshape(-1).float().cuda()[None].expand(bs,-1)
+  grid = get_crop_pixel_grid(H, W, depths.device)
+  us = grid[0][None].expand(bs,-1)
+  vs = grid[1][None].expand(bs,-1)
   zs = depths.reshape(bs,-1)
   Ks = Ks[:,None].expand(bs,zs.shape[-1],3,3)
   xs = (us-Ks[...,0,2])*zs/Ks[...,0,0]  #(B,N)
   ys = (vs-Ks[...,1,2])*zs/Ks[...,1,1]
   pts = torch.stack([xs,ys,zs], dim=-1)  #(B,N,3)
-  xyz_maps = pts.reshape(bs,H,W,3)
-  xyz_maps[invalid_mask] = 0
+  xyz_maps = pts.reshape(bs,H,W,3)*(~invalid_mask)[...,None]   # Masking by multiplication, boolean indexing would sync with the host
   return xyz_maps
 
 
@@ -565,28 +1392,219 @@ def random_direction():
 
 
 
+def _build_box_tree(xyz, leaf_size):
+  '''Median-split tree of axis aligned boxes over the columns of xyz
+  @xyz: (3,N), reordered in place so that every node covers a contiguous range
+  Return: starts (K,), ends (K,), los (K,3), his (K,3), children (K,2) with -1 for leaves
+  '''
+  starts, ends, los, his, children = [], [], [], [], []
+  stack = [(0, xyz.shape[1], -1, 0)]
+  while len(stack)>0:
+    start, end, parent, side = stack.pop()
+    node = len(starts)
+    if parent>=0:
+      children[parent][side] = node
+    cur = xyz[:,start:end]
+    lo = cur.min(axis=1)
+    hi = cur.max(axis=1)
+    starts.append(start)
+    ends.append(end)
+    los.append(lo)
+    his.append(hi)
+    children.append([-1,-1])
+    if end-start>leaf_size:
+      mid = (end-start)//2
+      order = np.argpartition(cur[np.argmax(hi-lo)], mid)
+      xyz[:,start:end] = cur[:,order]
+      stack.append((start, start+mid, node, 0))
+      stack.append((start+mid, end, node, 1))
+  return np.asarray(starts), np.asarray(ends), np.asarray(los), np.asarray(his), np.asarray(children)
+
+
+def farthest_pair_distance(pts, leaf_size=256):
+  '''Exact largest pairwise distance. Pairs of tree boxes whose farthest corners are not farther apart than the best pair so far are pruned,
+  the remaining leaf pairs are compared exhaustively (leaf_size^2 distances at a time), so memory stays O(N)
+  @pts: (N,3)
+  '''
+  xyz = np.array(pts, dtype=np.float64).reshape(-1,3).T.copy()
+  if xyz.shape[1]<2:
+    return 0.0
+  far = np.argmax(((xyz-xyz[:,:1])**2).sum(axis=0))
+  best = ((xyz-xyz[:,far:far+1])**2).sum(axis=0).max()   # Lower bound to start pruning with
+  starts, ends, los, his, children = _build_box_tree(xyz, leaf_size)
+  sizes = ends-starts
+  is_leaf = children[:,0]<0
+
+  A = np.zeros((1), dtype=int)
+  B = np.zeros((1), dtype=int)
+  leaf_A, leaf_B, leaf_ub = [], [], []
+  while len(A)>0:
+    gap = np.maximum(np.abs(his[A]-los[B]), np.abs(his[B]-los[A]))
+    ub = (gap**2).sum(axis=-1)
+    keep = ub>best
+    A, B, ub = A[keep], B[keep], ub[keep]
+    both_leaf = is_leaf[A] & is_leaf[B]
+    leaf_A.append(A[both_leaf])
+    leaf_B.append(B[both_leaf])
+    leaf_ub.append(ub[both_leaf])
+    A, B = A[~both_leaf], B[~both_leaf]
+    same = A==B
+    split_a = ~same & ~is_leaf[A] & (is_leaf[B] | (sizes[A]>=sizes[B]))
+    split_b = ~same & ~split_a
+    S, SA, SB = A[same], A[split_a], B[split_b]
+    A = np.concatenate([children[S,0], children[S,0], children[S,1], children[SA,0], children[SA,1], A[split_b], A[split_b]])
+    B = np.concatenate([children[S,0], children[S,1], children[S,1], B[split_a], B[split_a], children[SB,0], children[SB,1]])
+
+  leaf_A = np.concatenate(leaf_A)
+  leaf_B = np.concatenate(leaf_B)
+  leaf_ub = np.concatenate(leaf_ub)
+  order = np.argsort(-leaf_ub)
+  for a,b,ub in zip(leaf_A[order], leaf_B[order], leaf_ub[order]):
+    if ub<=best:
+      break
+    pa = xyz[:,starts[a]:ends[a]]
+    pb = xyz[:,starts[b]:ends[b]]
+    best = max(best, ((pa[:,:,None]-pb[:,None,:])**2).sum(axis=0).max())
+  return float(np.sqrt(best))
+
+
 def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
-  from sklearn.decomposition import TruncatedSVD
+  '''The farthest pair is made of convex hull vertices, so only the H hull vertices of the N points go to farthest_pair_distance.
+  Time O(N log N) for the hull, then O(H log H) for the search when its box pruning works, degrading to O(H^2) when many pairs are
+  within rounding of the diameter (points all over a sphere). Peak memory O(N) for the hull plus O(H + P) for the search, P the leaf pairs it keeps
+  (at most (H/leaf_size)^2, again only for sphere-like inputs), and leaf_size^2 distances at a time
+  @n_sample: if not None, only a random subset of this size is considered and the result is a lower bound. None for the exact diameter
+  '''
   if mesh is not None:
-    u, s, vh = scipy.linalg.svd(mesh.vertices, full_matrices=False)
-    pts = u@s
-    diameter = np.linalg.norm(pts.max(axis=0)-pts.min(axis=0))
-    return float(diameter)
-
-  if n_sample is None:
-    pts = model_pts
-  else:
-    ids = np.random.choice(len(model_pts), size=min(n_sample, len(model_pts)), replace=False)
-    pts = model_pts[ids]
-  dists = np.linalg.norm(pts[None]-pts[:,None], axis=-1)
-  diameter = dists.max()
-  return diameter
+    model_pts = mesh.vertices
+  pts = np.asarray(model_pts, dtype=np.float64).reshape(-1,3)
+  if n_sample is not None and n_sample<len(pts):
+    ids = np.random.choice(len(pts), size=n_sample, replace=False)
+    pts = pts[ids]
+  if len(pts)>4:
+    try:
+      pts = pts[ConvexHull(pts).vertices]
+    except QhullError:   # Flat or otherwise degenerate: search all points
+      pass
+  return farthest_pair_distance(pts)
+
+
+def cluster_poses(angle_diff, dist_diff, poses_in, symmetry_tfs, bs=64):
+  '''Greedy pose clustering with the same output as mycpp.cluster_poses. A pose starts a new cluster unless, under some symmetry, it is within angle_diff and dist_diff of an already kept one.
+  As in mycpp, kept clusters are bucketed by their quaternion (w>=0) on a 4D grid whose cell is the chord of the angle threshold, and each symmetric variant of a pose only looks at the 3^4 neighbouring cells
+  (also those of -q near w=0). Up to 64 kept clusters, comparing against all of them is cheaper and done instead. Candidates then get the exact float32 rotation test.
+  Poses go in blocks of bs: a block is looked up against the clusters kept before it at once, then its remaining poses are resolved among themselves in order.
+  Time O(N*S*81*log(M) + N*bs*S) for N poses, S symmetries and M kept clusters, plus the candidates found; memory O(N*S + bs*S*(81+bs))
+  @angle_diff: unit is degree
+  @dist_diff: unit is meter
+  @poses_in: (N,4,4)
+  @symmetry_tfs: (S,4,4)
+  Return: (M,4,4) np array float32
+  '''
+  from scipy.spatial.transform import Rotation
+  poses = np.asarray(poses_in, dtype=np.float32).reshape(-1,4,4)
+  tfs = np.asarray(symmetry_tfs, dtype=np.float32).reshape(-1,4,4)
+  N = len(poses)
+  S = len(tfs)
+  if N<=1 or S==0:
+    return poses.copy()
+  radian_thres = np.float32(angle_diff/180.0*np.pi)
+  rots = poses[:,:3,:3]
+  trans = poses[:,:3,3]
+  rots_tf = tfs[:,:3,:3]
+
+  quats = Rotation.from_matrix(rots.astype(np.float64)).as_quat()  #(N,4) xyzw
+  quats_tf = Rotation.from_matrix(rots_tf.astype(np.float64)).as_quat()  #(S,4)
+  x1,y1,z1,w1 = [quats[:,None,k] for k in range(4)]
+  x2,y2,z2,w2 = [quats_tf[None,:,k] for k in range(4)]
+  quats_sym = np.stack([w1*x2+x1*w2+y1*z2-z1*y2,
+                        w1*y2-x1*z2+y1*w2+z1*x2,
+                        w1*z2+x1*y2-y1*x2+z1*w2,
+                        w1*w2-x1*x2-y1*y2-z1*z2], axis=-1)  #(N,S,4), rotation of R@R_sym
+  quats = np.where(quats[:,3:4]<0, -quats, quats)
+  quats_sym = np.where(quats_sym[...,3:4]<0, -quats_sym, quats_sym)
+  half_angle = min(float(radian_thres)/2+1e-3, np.pi/2)   # Margin against the float32 exact test below
+  min_abs_dot = np.cos(half_angle)
+  cell_size = max(np.sqrt(2-2*min_abs_dot), 1e-3)   # Chord between unit quaternions at half_angle
+  n_cells = int(np.ceil(2/cell_size))+3
+  def to_codes(q):
+    cells = np.floor((q+1)/cell_size).astype(np.int64)+1   # Neighbours of cell 0 are at -1
+    return ((cells[...,0]*n_cells + cells[...,1])*n_cells + cells[...,2])*n_cells + cells[...,3]
+  offsets = np.stack(np.meshgrid(*[np.arange(-1,2)]*4, indexing='ij'), axis=-1).reshape(-1,4)  #(81,4)
+  offset_codes = ((offsets[:,0]*n_cells + offsets[:,1])*n_cells + offsets[:,2])*n_cells + offsets[:,3]   # The code is linear in the cell
+
+  def match(ids_pose, ids_sym, ids_cand):
+    '''Exact test, float32 sums in the same order as the Eigen code so that poses sitting exactly on the threshold go the same way
+    '''
+    diff = trans[ids_cand]-trans[ids_pose]
+    close = np.sqrt((diff[:,0]*diff[:,0] + diff[:,1]*diff[:,1]) + diff[:,2]*diff[:,2])<dist_diff
+    R = rots[ids_pose]
+    R_tf = rots_tf[ids_sym]
+    R1 = (R[:,:,0:1]*R_tf[:,0:1,:] + R[:,:,1:2]*R_tf[:,1:2,:]) + R[:,:,2:3]*R_tf[:,2:3,:]
+    prod = R1*rots[ids_cand]
+    diag = prod[...,0] + (prod[...,1] + prod[...,2])
+    cos = ((diag[:,0] + (diag[:,1] + diag[:,2])) - np.float32(1))/np.float32(2)   # trace(R1@R2.T)
+    return close & (np.arccos(np.clip(cos, np.float32(-1), np.float32(1)))<radian_thres)
+
+  max_linear_scan = 64
+  kept = np.zeros((N), dtype=bool)
+  kept[0] = True
+  kept_ids = np.zeros((1), dtype=int)
+  bucket_codes = to_codes(quats[:1])   # Sorted cell codes of the kept clusters
+  bucket_ids = np.zeros((1), dtype=int)
+  for b in range(1,N,bs):
+    block = np.arange(b, min(b+bs,N))
+
+    ########## Against the clusters kept before the block
+    if len(kept_ids)<=max_linear_scan:
+      ids_pose, ids_sym, ids_cand = np.nonzero(np.abs(quats_sym[block]@quats[kept_ids].T)>=min_abs_dot)
+      ids_cand = kept_ids[ids_cand]
+    else:
+      ids_pose, ids_sym = np.nonzero(np.ones((len(block),S), dtype=bool))
+      near_pose, near_sym = np.nonzero(quats_sym[block,:,3]<cell_size)   # -q may land in another cell
+      ids_pose = np.concatenate([ids_pose, near_pose])
+      ids_sym = np.concatenate([ids_sym, near_sym])
+      codes = np.concatenate([to_codes(quats_sym[block]).reshape(-1), to_codes(-quats_sym[block[near_pose],near_sym])])
+      codes = (codes[:,None]+offset_codes[None]).reshape(-1)
+      begin = np.searchsorted(bucket_codes, codes, side='left')
+      count = np.searchsorted(bucket_codes, codes, side='right')-begin
+      hit = np.nonzero(count)[0]
+      count = count[hit]
+      within = np.arange(count.sum())-np.repeat(np.cumsum(count)-count, count)
+      ids_cand = bucket_ids[np.repeat(begin[hit], count)+within]
+      ids_pose = ids_pose[np.repeat(hit//len(offsets), count)]
+      ids_sym = ids_sym[np.repeat(hit//len(offsets), count)]
+    ids_pose = block[ids_pose]
+    matched = ids_pose[match(ids_pose, ids_sym, ids_cand)]
+    rest = np.setdiff1d(block, matched)
+
+    ########## Among the rest of the block, in order
+    ids_pose, ids_sym, ids_cand = np.nonzero(np.abs(quats_sym[rest]@quats[rest].T)>=min_abs_dot)
+    ids_pose, ids_cand = rest[ids_pose], rest[ids_cand]
+    earlier = ids_cand<ids_pose
+    ids_pose, ids_sym, ids_cand = ids_pose[earlier], ids_sym[earlier], ids_cand[earlier]
+    valid = match(ids_pose, ids_sym, ids_cand)
+    ids_pose, ids_cand = ids_pose[valid], ids_cand[valid]   # Sorted by ids_pose, as nonzero returns them
+    bounds = np.searchsorted(ids_pose, rest, side='left')
+    ends = np.searchsorted(ids_pose, rest, side='right')
+    for i,begin,end in zip(rest, bounds, ends):
+      kept[i] = not kept[ids_cand[begin:end]].any()
+
+    new_ids = block[kept[block]]
+    if len(new_ids)>0:
+      kept_ids = np.concatenate([kept_ids, new_ids])
+      bucket_codes = np.concatenate([bucket_codes, to_codes(quats[new_ids])])
+      bucket_ids = np.concatenate([bucket_ids, new_ids])
+      order = np.argsort(bucket_codes, kind='stable')
+      bucket_codes, bucket_ids = bucket_codes[order], bucket_ids[order]
+  return poses[kept].copy()
 
 
 def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, crop_ratio=1.2, out_size=None, rgb=None, uvs=None, method='min_box', mesh_diameter=None):
   '''Project the points and find the cropping transform
   @pts: (N,3)
   @poses: (B,4,4) tensor
+  @mesh_diameter: float, or (B,) tensor when the poses belong to different objects
   @min_box: min_box/min_circle
   @scale: scale to apply to the tightly enclosing roi
   '''
@@ -597,26 +1615,26 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
     top = top.round()
     bottom = bottom.round()
 
-    tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    tf = torch.eye(3, device=left.device)[None].expand(B,-1,-1).contiguous()
     tf[:,0,2] = -left
     tf[:,1,2] = -top
-    new_tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    new_tf = torch.eye(3, device=left.device)[None].expand(B,-1,-1).contiguous()
     new_tf[:,0,0] = out_size[0]/(right-left)
     new_tf[:,1,1] = out_size[1]/(bottom-top)
     tf = new_tf@tf
     return tf
 
   B = len(poses)
-  torch.set_default_tensor_type('torch.cuda.FloatTensor')
+  device = poses.device
   if method=='box_3d':
-    radius = mesh_diameter*crop_ratio/2
+    radius = torch.as_tensor(mesh_diameter*crop_ratio/2, dtype=torch.float, device=device).reshape(-1,1,1)   # Scalar or per pose (B,)
     offsets = torch.tensor([0,0,0,
-                        radius,0,0,
-                        -radius,0,0,
-                        0,radius,0,
-                        0,-radius,0]).reshape(-1,3)
-    pts = poses[:,:3,3].reshape(-1,1,3)+offsets.reshape(1,-1,3)
-    K = torch.as_tensor(K)
+                        1,0,0,
+                        -1,0,0,
+                        0,1,0,
+                        0,-1,0], dtype=torch.float, device=device).reshape(1,-1,3)*radius
+    pts = poses[:,:3,3].reshape(-1,1,3)+offsets
+    K = torch.as_tensor(K, dtype=torch.float, device=device)
     projected = (K@pts.reshape(-1,3).T).T
     uvs = projected[:,:2]/projected[:,2:3]
     uvs = uvs.reshape(B, -1, 2)
@@ -636,6 +1654,116 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
 
 
 
+def dedup_crop_windows(tf_to_crops, out_size, quantize=None):
+  '''Find the crop windows shared by several poses, so that the observed image only needs to be warped once per window
+  @tf_to_crops: (B,3,3) scale+translation transforms from compute_crop_window_tf_batch
+  @out_size: (W,H) of the crop
+  @quantize: pixels. If set, windows whose left, top, width and height round to the same multiple of it are merged, and their tf_to_crops are rewritten to the shared window
+  @return: tf_to_crops (B,3,3), uniq (U,) one pose id per window, inverse (B,) window id of every pose
+  '''
+  B = len(tf_to_crops)
+  if quantize:
+    window = torch.stack([-tf_to_crops[:,0,2]/tf_to_crops[:,0,0], -tf_to_crops[:,1,2]/tf_to_crops[:,1,1], out_size[0]/tf_to_crops[:,0,0], out_size[1]/tf_to_crops[:,1,1]], dim=-1)  #(B,4) left,top,width,height
+    window = (window/quantize).round()*quantize
+    tf_to_crops = torch.eye(3, device=tf_to_crops.device)[None].repeat(B,1,1)
+    tf_to_crops[:,0,0] = out_size[0]/window[:,2]
+    tf_to_crops[:,1,1] = out_size[1]/window[:,3]
+    tf_to_crops[:,0,2] = -window[:,0]*tf_to_crops[:,0,0]
+    tf_to_crops[:,1,2] = -window[:,1]*tf_to_crops[:,1,1]
+  _, inverse = torch.unique(tf_to_crops.reshape(B,9), dim=0, return_inverse=True)
+  U = int(inverse.max())+1
+  uniq = torch.full((U,), B, dtype=torch.long, device=tf_to_crops.device).scatter_reduce_(0, inverse, torch.arange(B, device=tf_to_crops.device), reduce='amin')
+  return tf_to_crops, uniq, inverse
+
+
+
+_crop_grid_cache = {}
+
+def get_crop_pixel_grid(H, W, device):
+  '''Homogeneous pixel coordinates (3,H*W) of an HxW crop, built once per size and device
+  '''
+  key = (H, W, str(device))
+  if key not in _crop_grid_cache:
+    vs,us = torch.meshgrid(torch.arange(H, dtype=torch.float, device=device), torch.arange(W, dtype=torch.float, device=device), indexing='ij')
+    _crop_grid_cache[key] = torch.stack([us.reshape(-1), vs.reshape(-1), torch.ones_like(us).reshape(-1)], dim=0)
+  return _crop_grid_cache[key]
+
+
+def mask_bbox_torch(mask):
+  '''Bounding box of a mask without leaving the device
+  @mask: (H,W) bool tensor
+  Return: (4,) float tensor umin,vmin,umax,vmax (meaningless if the mask is empty), and a bool tensor telling whether it is not
+  '''
+  cols = mask.any(dim=0)
+  rows = mask.any(dim=1)
+  umin = cols.int().argmax()
+  umax = len(cols)-1-cols.flip(0).int().argmax()
+  vmin = rows.int().argmax()
+  vmax = len(rows)-1-rows.flip(0).int().argmax()
+  return torch.stack([umin,vmin,umax,vmax]).float(), cols.any()
+
+
+def group_crop_windows(boxes):
+  '''Merge overlapping crop windows into groups, each group is sampled from its own ROI. Windows of different objects usually end up in different groups
+  @boxes: list of (x0,y0,x1,y1)
+  Return: list of (box, window ids)
+  '''
+  groups = [(list(box), [i]) for i,box in enumerate(boxes)]
+  merged = True
+  while merged:
+    merged = False
+    out = []
+    for box,ids in groups:
+      for other_box,other_ids in out:
+        if box[0]<other_box[2] and other_box[0]<box[2] and box[1]<other_box[3] and other_box[1]<box[3]:
+          other_box[:] = [min(box[0],other_box[0]), min(box[1],other_box[1]), max(box[2],other_box[2]), max(box[3],other_box[3])]
+          other_ids += ids
+          merged = True
+          break
+      else:
+        out.append((box,ids))
+    groups = out
+  return groups
+
+
+def crop_to_windows(img, tf_to_crops, dsize, mode='bilinear', device='cuda'):
+  '''Sample the crop windows out of a single image. Only the regions covered by the windows are uploaded and converted, so the cost does not depend on the image resolution.
+  Sampling positions follow kornia.geometry.transform.warp_perspective(..., align_corners=False), which this replaces: a crop pixel mapped to original pixel u is read at u*W/(W-1)-0.5
+  @img: (H,W) or (H,W,C) numpy array or tensor
+  @tf_to_crops: (B,3,3) tensor, original pixel to crop pixel
+  @dsize: (H,W) of the crops
+  @return: (B,C,H,W) float tensor, zero outside the image
+  '''
+  H_ori,W_ori = img.shape[:2]
+  h,w = dsize
+  B = len(tf_to_crops)
+  crop_to_oris = tf_to_crops.inverse()
+  uvs = (crop_to_oris@get_crop_pixel_grid(h, w, tf_to_crops.device)[None])  #(B,3,h*w)
+  uvs = uvs[:,:2]/uvs[:,2:3]
+  uvs = uvs*torch.tensor([W_ori/max(W_ori-1,1), H_ori/max(H_ori-1,1)], device=uvs.device).reshape(1,2,1)-0.5
+  bounds = torch.cat([uvs.amin(dim=2), uvs.amax(dim=2)], dim=1).tolist()  #(B,4)
+  boxes = []
+  for umin,vmin,umax,vmax in bounds:
+    x0 = int(np.clip(np.floor(umin), 0, W_ori-1))
+    y0 = int(np.clip(np.floor(vmin), 0, H_ori-1))
+    boxes.append((x0, y0, int(np.clip(np.ceil(umax)+1, x0+1, W_ori)), int(np.clip(np.ceil(vmax)+1, y0+1, H_ori))))
+
+  out = None
+  for (x0,y0,x1,y1),ids in group_crop_windows(boxes):
+    roi = torch.as_tensor(img[y0:y1, x0:x1], device=device).float()
+    if roi.ndim==2:
+      roi = roi[...,None]
+    if out is None:
+      out = torch.zeros((B,roi.shape[-1],h,w), dtype=torch.float, device=roi.device)
+    ids = torch.as_tensor(ids, device=uvs.device)
+    uv = uvs[ids]
+    grid = torch.stack([(uv[:,0]-x0)*2/max(x1-x0-1,1)-1, (uv[:,1]-y0)*2/max(y1-y0-1,1)-1], dim=-1).reshape(len(ids),h,w,2)
+    roi = roi.permute(2,0,1)[None].expand(len(ids),-1,-1,-1)
+    out[ids.to(out.device)] = F.grid_sample(roi, grid.to(roi.device), mode=mode, padding_mode='zeros', align_corners=True)
+  return out
+
+
+
 def cv_draw_text(img,text,uv_top_left,color=(255, 255, 255),fontScale=0.5,thickness=1,fontFace=cv2.FONT_HERSHEY_SIMPLEX,outline_color=None,line_spacing=1.5):
   H,W = img.shape[:2]
   uv_top_left = np.array(uv_top_left, dtype=float)
@@ -0,0 +1,85 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Time Utils.cluster_poses against mycpp.cluster_poses (when built) over rotation grid sizes and symmetry counts, and check both give the same poses
+python benchmarks/bench_cluster_poses.py --min_n_views 40 162 642 --inplane_steps 60 30
+'''
+
+import os,sys,json,argparse,time
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+def make_unclustered_grid(min_n_views, inplane_step):
+  cam_in_obs = sample_views_icosphere(n_views=min_n_views)
+  rot_grid = []
+  for i in range(len(cam_in_obs)):
+    for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step)):
+      cam_in_ob = cam_in_obs[i]@euler_matrix(0,0,inplane_rot)
+      rot_grid.append(np.linalg.inv(cam_in_ob))
+  return np.asarray(rot_grid).astype(np.float32)
+
+
+def make_symmetry_tfs(name):
+  if name=='none':
+    tfs = [np.eye(4)]
+  elif name=='discrete':
+    tfs = [np.eye(4), euler_matrix(np.pi,0,0)]
+  elif name=='continuous':
+    tfs = [np.eye(4)]+[euler_matrix(0,0,a) for a in np.deg2rad(np.arange(0,360,5))]
+  else:
+    raise RuntimeError(f'unknown symmetry {name}')
+  return np.asarray(tfs).astype(np.float32)
+
+
+def timeit(fn, n_repeat):
+  times = []
+  for _ in range(n_repeat):
+    begin = time.time()
+    out = fn()
+    times.append(time.time()-begin)
+  return np.asarray(out), float(np.median(times))
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--min_n_views', type=int, nargs='+', default=[40,162,642])
+  parser.add_argument('--inplane_steps', type=int, nargs='+', default=[60,30])
+  parser.add_argument('--symmetries', type=str, nargs='+', default=['none','discrete','continuous'])
+  parser.add_argument('--n_repeat', type=int, default=3)
+  parser.add_argument('--out_file', type=str, default=None)
+  args = parser.parse_args()
+
+  results = []
+  for min_n_views in args.min_n_views:
+    for inplane_step in args.inplane_steps:
+      rot_grid = make_unclustered_grid(min_n_views, inplane_step)
+      for sym_name in args.symmetries:
+        symmetry_tfs = make_symmetry_tfs(sym_name)
+        out, py_time = timeit(lambda: cluster_poses(30, 99999, rot_grid, symmetry_tfs), args.n_repeat)
+        res = {
+          'min_n_views': min_n_views,
+          'inplane_step': inplane_step,
+          'symmetry': sym_name,
+          'n_symmetry': len(symmetry_tfs),
+          'n_in': len(rot_grid),
+          'n_out': len(out),
+          'python_s': py_time,
+        }
+        if mycpp is not None:
+          out_cpp, cpp_time = timeit(lambda: mycpp.cluster_poses(30, 99999, rot_grid, symmetry_tfs), args.n_repeat)
+          res['mycpp_s'] = cpp_time
+          res['identical'] = bool(np.array_equal(out, out_cpp))
+        results.append(res)
+        print(json.dumps(res))
+
+  if args.out_file is not None:
+    with open(args.out_file, 'w') as ff:
+      json.dump(results, ff, indent=2)
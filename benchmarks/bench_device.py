@@ -0,0 +1,86 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Compare FoundationPose.register/track_one throughput on cpu and cuda with the same synthetic inputs
+python benchmarks/bench_device.py --devices cpu cuda --n_track 10
+'''
+
+import os,sys,json,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from estimater import *
+from benchmarks.synthetic import *
+
+
+def sync(device):
+  if torch.device(device).type=='cuda':
+    torch.cuda.synchronize()
+
+
+def run_device(device, mesh, rgb, depth, mask, K, est_refine_iter, track_refine_iter, n_track):
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, debug=0, debug_dir='/tmp/bench_device', device=device)
+  sync(device)
+  begin = time.time()
+  pose = est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=est_refine_iter)
+  sync(device)
+  register_time = time.time()-begin
+
+  track_times = []
+  for _ in range(n_track):
+    begin = time.time()
+    est.track_one(rgb=rgb, depth=depth, K=K, iteration=track_refine_iter)
+    sync(device)
+    track_times.append(time.time()-begin)
+  track_times = np.asarray(track_times)
+  return pose, {
+    'register_s': register_time,
+    'track_mean_s': float(track_times.mean()) if len(track_times)>0 else None,
+    'track_p50_s': float(np.percentile(track_times, 50)) if len(track_times)>0 else None,
+    'track_p90_s': float(np.percentile(track_times, 90)) if len(track_times)>0 else None,
+    'track_fps': float(1/track_times.mean()) if len(track_times)>0 else None,
+  }
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--devices', type=str, nargs='+', default=['cpu','cuda'])
+  parser.add_argument('--subdivisions', type=int, default=3)
+  parser.add_argument('--H', type=int, default=480)
+  parser.add_argument('--W', type=int, default=640)
+  parser.add_argument('--est_refine_iter', type=int, default=5)
+  parser.add_argument('--track_refine_iter', type=int, default=2)
+  parser.add_argument('--n_track', type=int, default=10)
+  parser.add_argument('--out_file', type=str, default=None)
+  args = parser.parse_args()
+
+  set_logging_format(logging.WARNING)
+  mesh = make_synthetic_mesh(subdivisions=args.subdivisions)
+  K = make_synthetic_K(H=args.H, W=args.W)
+  rgb, depth, mask, gt_pose = make_synthetic_frame(mesh, K, H=args.H, W=args.W, device='cpu')
+
+  results = {}
+  poses = {}
+  for device in args.devices:
+    if torch.device(device).type=='cuda' and not torch.cuda.is_available():
+      logging.warning(f'skip {device}, cuda not available')
+      continue
+    set_seed(0)
+    poses[device], results[device] = run_device(device, mesh, rgb, depth, mask, K, args.est_refine_iter, args.track_refine_iter, args.n_track)
+    results[device]['register_trans_err'] = float(np.linalg.norm(poses[device][:3,3]-gt_pose[:3,3]))
+
+  devices = list(poses.keys())
+  if len(devices)>=2:
+    results['pose_diff_trans'] = float(np.linalg.norm(poses[devices[0]][:3,3]-poses[devices[1]][:3,3]))
+    R_diff = poses[devices[0]][:3,:3].T@poses[devices[1]][:3,:3]
+    results['pose_diff_rot_deg'] = float(np.rad2deg(np.arccos(np.clip((np.trace(R_diff)-1)/2, -1, 1))))
+
+  print(json.dumps(results, indent=2))
+  if args.out_file is not None:
+    with open(args.out_file, 'w') as ff:
+      json.dump(results, ff, indent=2)
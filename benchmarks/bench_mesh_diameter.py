@@ -0,0 +1,76 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Time and peak RSS of compute_mesh_diameter against the former sampled all-pairs version. Every measurement runs in its own process so that peaks do not mix
+python benchmarks/bench_mesh_diameter.py --n_vertices 1000 10000 100000 1000000
+'''
+
+import os,sys,json,argparse,time,resource
+import multiprocessing as mp
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from benchmarks.synthetic import *
+
+
+def compute_mesh_diameter_legacy(model_pts, n_sample=10000):
+  '''What reset_object used before: all pairs over a random subset, (n_sample,n_sample,3) float64 intermediate
+  '''
+  ids = np.random.choice(len(model_pts), size=min(n_sample, len(model_pts)), replace=False)
+  pts = model_pts[ids]
+  dists = np.linalg.norm(pts[None]-pts[:,None], axis=-1)
+  return dists.max()
+
+
+def make_points(n_vertices, seed=0):
+  mesh = make_synthetic_mesh(subdivisions=4)
+  pts, _ = trimesh.sample.sample_surface(mesh, n_vertices, seed=seed)
+  return np.asarray(pts)
+
+
+def run_one(method, n_vertices, queue):
+  pts = make_points(n_vertices)
+  rss_before = psutil.Process().memory_info().rss
+  begin = time.time()
+  if method=='legacy':
+    diameter = compute_mesh_diameter_legacy(pts)
+  else:
+    diameter = compute_mesh_diameter(model_pts=pts, n_sample=None)
+  elapsed = time.time()-begin
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024   # KB on linux
+  queue.put({
+    'method': method,
+    'n_vertices': n_vertices,
+    'diameter': float(diameter),
+    'time_s': elapsed,
+    'peak_rss_increase_mb': max(peak-rss_before, 0)/1e6,
+  })
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--n_vertices', type=int, nargs='+', default=[1000,10000,100000,1000000])
+  parser.add_argument('--methods', type=str, nargs='+', default=['exact','legacy'])
+  parser.add_argument('--out_file', type=str, default=None)
+  args = parser.parse_args()
+
+  ctx = mp.get_context('spawn')
+  results = []
+  for n_vertices in args.n_vertices:
+    for method in args.methods:
+      queue = ctx.Queue()
+      p = ctx.Process(target=run_one, args=(method, n_vertices, queue))
+      p.start()
+      res = queue.get()
+      p.join()
+      results.append(res)
+      print(json.dumps(res))
+
+  if args.out_file is not None:
+    with open(args.out_file, 'w') as ff:
+      json.dump(results, ff, indent=2)
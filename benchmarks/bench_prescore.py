@@ -0,0 +1,103 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Accuracy vs speed of register with the silhouette/depth pre-score keeping only the top K hypotheses, on a BOP scene
+python benchmarks/bench_prescore.py --dataset lm --scene_dir /path/to/LINEMOD/lm_test_all/test/000001 --topks 0 32 64 128 --max_frames 50
+topk 0 means no pre-score (all hypotheses are refined)
+'''
+
+import os,sys,json,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from estimater import *
+
+
+READERS = {
+  'lm': LinemodReader,
+  'lmo': LinemodOcclusionReader,
+  'ycbv': YcbVideoReader,
+  'tless': TlessReader,
+  'hb': HomebrewedReader,
+  'itodd': ItoddReader,
+  'icbin': IcbinReader,
+  'tudl': TudlReader,
+}
+
+
+def sync(device):
+  if torch.device(device).type=='cuda':
+    torch.cuda.synchronize()
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dataset', type=str, default='lm', choices=list(READERS.keys()))
+  parser.add_argument('--scene_dir', type=str, required=True)
+  parser.add_argument('--topks', type=int, nargs='+', default=[0,32,64,128])
+  parser.add_argument('--max_frames', type=int, default=50)
+  parser.add_argument('--ob_ids', type=int, nargs='+', default=None, help='default all objects of the scene')
+  parser.add_argument('--iteration', type=int, default=5)
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--out_file', type=str, default=None)
+  args = parser.parse_args()
+
+  set_logging_format(logging.WARNING)
+  reader = READERS[args.dataset](args.scene_dir)
+  i_frames = np.linspace(0, len(reader.color_files)-1, min(args.max_frames, len(reader.color_files))).round().astype(int).tolist()
+  ob_ids = args.ob_ids
+  if ob_ids is None:
+    ob_ids = sorted(set([int(ob_id) for i_frame in i_frames for ob_id in reader.get_instance_ids_in_image(i_frame)]))
+
+  est = None
+  results = {topk:{'time_s':[], 'add':[], 'adds':[]} for topk in args.topks}
+  for ob_id in ob_ids:
+    mesh = reader.get_gt_mesh(ob_id)
+    symmetry_tfs = reader.symmetry_tfs[ob_id] if hasattr(reader, 'symmetry_tfs') else None
+    if est is None:
+      est = FoundationPose(model_pts=mesh.vertices.copy(), model_normals=mesh.vertex_normals.copy(), symmetry_tfs=symmetry_tfs, mesh=mesh, debug=0, debug_dir='/tmp/bench_prescore', device=args.device)
+    else:
+      est.reset_object(model_pts=mesh.vertices.copy(), model_normals=mesh.vertex_normals.copy(), symmetry_tfs=symmetry_tfs, mesh=mesh)
+    model_pts = mesh.vertices.copy()
+
+    for i_frame in i_frames:
+      if ob_id not in reader.get_instance_ids_in_image(i_frame):
+        continue
+      ob_mask = reader.get_mask(i_frame, ob_id)
+      if ob_mask is None or ob_mask.sum()<16:
+        continue
+      color = reader.get_color(i_frame)
+      depth = reader.get_depth(i_frame)
+      K = reader.get_K(i_frame)
+      gt_pose = reader.get_gt_pose(i_frame, ob_id)
+      for topk in args.topks:
+        sync(args.device)
+        begin = time.time()
+        pose = est.register(K=K, rgb=color, depth=depth, ob_mask=ob_mask, iteration=args.iteration, prescore_topk=topk if topk>0 else None)
+        sync(args.device)
+        results[topk]['time_s'].append(time.time()-begin)
+        results[topk]['add'].append(add_err(pose, gt_pose, model_pts))
+        results[topk]['adds'].append(adds_err(pose, gt_pose, model_pts))
+
+  summary = {}
+  for topk in args.topks:
+    res = results[topk]
+    if len(res['time_s'])==0:
+      continue
+    summary[topk] = {
+      'n_hypotheses': topk if topk>0 else len(est.rot_grid),
+      'n_samples': len(res['time_s']),
+      'register_mean_s': float(np.mean(res['time_s'])),
+      'register_p50_s': float(np.percentile(res['time_s'], 50)),
+      'add_auc': float(compute_auc_sklearn(res['add'])),
+      'adds_auc': float(compute_auc_sklearn(res['adds'])),
+    }
+  print(json.dumps(summary, indent=2))
+  if args.out_file is not None:
+    with open(args.out_file, 'w') as ff:
+      json.dump(summary, ff, indent=2)
@@ -0,0 +1,190 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Time nvdiffrast_render against the former per-attribute version over batch sizes and mesh sizes, rendering 160x160 crops like the refiner and scorer do. fused_lod additionally lets nvdiffrast_render pick a level of detail
+python benchmarks/bench_render.py --batch_sizes 1 16 64 256 1024 --subdivisions 3 4 5 6 7
+'''
+
+import os,sys,json,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from benchmarks.synthetic import *
+
+
+def nvdiffrast_render_legacy(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}, device='cuda'):
+  '''What nvdiffrast_render did before: one interpolate per attribute over camera space vertices of every pose, outputs flipped afterwards
+  @K: (3,3) np array
+  @ob_in_cams: (N,4,4) torch tensor, openCV camera
+  @projection_mat: np array (4,4)
+  @output_size: (height, width)
+  @bbox2d: (N,4) (umin,vmin,umax,vmax) if only roi need to render.
+  @light_dir: in cam space
+  @light_pos: in cam space
+  @device: on cpu the pytorch3d rasterizer is used instead of nvdiffrast, glctx is ignored
+  '''
+  device = torch.device(device)
+  use_cuda = device.type=='cuda'
+  if glctx is None and use_cuda:
+    if context == 'gl':
+      glctx = dr.RasterizeGLContext()
+    elif context=='cuda':
+      glctx = dr.RasterizeCudaContext(device)
+    else:
+      raise NotImplementedError
+    logging.info("created context")
+
+  if use_cuda:
+    interpolate = lambda attr, rast_out, tri: dr.interpolate(attr, rast_out, tri)[0]
+  else:
+    interpolate = interpolate_torch
+
+  if mesh_tensors is None:
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+  pos = mesh_tensors['pos']
+  vnormals = mesh_tensors['vnormals']
+  pos_idx = mesh_tensors['faces']
+  has_tex = 'tex' in mesh_tensors
+
+  ob_in_cams = torch.as_tensor(ob_in_cams, device=device, dtype=torch.float)
+  ob_in_glcams = torch.tensor(glcam_in_cvcam, device=device, dtype=torch.float)[None]@ob_in_cams
+  if projection_mat is None:
+    projection_mat = projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100)
+  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device=device, dtype=torch.float)
+  mtx = projection_mat@ob_in_glcams
+
+  if output_size is None:
+    output_size = np.asarray([H,W])
+
+  pts_cam = transform_pts(pos, ob_in_cams)
+  pos_homo = to_homo_torch(pos)
+  pos_clip = (mtx[:,None]@pos_homo[None,...,None])[...,0]
+  if bbox2d is not None:
+    l = bbox2d[:,0]
+    t = H-bbox2d[:,1]
+    r = bbox2d[:,2]
+    b = H-bbox2d[:,3]
+    tf = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
+    tf[:,0,0] = W/(r-l)
+    tf[:,1,1] = H/(t-b)
+    tf[:,3,0] = (W-r-l)/(r-l)
+    tf[:,3,1] = (H-t-b)/(t-b)
+    pos_clip = pos_clip@tf
+  if use_cuda:
+    rast_out, _ = dr.rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
+  else:
+    rast_out = rasterize_torch(pos_clip, pos_idx, resolution=np.asarray(output_size))
+  xyz_map = interpolate(pts_cam, rast_out, pos_idx)
+  depth = xyz_map[...,2]
+  if has_tex:
+    texc = interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
+    if use_cuda:
+      color = dr.texture(mesh_tensors['tex'], texc, filter_mode='linear')
+    else:
+      color = texture_torch(mesh_tensors['tex'], texc)
+  else:
+    color = interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
+
+  if use_light:
+    get_normal = True
+  if get_normal:
+    vnormals_cam = transform_dirs(vnormals, ob_in_cams)
+    normal_map = interpolate(vnormals_cam, rast_out, pos_idx)
+    normal_map = F.normalize(normal_map, dim=-1)
+    normal_map = torch.flip(normal_map, dims=[1])
+  else:
+    normal_map = None
+
+  if use_light:
+    if light_dir is not None:
+      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device=device)
+    else:
+      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device).reshape(1,1,3) - pts_cam
+    diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
+    diffuse_intensity_map = interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
+    if light_color is None:
+      light_color = color
+    else:
+      light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
+    color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
+
+  color = color.clip(0,1)
+  color = color * torch.clamp(rast_out[..., -1:], 0, 1) # Mask out background using alpha
+  color = torch.flip(color, dims=[1])   # Flip Y coordinates
+  depth = torch.flip(depth, dims=[1])
+  extra['xyz_map'] = torch.flip(xyz_map, dims=[1])
+  return color, depth, normal_map
+
+
+def sync(device):
+  if torch.device(device).type=='cuda':
+    torch.cuda.synchronize()
+
+
+def make_poses(n, seed=0):
+  rng = np.random.RandomState(seed)
+  poses = []
+  for _ in range(n):
+    pose = random_rotation_matrix(rng.rand(3))
+    pose[:3,3] = [0, 0, 0.6]
+    poses.append(pose)
+  return np.asarray(poses)
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1,16,64,256,1024])
+  parser.add_argument('--subdivisions', type=int, nargs='+', default=[3,4,5,6,7], help='faces 20*4^s, i.e. 1.3k to 330k')
+  parser.add_argument('--render_size', type=int, default=160)
+  parser.add_argument('--use_light', type=int, default=1)
+  parser.add_argument('--get_normal', type=int, default=0)
+  parser.add_argument('--n_repeat', type=int, default=5)
+  parser.add_argument('--lod_min_faces', type=int, default=20000, help='for the fused_lod column')
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--out_file', type=str, default=None)
+  args = parser.parse_args()
+
+  device = args.device
+  H,W = 480,640
+  K = make_synthetic_K(H, W)
+  glctx = dr.RasterizeCudaContext(device) if torch.device(device).type=='cuda' else None
+  results = []
+  for subdivisions in args.subdivisions:
+    mesh = make_synthetic_mesh(subdivisions=subdivisions)
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
+    mesh_tensors_lod = make_mesh_tensors(mesh, device=device, lod_min_faces=args.lod_min_faces)
+    for batch_size in args.batch_sizes:
+      ob_in_cams = torch.as_tensor(make_poses(batch_size), dtype=torch.float, device=device)
+      bbox2d = torch.as_tensor([W/2-100, H/2-100, W/2+100, H/2+100], dtype=torch.float, device=device).reshape(1,4).expand(batch_size,-1)
+      lod_pix_per_meter = K[0,0]*args.render_size/200/0.6   # The 200 pixel window scaled to render_size, every pose at 0.6m
+      res = {'n_faces': len(mesh.faces), 'batch_size': batch_size}
+      outs = {}
+      for name,fn,cur_mesh_tensors,kwargs in [('legacy',nvdiffrast_render_legacy,mesh_tensors,{}), ('fused',nvdiffrast_render,mesh_tensors,{}), ('fused_lod',nvdiffrast_render,mesh_tensors_lod,{'lod_pix_per_meter':lod_pix_per_meter})]:
+        times = []
+        for i in range(args.n_repeat+1):
+          extra = {}
+          sync(device)
+          begin = time.time()
+          color, depth, normal = fn(K=K, H=H, W=W, ob_in_cams=ob_in_cams, glctx=glctx, mesh_tensors=cur_mesh_tensors, output_size=(args.render_size,args.render_size), bbox2d=bbox2d, use_light=bool(args.use_light), get_normal=bool(args.get_normal), extra=extra, device=device, **kwargs)
+          sync(device)
+          if i>0:   # First call warms up
+            times.append(time.time()-begin)
+        outs[name] = (color, extra['xyz_map'])
+        res[f'{name}_ms'] = float(np.median(times))*1000
+      res['speedup'] = res['legacy_ms']/res['fused_ms']
+      res['max_color_diff'] = float((outs['legacy'][0]-outs['fused'][0]).abs().max())
+      res['max_xyz_diff'] = float((outs['legacy'][1]-outs['fused'][1]).abs().max())
+      res['lod_speedup'] = res['legacy_ms']/res['fused_lod_ms']
+      res['lod_mean_color_diff'] = float((outs['legacy'][0]-outs['fused_lod'][0]).abs().mean())
+      results.append(res)
+      print(json.dumps(res))
+      del outs
+
+  if args.out_file is not None:
+    with open(args.out_file, 'w') as ff:
+      json.dump(results, ff, indent=2)
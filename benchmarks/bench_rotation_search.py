@@ -0,0 +1,91 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Hypotheses rendered vs ADD-S AUC of register with the flat rotation grid and with the coarse-to-fine search, on a BOP scene
+python benchmarks/bench_rotation_search.py --dataset lm --scene_dir /path/to/LINEMOD/lm_test_all/test/000001 --hier_topks 2 4 8 --max_frames 50
+'''
+
+import os,sys,json,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from estimater import *
+from benchmarks.bench_prescore import READERS, sync
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dataset', type=str, default='lm', choices=list(READERS.keys()))
+  parser.add_argument('--scene_dir', type=str, required=True)
+  parser.add_argument('--hier_topks', type=int, nargs='+', default=[2,4,8])
+  parser.add_argument('--hier_radius', type=float, default=45, help='degree')
+  parser.add_argument('--coarse_views', type=int, default=10)
+  parser.add_argument('--coarse_inplane_step', type=int, default=90)
+  parser.add_argument('--max_frames', type=int, default=50)
+  parser.add_argument('--ob_ids', type=int, nargs='+', default=None, help='default all objects of the scene')
+  parser.add_argument('--iteration', type=int, default=5)
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--out_file', type=str, default=None)
+  args = parser.parse_args()
+
+  set_logging_format(logging.WARNING)
+  configs = {'flat': dict(search='flat')}
+  for topk in args.hier_topks:
+    configs[f'hierarchical_top{topk}'] = dict(search='hierarchical', search_cfg=dict(coarse_cfg=(args.coarse_views, args.coarse_inplane_step), topk=topk, radius=args.hier_radius))
+
+  reader = READERS[args.dataset](args.scene_dir)
+  i_frames = np.linspace(0, len(reader.color_files)-1, min(args.max_frames, len(reader.color_files))).round().astype(int).tolist()
+  ob_ids = args.ob_ids
+  if ob_ids is None:
+    ob_ids = sorted(set([int(ob_id) for i_frame in i_frames for ob_id in reader.get_instance_ids_in_image(i_frame)]))
+
+  est = None
+  results = {name:{'time_s':[], 'n_rendered':[], 'adds':[]} for name in configs}
+  for ob_id in ob_ids:
+    mesh = reader.get_gt_mesh(ob_id)
+    symmetry_tfs = reader.symmetry_tfs[ob_id] if hasattr(reader, 'symmetry_tfs') else None
+    if est is None:
+      est = FoundationPose(model_pts=mesh.vertices.copy(), model_normals=mesh.vertex_normals.copy(), symmetry_tfs=symmetry_tfs, mesh=mesh, debug=0, debug_dir='/tmp/bench_rotation_search', device=args.device)
+    else:
+      est.reset_object(model_pts=mesh.vertices.copy(), model_normals=mesh.vertex_normals.copy(), symmetry_tfs=symmetry_tfs, mesh=mesh)
+    model_pts = mesh.vertices.copy()
+
+    for i_frame in i_frames:
+      if ob_id not in reader.get_instance_ids_in_image(i_frame):
+        continue
+      ob_mask = reader.get_mask(i_frame, ob_id)
+      if ob_mask is None or ob_mask.sum()<16:
+        continue
+      color = reader.get_color(i_frame)
+      depth = reader.get_depth(i_frame)
+      K = reader.get_K(i_frame)
+      gt_pose = reader.get_gt_pose(i_frame, ob_id)
+      for name, config in configs.items():
+        sync(args.device)
+        begin = time.time()
+        pose = est.register(K=K, rgb=color, depth=depth, ob_mask=ob_mask, iteration=args.iteration, **config)
+        sync(args.device)
+        results[name]['time_s'].append(time.time()-begin)
+        results[name]['n_rendered'].append(est.n_rendered)
+        results[name]['adds'].append(adds_err(pose, gt_pose, model_pts))
+
+  summary = {}
+  for name in configs:
+    res = results[name]
+    if len(res['time_s'])==0:
+      continue
+    summary[name] = {
+      'n_samples': len(res['time_s']),
+      'hypotheses_rendered_mean': float(np.mean(res['n_rendered'])),
+      'register_mean_s': float(np.mean(res['time_s'])),
+      'adds_auc': float(compute_auc_sklearn(res['adds'])),
+    }
+  print(json.dumps(summary, indent=2))
+  if args.out_file is not None:
+    with open(args.out_file, 'w') as ff:
+      json.dump(summary, ff, indent=2)
@@ -0,0 +1,241 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Latency percentiles and throughput of the hot paths, from rotation grid building to end-to-end register/track_one, on a synthetic mesh and frame.
+Runs on cpu when no GPU is present. Results are json; pass a previous run as --baseline to flag regressions (exit code 1 if any)
+python benchmarks/bench_suite.py --out_file /tmp/bench.json --save_baseline benchmarks/baseline_cuda.json
+python benchmarks/bench_suite.py --baseline benchmarks/baseline_cuda.json --cases nvdiffrast_render refinenet_forward
+python benchmarks/bench_suite.py --cases register track_one --count_syncs     # also one untimed call per case under a SyncCounter
+Cases needing the networks (make_crop_data_batch, *_forward, register, track_one) use the predictors, i.e. the downloaded weights; a case that fails is reported with its error and the rest still run
+'''
+
+import os,sys,json,argparse
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from estimater import *
+from learning.training.predict_pose_refine import make_crop_data_batch as make_crop_data_batch_refine
+from benchmarks.synthetic import *
+from benchmarks.harness import measure, env_info, compare_to_baseline, format_comparison
+from benchmarks.bench_cluster_poses import make_unclustered_grid
+
+
+class Context:
+  '''Inputs shared by the cases. The estimator, which loads the networks, is only built when a case needs it
+  '''
+  def __init__(self, args):
+    self.args = args
+    self.device = torch.device(args.device)
+    self.H = args.H
+    self.W = args.W
+    self.K = make_synthetic_K(H=args.H, W=args.W)
+    self.mesh = make_synthetic_mesh(subdivisions=args.subdivisions)
+    self.glctx = dr.RasterizeCudaContext(self.device) if self.device.type=='cuda' else None
+    self.mesh_tensors = make_mesh_tensors(self.mesh, device=self.device, lod_min_faces=args.lod_min_faces)
+    self.rgb, self.depth, self.mask, self.gt_pose = make_synthetic_frame(self.mesh, self.K, H=args.H, W=args.W, device=self.device, glctx=self.glctx)
+    self.diameter = compute_mesh_diameter(model_pts=self.mesh.vertices, n_sample=None)
+    rot_grid = make_rotation_grid_poses(min_n_views=40, inplane_step=60)
+    ids = np.arange(args.batch_size)%len(rot_grid)
+    poses = torch.as_tensor(rot_grid[ids], dtype=torch.float, device=self.device)
+    poses[:,:3,3] = torch.as_tensor(self.gt_pose[:3,3], dtype=torch.float, device=self.device)
+    self.poses = poses
+    self._est = None
+
+
+  @property
+  def est(self):
+    if self._est is None:
+      self._est = FoundationPose(model_pts=self.mesh.vertices, model_normals=self.mesh.vertex_normals, mesh=self.mesh, glctx=self.glctx, debug=0, debug_dir='/tmp/bench_suite', device=self.device, lod_min_faces=self.args.lod_min_faces)
+    return self._est
+
+
+
+########## Each case takes the Context and returns (fn, n_items, params)
+
+def case_sample_views_icosphere(ctx):
+  return lambda: sample_views_icosphere(n_views=40), 1, {'n_views': 40}
+
+
+def case_cluster_poses(ctx):
+  rot_grid = make_unclustered_grid(40, 60)
+  symmetry_tfs = np.eye(4, dtype=np.float32)[None]
+  return lambda: cluster_poses(30, 99999, rot_grid, symmetry_tfs), len(rot_grid), {'n_in': len(rot_grid)}
+
+
+def case_compute_crop_window_tf_batch(ctx):
+  fn = lambda: compute_crop_window_tf_batch(H=ctx.H, W=ctx.W, poses=ctx.poses, K=ctx.K, crop_ratio=1.2, out_size=(160,160), method='box_3d', mesh_diameter=ctx.diameter)
+  return fn, len(ctx.poses), {'batch_size': len(ctx.poses)}
+
+
+def case_nvdiffrast_render(ctx):
+  tf_to_crops = compute_crop_window_tf_batch(H=ctx.H, W=ctx.W, poses=ctx.poses, K=ctx.K, crop_ratio=1.2, out_size=(160,160), method='box_3d', mesh_diameter=ctx.diameter)
+  fn = lambda: render_crop_batch(K=ctx.K, H=ctx.H, W=ctx.W, poses=ctx.poses, tf_to_crops=tf_to_crops, output_size=(160,160), mesh_tensors=ctx.mesh_tensors, glctx=ctx.glctx, device=ctx.device)
+  return fn, len(ctx.poses), {'batch_size': len(ctx.poses), 'n_faces': len(ctx.mesh.faces), 'output_size': 160}
+
+
+def case_render_cache(ctx):
+  '''The pattern of register with get_vis: the first refine iteration stores its renders, the visualization asks for the same poses again.
+  params['render_cache'] holds the stats of the last call, hit_rate 0.5 when every second request is served from the cache
+  '''
+  tf_to_crops = compute_crop_window_tf_batch(H=ctx.H, W=ctx.W, poses=ctx.poses, K=ctx.K, crop_ratio=1.2, out_size=(160,160), method='box_3d', mesh_diameter=ctx.diameter)
+  render_cache = RenderCache()
+  params = {'batch_size': len(ctx.poses), 'output_size': 160}
+  def fn():
+    render_cache.new_frame()
+    for store in [True, False]:
+      render_crop_batch(K=ctx.K, H=ctx.H, W=ctx.W, poses=ctx.poses, tf_to_crops=tf_to_crops, output_size=(160,160), mesh_tensors=ctx.mesh_tensors, glctx=ctx.glctx, render_cache=render_cache, store=store, device=ctx.device)
+    params['render_cache'] = render_cache.stats()
+    render_cache.clear()
+  return fn, 2*len(ctx.poses), params
+
+
+def case_make_crop_data_batch(ctx):
+  refiner = ctx.est.refiner
+  rgb = torch.as_tensor(ctx.rgb, dtype=torch.float, device=ctx.device)
+  depth = torch.as_tensor(ctx.depth, dtype=torch.float, device=ctx.device)
+  xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(ctx.K, dtype=torch.float, device=ctx.device)[None], zfar=np.inf)[0]
+  fn = lambda: make_crop_data_batch_refine(refiner.cfg.input_resize, ctx.poses, ctx.mesh, rgb, depth, ctx.K, crop_ratio=refiner.cfg['crop_ratio'], xyz_map=xyz_map, cfg=refiner.cfg, glctx=ctx.glctx, mesh_tensors=ctx.mesh_tensors, dataset=refiner.dataset, mesh_diameter=ctx.diameter, device=ctx.device)
+  return fn, len(ctx.poses), {'batch_size': len(ctx.poses)}
+
+
+def case_depth2xyzmap(ctx):
+  return lambda: depth2xyzmap(ctx.depth, ctx.K), ctx.H*ctx.W, {'H': ctx.H, 'W': ctx.W}
+
+
+def case_depth2xyzmap_batch(ctx):
+  depth = torch.as_tensor(ctx.depth, dtype=torch.float, device=ctx.device)[None]
+  K = torch.as_tensor(ctx.K, dtype=torch.float, device=ctx.device)[None]
+  return lambda: depth2xyzmap_batch(depth, K, zfar=np.inf), ctx.H*ctx.W, {'H': ctx.H, 'W': ctx.W}
+
+
+def case_erode_depth(ctx):
+  depth = torch.as_tensor(ctx.depth, dtype=torch.float, device=ctx.device)
+  return lambda: erode_depth(depth, radius=2, device=str(ctx.device)), ctx.H*ctx.W, {'H': ctx.H, 'W': ctx.W, 'warp': wp is not None}
+
+
+def case_bilateral_filter_depth(ctx):
+  depth = torch.as_tensor(ctx.depth, dtype=torch.float, device=ctx.device)
+  return lambda: bilateral_filter_depth(depth, radius=2, device=str(ctx.device)), ctx.H*ctx.W, {'H': ctx.H, 'W': ctx.W, 'warp': wp is not None}
+
+
+def make_forward_case(predictor_name):
+  def case(ctx):
+    predictor = getattr(ctx.est, predictor_name)
+    h,w = predictor.cfg['input_resize']
+    c_in = predictor.cfg['c_in']
+    A = torch.rand((len(ctx.poses),c_in,h,w), dtype=torch.float, device=ctx.device)
+    B = torch.rand((len(ctx.poses),c_in,h,w), dtype=torch.float, device=ctx.device)
+    @torch.inference_mode()
+    def fn():
+      with torch.autocast(device_type=ctx.device.type, enabled=predictor.amp):
+        if predictor_name=='scorer':
+          return predictor.model(A, B, L=len(A))
+        return predictor.model(A, B)
+    return fn, len(ctx.poses), {'batch_size': len(ctx.poses), 'input_resize': [h,w], 'amp': predictor.amp}
+  return case
+
+
+def case_register(ctx):
+  params = {'iteration': ctx.args.est_refine_iter, 'n_hypotheses': len(ctx.est.rot_grid)}
+  def fn():
+    ctx.est.register(K=ctx.K, rgb=ctx.rgb, depth=ctx.depth, ob_mask=ctx.mask, iteration=ctx.args.est_refine_iter)
+    params['render_cache'] = ctx.est.render_cache.stats()
+  return fn, 1, params
+
+
+def case_register_hierarchical(ctx):
+  '''The coarse level is only looked up, not stored: its poses are refined before being rendered again
+  '''
+  params = {'iteration': ctx.args.est_refine_iter}
+  def fn():
+    ctx.est.register(K=ctx.K, rgb=ctx.rgb, depth=ctx.depth, ob_mask=ctx.mask, iteration=ctx.args.est_refine_iter, search='hierarchical')
+    params['render_cache'] = ctx.est.render_cache.stats()
+  return fn, 1, params
+
+
+def case_track_one(ctx):
+  if ctx.est.pose_last is None:
+    ctx.est.register(K=ctx.K, rgb=ctx.rgb, depth=ctx.depth, ob_mask=ctx.mask, iteration=ctx.args.est_refine_iter)
+  fn = lambda: ctx.est.track_one(rgb=ctx.rgb, depth=ctx.depth, K=ctx.K, iteration=ctx.args.track_refine_iter)
+  return fn, 1, {'iteration': ctx.args.track_refine_iter}
+
+
+CASES = OrderedDict([
+  ('sample_views_icosphere', case_sample_views_icosphere),
+  ('cluster_poses', case_cluster_poses),
+  ('compute_crop_window_tf_batch', case_compute_crop_window_tf_batch),
+  ('nvdiffrast_render', case_nvdiffrast_render),
+  ('render_cache', case_render_cache),
+  ('make_crop_data_batch', case_make_crop_data_batch),
+  ('depth2xyzmap', case_depth2xyzmap),
+  ('depth2xyzmap_batch', case_depth2xyzmap_batch),
+  ('erode_depth', case_erode_depth),
+  ('bilateral_filter_depth', case_bilateral_filter_depth),
+  ('refinenet_forward', make_forward_case('refiner')),
+  ('scorenet_forward', make_forward_case('scorer')),
+  ('register', case_register),
+  ('register_hierarchical', case_register_hierarchical),
+  ('track_one', case_track_one),
+])
+
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--cases', type=str, nargs='+', default=list(CASES.keys()), choices=list(CASES.keys()))
+  parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+  parser.add_argument('--n_repeat', type=int, default=20)
+  parser.add_argument('--n_warmup', type=int, default=2)
+  parser.add_argument('--batch_size', type=int, default=252, help='poses per batch, the size of the default rotation grid')
+  parser.add_argument('--subdivisions', type=int, default=4)
+  parser.add_argument('--lod_min_faces', type=int, default=None, help='give meshes above this many faces levels of detail, off by default as in FoundationPose')
+  parser.add_argument('--H', type=int, default=480)
+  parser.add_argument('--W', type=int, default=640)
+  parser.add_argument('--est_refine_iter', type=int, default=5)
+  parser.add_argument('--track_refine_iter', type=int, default=2)
+  parser.add_argument('--out_file', type=str, default=None)
+  parser.add_argument('--baseline', type=str, default=None, help='json of a previous run to compare against')
+  parser.add_argument('--save_baseline', type=str, default=None, help='also write the results there, to be used as --baseline later')
+  parser.add_argument('--count_syncs', action='store_true', help='after timing, run each case once more under a SyncCounter and report its host-device synchronizations and copies')
+  parser.add_argument('--tolerance', type=float, default=0.1, help='relative p50 change counted as regression/improvement')
+  args = parser.parse_args()
+
+  set_logging_format(logging.WARNING)
+  set_seed(0)
+  ctx = Context(args)
+  results = {'meta': env_info(args.device), 'config': vars(args), 'cases': OrderedDict()}
+  for name in args.cases:
+    try:
+      fn, n_items, params = CASES[name](ctx)
+      n_repeat = args.n_repeat if name not in ['register','register_hierarchical','track_one'] else max(1, args.n_repeat//4)
+      res = measure(fn, device=args.device, n_repeat=n_repeat, n_warmup=args.n_warmup, n_items=n_items)
+      res['params'] = params
+      if args.count_syncs:
+        with SyncCounter() as counter:
+          fn()
+        res['syncs'] = counter.stats()
+    except Exception as e:
+      logging.warning(f'{name} failed: {e}')
+      res = {'error': str(e)}
+    results['cases'][name] = res
+    print(json.dumps({name: res}))
+
+  for out_file in [args.out_file, args.save_baseline]:
+    if out_file is not None:
+      with open(out_file, 'w') as ff:
+        json.dump(results, ff, indent=2)
+
+  if args.baseline is not None:
+    with open(args.baseline, 'r') as ff:
+      baseline = json.load(ff)
+    if baseline['meta']['device']!=results['meta']['device'] or baseline['meta'].get('gpu')!=results['meta'].get('gpu'):
+      logging.warning(f"baseline was taken on {baseline['meta']['device']} {baseline['meta'].get('gpu')}, comparison is not apples to apples")
+    rows = compare_to_baseline(results, baseline, tolerance=args.tolerance)
+    print(format_comparison(rows))
+    if any(row['status']=='regression' for row in rows):
+      sys.exit(1)
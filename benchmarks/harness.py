@@ -0,0 +1,108 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Timing and baseline comparison shared by the benchmarks, see bench_suite.py
+'''
+
+import os,sys,time,json,platform,subprocess
+import numpy as np
+import torch
+
+
+def sync(device):
+  if torch.device(device).type=='cuda':
+    torch.cuda.synchronize()
+
+
+def measure(fn, device, n_repeat=20, n_warmup=2, n_items=1):
+  '''Call fn n_warmup times untimed, then n_repeat times with the device synchronized around each call
+  @n_items: what one call processes (poses, pixels, ...), for the throughput
+  Return: dict of latency stats in ms and throughput in items/s
+  '''
+  for _ in range(n_warmup):
+    fn()
+  times = []
+  for _ in range(n_repeat):
+    sync(device)
+    begin = time.perf_counter()
+    fn()
+    sync(device)
+    times.append(time.perf_counter()-begin)
+  times = np.asarray(times)*1000
+  return {
+    'n_repeat': n_repeat,
+    'n_items': n_items,
+    'mean_ms': float(times.mean()),
+    'std_ms': float(times.std()),
+    'min_ms': float(times.min()),
+    'p50_ms': float(np.percentile(times, 50)),
+    'p90_ms': float(np.percentile(times, 90)),
+    'p99_ms': float(np.percentile(times, 99)),
+    'throughput': float(n_items/(times.mean()/1000)),
+  }
+
+
+def env_info(device):
+  info = {
+    'device': str(device),
+    'torch': torch.__version__,
+    'python': platform.python_version(),
+    'host': platform.node(),
+    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+  }
+  if torch.device(device).type=='cuda':
+    info['gpu'] = torch.cuda.get_device_name(torch.device(device))
+  try:
+    code_dir = os.path.dirname(os.path.realpath(__file__))
+    info['commit'] = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=code_dir, stderr=subprocess.DEVNULL).decode().strip()
+  except Exception:
+    info['commit'] = None
+  return info
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1, metric='p50_ms'):
+  '''
+  @results, baseline: outputs of bench_suite.py
+  @tolerance: relative change of the metric above which a case counts as regression (slower) or improvement (faster)
+  Return: list of per case dicts, status one of ok / regression / improvement / new / missing / error
+  '''
+  rows = []
+  cur_cases = results['cases']
+  base_cases = baseline['cases']
+  for name in list(cur_cases.keys())+[name for name in base_cases if name not in cur_cases]:
+    cur = cur_cases.get(name)
+    base = base_cases.get(name)
+    row = {'case': name, 'baseline': None, 'current': None, 'ratio': None}
+    if cur is None:
+      row['status'] = 'missing'
+    elif 'error' in cur:
+      row['status'] = 'error'
+    elif base is None or 'error' in base:
+      row['status'] = 'new'
+      row['current'] = cur[metric]
+    else:
+      row['baseline'] = base[metric]
+      row['current'] = cur[metric]
+      row['ratio'] = cur[metric]/max(base[metric], 1e-9)
+      if row['ratio']>1+tolerance:
+        row['status'] = 'regression'
+      elif row['ratio']<1-tolerance:
+        row['status'] = 'improvement'
+      else:
+        row['status'] = 'ok'
+    rows.append(row)
+  return rows
+
+
+def format_comparison(rows, metric='p50_ms'):
+  fmt = lambda x: '-' if x is None else f'{x:.3f}'
+  lines = [f"{'case':<32} {'baseline '+metric:>18} {'current '+metric:>18} {'ratio':>8}  status"]
+  for row in rows:
+    lines.append(f"{row['case']:<32} {fmt(row['baseline']):>18} {fmt(row['current']):>18} {fmt(row['ratio']):>8}  {row['status']}")
+  return '\n'.join(lines)
@@ -0,0 +1,47 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+import os,sys
+code_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{code_dir}/../')
+from Utils import *
+
+
+def make_synthetic_mesh(subdivisions=3, extents=np.array([0.1,0.06,0.04])):
+  '''Vertex colored ellipsoid, no texture. Face count grows as 20*4^subdivisions
+  '''
+  mesh = trimesh.creation.icosphere(subdivisions=subdivisions, radius=1)
+  mesh.vertices = mesh.vertices*extents.reshape(1,3)/2
+  colors = ((mesh.vertices-mesh.vertices.min(axis=0))/(mesh.vertices.max(axis=0)-mesh.vertices.min(axis=0))*255).astype(np.uint8)
+  mesh.visual.vertex_colors = np.concatenate([colors, np.full((len(colors),1), 255, dtype=np.uint8)], axis=-1)
+  return mesh
+
+
+def make_synthetic_K(H=480, W=640):
+  return np.array([[600,0,W/2],
+                   [0,600,H/2],
+                   [0,0,1]], dtype=np.float64)
+
+
+def make_synthetic_frame(mesh, K, H=480, W=640, ob_in_cam=None, device='cuda', glctx=None):
+  '''Render the mesh at ob_in_cam on a flat background plane
+  Return: rgb (H,W,3) uint8, depth (H,W) float meters, mask (H,W) bool, ob_in_cam (4,4)
+  '''
+  if ob_in_cam is None:
+    ob_in_cam = euler_matrix(0.3, -0.5, 0.8)
+    ob_in_cam[:3,3] = [0.02, -0.01, 0.6]
+  mesh_tensors = make_mesh_tensors(mesh, device=device)
+  color, depth, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=torch.as_tensor(ob_in_cam[None], dtype=torch.float, device=device), glctx=glctx, mesh_tensors=mesh_tensors, device=device)
+  color = (color[0].data.cpu().numpy()*255).astype(np.uint8)
+  depth = depth[0].data.cpu().numpy()
+  mask = depth>=0.001
+  background_z = ob_in_cam[2,3]+0.2
+  depth[~mask] = background_z
+  color[~mask] = 90
+  return color, depth, mask, ob_in_cam
@@ -1,7 +1,6 @@
 import os
-import shutil
-import subprocess
-import time
+
+from pipeline import ensure_worker, submit_job, stop_worker, read_run_settings
 
 # 源文件目录
 BASE_DIR = "/home/wyf/Projects/FoundationPose/newdata"
@@ -10,16 +9,10 @@ DEPTH_DIR = os.path.join(BASE_DIR, "depth")
 MASK_DIR = os.path.join(BASE_DIR, "masks")
 OUTPUT_DIR = os.path.join(BASE_DIR, "outputs")
 
-# demodebug.py 读取的固定路径（目标目录）
+# 物体的 mesh 和相机参数（图像直接随任务发给常驻进程，不再复制到 demo_data）
 DEMO_DATA_DIR = "/home/wyf/Projects/FoundationPose/demo_data/module_needle_box_base"
-FIXED_RGB = os.path.join(DEMO_DATA_DIR, "rgb", "new.png")
-FIXED_MASK = os.path.join(DEMO_DATA_DIR, "masks", "new.png")
-FIXED_DEPTH = os.path.join(DEMO_DATA_DIR, "depth", "new.png")
-
-# 确保目标目录存在
-os.makedirs(os.path.join(DEMO_DATA_DIR, "rgb"), exist_ok=True)
-os.makedirs(os.path.join(DEMO_DATA_DIR, "mask"), exist_ok=True)
-os.makedirs(os.path.join(DEMO_DATA_DIR, "depth"), exist_ok=True)
+MESH_FILE = os.path.join(DEMO_DATA_DIR, "mesh", "needle_box_base.obj")
+CAM_K_FILE = os.path.join(DEMO_DATA_DIR, "cam_K.txt")
 
 # 固定 RGB 顺序
 RGB_NAMES = ["c1", "c2", "c3", "c4", "c5"]
@@ -27,9 +20,12 @@ RGB_NAMES = ["c1", "c2", "c3", "c4", "c5"]
 print("="*70)
 print("开始批处理图像...")
 print(f"源目录: {BASE_DIR}")
-print(f"目标目录: {DEMO_DATA_DIR}")
+print(f"Mesh: {MESH_FILE}")
 print("="*70)
 
+if not ensure_worker():
+    raise SystemExit("[ERROR] 常驻位姿估计进程不可用")
+
 for idx, rgb_name in enumerate(RGB_NAMES, 1):
     print(f"\n{'='*70}")
     print(f"处理进度: [{idx}/{len(RGB_NAMES)}] RGB组: {rgb_name}")
@@ -66,72 +62,33 @@ for idx, rgb_name in enumerate(RGB_NAMES, 1):
         print(f"  Mask:  {mask_file}")
         print(f"  Depth: {depth_path}")
 
-        # 复制文件到固定路径
-        print(f"\n复制文件到目标路径...")
-        try:
-            # 先删除旧文件（确保没有残留）
-            for fixed_file in [FIXED_RGB, FIXED_MASK, FIXED_DEPTH]:
-                if os.path.exists(fixed_file):
-                    os.remove(fixed_file)
-                    print(f"  删除旧文件: {fixed_file}")
-            
-            # 复制新文件
-            shutil.copy2(rgb_file, FIXED_RGB)
-            shutil.copy2(mask_file, FIXED_MASK)
-            shutil.copy2(depth_path, FIXED_DEPTH)
-            
-            # 验证文件已复制
-            assert os.path.exists(FIXED_RGB), f"RGB 复制失败: {FIXED_RGB}"
-            assert os.path.exists(FIXED_MASK), f"Mask 复制失败: {FIXED_MASK}"
-            assert os.path.exists(FIXED_DEPTH), f"Depth 复制失败: {FIXED_DEPTH}"
-            
-            print(f"  ✓ RGB  -> {FIXED_RGB}")
-            print(f"  ✓ Mask -> {FIXED_MASK}")
-            print(f"  ✓ Depth-> {FIXED_DEPTH}")
-            
-            # 给文件系统一点时间同步
-            time.sleep(0.2)
-            
-        except Exception as e:
-            print(f"[ERROR] 文件复制失败: {e}")
-            continue
-
         # 准备输出目录
         depth_label = os.path.splitext(os.path.basename(depth_path))[0]
         out_dir = os.path.join(OUTPUT_DIR, rgb_name, depth_label)
         os.makedirs(out_dir, exist_ok=True)
 
-        # 设置环境变量
-        env = {**os.environ, "DEBUG_DIR_OVERRIDE": out_dir}
-
-        print(f"\n运行 demodebug.py...")
+        print(f"\n提交给常驻位姿估计进程...")
         print(f"  输出目录: {out_dir}")
         
-        # 调用 demodebug.py
         try:
-            result = subprocess.run([
-                "python3", 
-                "/home/wyf/Projects/FoundationPose/demodebug.py",
-                "--config", 
-                "/home/wyf/Projects/FoundationPose/configs/mydemo.json"
-            ], 
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=300  # 5分钟超时
-            )
+            result = submit_job({
+                'cmd': 'run',
+                'mesh_file': MESH_FILE,
+                'cam_K_file': CAM_K_FILE,
+                'rgb_file': rgb_file,
+                'mask_file': mask_file,
+                'depth_file': depth_path,
+                'debug_dir': out_dir,
+                **read_run_settings(),
+            })
             
-            if result.returncode == 0:
-                print(f"  ✓ 处理成功")
+            if result['ok']:
+                timings = ', '.join([f"{k}={v:.2f}s" for k, v in result['timings'].items()])
+                print(f"  ✓ 处理成功 ({timings})")
             else:
-                print(f"  ✗ 处理失败 (返回码: {result.returncode})")
-                if result.stderr:
-                    print(f"  错误信息: {result.stderr[:500]}")
-                if result.stdout:
-                    print(f"  标准输出: {result.stdout[:500]}")
+                print(f"  ✗ 处理失败")
+                print(f"  错误信息: {result['error'][:500]}")
                     
-        except subprocess.TimeoutExpired:
-            print(f"  ✗ 处理超时（超过5分钟）")
         except Exception as e:
             print(f"  ✗ 运行出错: {e}")
 
@@ -140,4 +97,6 @@ for idx, rgb_name in enumerate(RGB_NAMES, 1):
 print("\n" + "="*70)
 print("所有处理完成！")
 print(f"结果保存在: {OUTPUT_DIR}")
-print("="*70)
\ No newline at end of file
+print("="*70)
+
+stop_worker()
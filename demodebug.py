@@ -12,100 +12,198 @@ import open3d as o3d
 
 from estimater import *
 from datareader import *
-import paramiko
-from scp import SCPClient
+import time
 from datetime import datetime
+from result_publisher import ResultPublisher, ROBOT_POSE_PATH, ROBOT_VIS_PATH
 
 
-def send_txt_scp(local_dir, remote_path):
+def load_mesh(mesh_file):
+    """读取 mesh，并计算可视化用的包围盒
+
+    Returns:
+        (mesh, to_origin, bbox)
+    """
+    mesh = trimesh.load(mesh_file)
+    if isinstance(mesh, trimesh.Scene):
+        mesh = list(mesh.geometry.values())[0]  # 假设场景中只有一个 mesh
+
+    # 计算 bounding box
+    to_origin, extents = trimesh.bounds.oriented_bounds(mesh)
+    bbox = np.stack([-extents / 2, extents / 2], axis=0).reshape(2, 3)
+    return mesh, to_origin, bbox
+
+
+def load_frame(rgb_file, depth_file, mask_file, zfar=np.inf):
+    """按 YcbineoatReader 的方式解码一组 RGB/depth/mask，不需要先复制成 rgb/new.png 这样的目录结构
+
+    Returns:
+        (color (H,W,3) uint8, depth (H,W) 米, mask (H,W) bool)
     """
-    将指定目录下的 .txt 文件传输到远程服务器。
-    
+    color = imageio.imread(rgb_file)[..., :3]
+    depth = cv2.imread(depth_file, -1) / 1e3
+    depth[(depth < 0.001) | (depth >= zfar)] = 0
+    return color, depth, load_mask(mask_file)
+
+
+def load_mask(mask_file):
+    """多通道的 mask 取第一个非空通道
+
+    Returns:
+        (H,W) bool
+    """
+    mask = cv2.imread(mask_file, -1)
+    if len(mask.shape) == 3:
+        for c in range(3):
+            if mask[..., c].sum() > 0:
+                mask = mask[..., c]
+                break
+    return mask.astype(bool)
+
+
+def save_frame_result(pose, color, K, to_origin, bbox, debug, debug_dir, id_str):
+    """位姿写到 debug_dir/ob_in_cam/object_in_camera.txt，debug>=2 时可视化写到 track_vis/<id_str>.png
+
+    Returns:
+        本帧写出的文件列表，交给 send_results
+    """
+    os.makedirs(f'{debug_dir}/ob_in_cam', exist_ok=True)
+    files = [f'{debug_dir}/ob_in_cam/object_in_camera.txt']
+    np.savetxt(files[0], pose.reshape(4, 4))
+
+    if debug >= 1:
+        center_pose = pose @ np.linalg.inv(to_origin)
+        vis = draw_posed_3d_box(K, img=color, ob_in_cam=center_pose, bbox=bbox)
+        vis = draw_xyz_axis(color, ob_in_cam=center_pose, scale=0.1, K=K,
+                            thickness=3, transparency=0, is_input_rgb=True)
+
+    if debug >= 2:
+        os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
+        files.append(f'{debug_dir}/track_vis/{id_str}.png')
+        imageio.imwrite(files[-1], vis)
+    return files
+
+
+def run_frame(est, mesh, to_origin, bbox, K, color, depth, mask, cfg, debug_dir, id_str='new', ob_id=None, frame_time=None, frame_id=None):
+    """对单帧直接 register，输入是已经解码好的数组
+
     Args:
-        local_dir (str): 本地目录，包含要传输的 .txt 文件
-        remote_path (str): 远程服务器上的目标路径
+        K: (3,3) 相机内参
+        cfg: 至少包含 est_refine_iter 和 debug
+        ob_id, frame_time, frame_id: 设置了 est.pose_stream 时随位姿推送的物体编号、图像到达时间和帧号
+    Returns:
+        (位姿 (4,4), 本次写出的文件列表)
     """
-    hostname = '10.12.58.80'
-    port = 22
-    username = 'elwg'
-    password = 'elwg224'
-
-    txt_ext = ('.txt',)
-
-    print("准备传输目录:", local_dir)
-
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, port, username, password)
-        print(f"已连接到远程主机: {hostname}")
-
-        txt_files = [f for f in os.listdir(local_dir)
-                     if f.lower().endswith(txt_ext) and os.path.isfile(os.path.join(local_dir, f))]
-        
-        if not txt_files:
-            print(f"  (在 {local_dir} 中未找到 .txt 文件)")
-            return
-
-        print(f"  找到 {len(txt_files)} 个 .txt 文件，开始传输...")
-
-        with SCPClient(ssh.get_transport()) as scp:
-            success_count = 0
-            for file in txt_files:
-                try:
-                    local_file_path = os.path.join(local_dir, file)
-                    scp.put(local_file_path, remote_path)
-                    print(f"  ✓ {file} 传输成功")
-                    success_count += 1
-                except Exception as e:
-                    print(f"  ✗ {file} 传输失败: {e}")
-
-            print(f"\n  传输完成: {success_count}/{len(txt_files)} 个文件成功")
-
-    except Exception as e:
-        print(f"  ✗ 连接或传输失败: {e}")
-    finally:
-        ssh.close()
-        print("  SSH连接已关闭")
-
-def send_files_scp(local_path, remote_path):
+    pose = est.register(K=K, rgb=color, depth=depth, ob_mask=mask, ob_id=ob_id, iteration=cfg['est_refine_iter'], frame_time=frame_time, frame_id=frame_id)
+    files = save_frame_result(pose, color, K, to_origin, bbox, cfg['debug'], debug_dir, id_str)
+    return pose, files
+
+
+def run_frame_many(est, ob_data, to_origin, bbox, K, color, depth, masks, cfg, debug_dir, id_str='new', ob_id=None, frame_time=None, frame_id=None):
+    """同一物体的多个实例（每个 mask 一个）在一次 register_many 里批量估计
+
+    Args:
+        ob_data: est.make_object_data(mesh)，常驻进程里缓存
+        masks: list of (H,W) bool
+        ob_id, frame_time, frame_id: 同 run_frame，各实例的位姿都带这个物体编号，按 mask 的顺序推送
+    Returns:
+        (list of 位姿 (4,4)，mask 无效的实例只有平移；本次写出的文件列表)
     """
-    将指定文件或目录下的文件传输到远程服务器。
-    
+    poses = est.register_many(K=K, rgb=color, depth=depth, ob_masks=masks, objects=[ob_data]*len(masks), iteration=cfg['est_refine_iter'],
+                              ob_ids=None if ob_id is None else [ob_id]*len(masks), frame_time=frame_time, frame_id=frame_id)
+
+    pose_dir = f'{debug_dir}/ob_in_cam'
+    os.makedirs(pose_dir, exist_ok=True)
+    for f in os.listdir(pose_dir):   # 之前实例更多的任务留下的文件
+        i_inst = f[len('object_in_camera_'):-len('.txt')]
+        if f.startswith('object_in_camera_') and f.endswith('.txt') and i_inst.isdigit() and int(i_inst) >= len(poses):
+            os.remove(os.path.join(pose_dir, f))
+    files = []
+    vis = color
+    for i_inst, pose in enumerate(poses):
+        files.append(f'{pose_dir}/object_in_camera_{i_inst}.txt')
+        np.savetxt(files[-1], pose.reshape(4, 4))
+        if cfg['debug'] >= 1:
+            center_pose = pose @ np.linalg.inv(to_origin)
+            vis = draw_posed_3d_box(K, img=vis, ob_in_cam=center_pose, bbox=bbox)
+            vis = draw_xyz_axis(vis, ob_in_cam=center_pose, scale=0.1, K=K,
+                                thickness=3, transparency=0, is_input_rgb=True)
+
+    if cfg['debug'] >= 2:
+        os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
+        files.append(f'{debug_dir}/track_vis/{id_str}.png')
+        imageio.imwrite(files[-1], vis)
+    return poses, files
+
+
+def run_scene(est, mesh, to_origin, bbox, test_scene_dir, cfg, debug_dir):
+    """第一帧 register，之后 track_one，每帧的位姿写到 debug_dir/ob_in_cam/object_in_camera.txt
+
+    Args:
+        est: FoundationPose，可以是常驻进程里复用的
+        cfg: mydemo.json 的内容
+    Returns:
+        (最后一帧的位姿 (4,4), 最后一帧写出的文件列表)
+    """
+    est_refine_iter = cfg['est_refine_iter']
+    track_refine_iter = cfg['track_refine_iter']
+    track_converge_trans_thres = cfg.get('track_converge_trans_thres', None)   # meter, stop refining once updates are this small
+    track_converge_rot_thres = cfg.get('track_converge_rot_thres', None)   # degree
+    debug = cfg['debug']
+
+    # 数据读取
+    reader = YcbineoatReader(video_dir=test_scene_dir, shorter_side=None, zfar=np.inf)
+
+    pose = None
+    files = []
+    for i in range(len(reader.color_files)):
+        logging.info(f'i:{i}')
+        frame_time = time.time()
+        color = reader.get_color(i)
+        depth = reader.get_depth(i)
+
+        if i == 0:
+            mask = reader.get_mask(0).astype(bool)
+            pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=est_refine_iter, frame_time=frame_time, frame_id=i)
+
+            if debug >= 3:
+                m = mesh.copy()
+                m.apply_transform(pose)
+                m.export(f'{debug_dir}/model_tf.obj')
+
+                xyz_map = depth2xyzmap(depth, reader.K)
+                valid = depth >= 0.001
+                pcd = toOpen3dCloud(xyz_map[valid], color[valid])
+                o3d.io.write_point_cloud(f'{debug_dir}/scene_complete.ply', pcd)
+        else:
+            pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=track_refine_iter, converge_trans_thres=track_converge_trans_thres, converge_rot_thres=track_converge_rot_thres, frame_time=frame_time, frame_id=i)
+
+        files = save_frame_result(pose, color, reader.K, to_origin, bbox, debug, debug_dir, reader.id_strs[i])
+
+    return pose, files
+
+
+def send_results(result_files, publisher=None, pose=None, object_name=None):
+    """把本次任务写出的位姿 txt 和可视化图片作为一批交给 publisher 上传给机器人端
+
     Args:
-        local_path (str): 本地目录或文件
-        remote_path (str): 远程服务器路径（包括文件名或目录）
+        result_files: run_frame / run_frame_many / run_scene 返回的文件列表，目录里以前任务留下的文件不会上传
+        publisher: ResultPublisher，常驻进程里一直复用；None 时临时建一个，并等上传完成
+        pose: (4,4) 或其列表，publisher 设置了位姿 socket 时直接推送，不等图片
     """
-    hostname = '10.12.58.80'
-    port = 22
-    username = 'elwg'
-    password = 'elwg224'
-
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(hostname, port, username, password)
-        print(f"已连接到远程主机: {hostname}")
-
-        with SCPClient(ssh.get_transport()) as scp:
-            if os.path.isfile(local_path):
-                scp.put(local_path, remote_path)
-                print(f"✓ 文件 {local_path} 传输成功 -> {remote_path}")
-            elif os.path.isdir(local_path):
-                # 传输目录下所有文件
-                for f in os.listdir(local_path):
-                    full_path = os.path.join(local_path, f)
-                    if os.path.isfile(full_path):
-                        scp.put(full_path, remote_path)
-                        print(f"✓ 文件 {full_path} 传输成功 -> {remote_path}")
-            else:
-                print(f"✗ 本地路径不存在: {local_path}")
-
-    except Exception as e:
-        print(f"✗ 连接或传输失败: {e}")
-    finally:
-        ssh.close()
-        print("SSH连接已关闭")
+    own_publisher = publisher is None
+    if own_publisher:
+        publisher = ResultPublisher()
+
+    files = {}
+    for f in result_files:
+        if f.endswith('.png'):
+            files[ROBOT_VIS_PATH] = f   # 远程只有一个 vis_pem.png
+        else:
+            files[os.path.join(os.path.dirname(ROBOT_POSE_PATH), os.path.basename(f))] = f
+
+    publisher.publish(files, pose=pose, object_name=object_name)
+    if own_publisher:
+        publisher.close()
 
 
 
@@ -124,28 +222,20 @@ if __name__ == '__main__':
     # 使用配置里的路径
     mesh_file = cfg['mesh_file']
     test_scene_dir = cfg['test_scene_dir']
-    est_refine_iter = cfg['est_refine_iter']
-    track_refine_iter = cfg['track_refine_iter']
     debug = cfg['debug']
     debug_dir = cfg['debug_dir']
 
     # 加载 mesh
-    mesh = trimesh.load(mesh_file)
+    mesh, to_origin, bbox = load_mesh(mesh_file)
 
     # 清理 debug 文件夹
     #if debug_dir is not None:
     #    os.system(f'rm -rf {debug_dir}/* && mkdir -p {debug_dir}/track_vis {debug_dir}/ob_in_cam')
 
-    # 计算 bounding box
-    to_origin, extents = trimesh.bounds.oriented_bounds(mesh)
-    bbox = np.stack([-extents / 2, extents / 2], axis=0).reshape(2, 3)
-
     # 初始化 estimator
     scorer = ScorePredictor()
     refiner = PoseRefinePredictor()
     glctx = dr.RasterizeCudaContext()
-    if isinstance(mesh, trimesh.Scene):
-        mesh = list(mesh.geometry.values())[0]  # 假设场景中只有一个 mesh
 
     est = FoundationPose(
         model_pts=mesh.vertices,
@@ -159,47 +249,5 @@ if __name__ == '__main__':
     )
     logging.info("estimator initialization done")
 
-    # 数据读取
-    reader = YcbineoatReader(video_dir=test_scene_dir, shorter_side=None, zfar=np.inf)
-
-    for i in range(len(reader.color_files)):
-        logging.info(f'i:{i}')
-        color = reader.get_color(i)
-        depth = reader.get_depth(i)
-
-        if i == 0:
-            mask = reader.get_mask(0).astype(bool)
-            pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=est_refine_iter)
-
-            if debug >= 3:
-                m = mesh.copy()
-                m.apply_transform(pose)
-                m.export(f'{debug_dir}/model_tf.obj')
-
-                xyz_map = depth2xyzmap(depth, reader.K)
-                valid = depth >= 0.001
-                pcd = toOpen3dCloud(xyz_map[valid], color[valid])
-                o3d.io.write_point_cloud(f'{debug_dir}/scene_complete.ply', pcd)
-        else:
-            pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=track_refine_iter)
-
-        os.makedirs(f'{debug_dir}/ob_in_cam', exist_ok=True)
-        np.savetxt(f'{debug_dir}/ob_in_cam/object_in_camera.txt', pose.reshape(4, 4))
-
-        if debug >= 1:
-            center_pose = pose @ np.linalg.inv(to_origin)
-            vis = draw_posed_3d_box(reader.K, img=color, ob_in_cam=center_pose, bbox=bbox)
-            vis = draw_xyz_axis(color, ob_in_cam=center_pose, scale=0.1, K=reader.K,
-                                thickness=3, transparency=0, is_input_rgb=True)
-
-        if debug >= 2:
-            os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
-            imageio.imwrite(f'{debug_dir}/track_vis/{reader.id_strs[i]}.png', vis)
-
-    # 传输 txt 文件
-    llcal_path = os.path.join(debug_dir, 'ob_in_cam')
-    send_files_scp(llcal_path, '/home/elwg/dowload/ConnectionWithRobot (copy)/connectWithSever/received_files/object_in_camera.txt')
-
-    # 传输可视化图片（假设你最后的 vis 保存为 vis_pem.png）
-    vis_file = os.path.join(debug_dir, 'track_vis')
-    send_files_scp(vis_file, '/home/elwg/dowload/ConnectionWithRobot (copy)/connectWithSever/received_files/vis_pem.png')
+    pose, files = run_scene(est, mesh, to_origin, bbox, test_scene_dir, cfg, debug_dir)
+    send_results(files, pose=pose, object_name=os.path.splitext(os.path.basename(mesh_file))[0])
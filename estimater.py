@@ -12,164 +12,518 @@ from datareader import *
 import itertools
 from learning.training.predict_score import *
 from learning.training.predict_pose_refine import *
-import yaml
+import yaml,json,shutil
+
+
+def make_rotation_grid_poses(min_n_views=40, inplane_step=60, symmetry_tfs=np.eye(4)[None]):
+  '''Icosphere views x inplane rotations, clustered under the symmetries
+  @symmetry_tfs: (N,4,4) np array
+  Return: (M,4,4) np array of ob_in_cam
+  '''
+  cam_in_obs = sample_views_icosphere(n_views=min_n_views)
+  logging.info(f'cam_in_obs:{cam_in_obs.shape}')
+  rot_grid = []
+  for i in range(len(cam_in_obs)):
+    for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step)):
+      cam_in_ob = cam_in_obs[i]
+      R_inplane = euler_matrix(0,0,inplane_rot)
+      cam_in_ob = cam_in_ob@R_inplane
+      ob_in_cam = np.linalg.inv(cam_in_ob)
+      rot_grid.append(ob_in_cam)
+
+  rot_grid = np.asarray(rot_grid)
+  logging.info(f"rot_grid:{rot_grid.shape}")
+  if mycpp is not None:
+    rot_grid = mycpp.cluster_poses(30, 99999, rot_grid.astype(np.float32), np.asarray(symmetry_tfs, dtype=np.float32))
+  else:
+    rot_grid = cluster_poses(30, 99999, rot_grid, symmetry_tfs)
+  rot_grid = np.asarray(rot_grid)
+  logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
+  return rot_grid
+
+
+
+class RotationGridCache:
+  '''Clustered rotation grids keyed by (min_n_views, inplane_step, symmetry_tfs). Kept in an in-process LRU and persisted as .npy files, so reloading an object does not re-run the clustering
+  '''
+  version = 1
+
+  def __init__(self, cache_dir=None, max_size=32):
+    if cache_dir is None:
+      cache_dir = os.getenv('FOUNDATIONPOSE_CACHE_DIR', os.path.expanduser('~/.cache/foundationpose'))
+    self.cache_dir = f'{cache_dir}/rot_grid' if cache_dir else None
+    self.max_size = max_size
+    self.lru = OrderedDict()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+
+  @staticmethod
+  def make_key(min_n_views, inplane_step, symmetry_tfs):
+    import hashlib
+    tfs = np.round(np.asarray(symmetry_tfs, dtype=np.float64).reshape(-1,4,4), 6)+0.0  # +0.0 gets rid of -0.0
+    sym_hash = hashlib.sha1(tfs.tobytes()).hexdigest()
+    return f'v{RotationGridCache.version}_views{int(min_n_views)}_inplane{int(inplane_step)}_sym{sym_hash}'
+
+
+  def get(self, min_n_views, inplane_step, symmetry_tfs):
+    key = self.make_key(min_n_views, inplane_step, symmetry_tfs)
+    if key in self.lru:
+      self.lru.move_to_end(key)
+      self.hits += 1
+      return self.lru[key].copy()
+
+    rot_grid = None
+    cache_file = None
+    if self.cache_dir is not None:
+      cache_file = f'{self.cache_dir}/{key}.npy'
+      if os.path.exists(cache_file):
+        try:
+          rot_grid = np.load(cache_file)
+          self.disk_hits += 1
+          logging.info(f'rot_grid loaded from {cache_file}')
+        except Exception as e:
+          logging.info(f'WARN: failed to load {cache_file}, recomputing. {e}')
+          rot_grid = None
+
+    if rot_grid is None:
+      self.misses += 1
+      rot_grid = make_rotation_grid_poses(min_n_views=min_n_views, inplane_step=inplane_step, symmetry_tfs=symmetry_tfs)
+      if cache_file is not None:
+        try:
+          os.makedirs(self.cache_dir, exist_ok=True)
+          tmp_file = f'{cache_file}.{os.getpid()}.{uuid4().hex}.tmp.npy'
+          np.save(tmp_file, rot_grid)
+          os.replace(tmp_file, cache_file)
+        except Exception as e:
+          logging.info(f'WARN: failed to write {cache_file}. {e}')
+
+    self.lru[key] = rot_grid
+    while len(self.lru)>self.max_size:
+      self.lru.popitem(last=False)
+    return rot_grid.copy()
+
+
+rot_grid_cache = RotationGridCache()
+
+
+
+class MeshAssetCache:
+  '''Per-object preprocessing done in FoundationPose.reset_object (diameter, downsampled points/normals, model center, packed render arrays), keyed by a hash of the mesh content.
+  On disk each entry is a directory of .npy files plus meta.json, loaded with mmap so that switching between known objects does not recompute anything
+  '''
+  version = 4
+
+  def __init__(self, cache_dir=None, max_size=16):
+    if cache_dir is None:
+      cache_dir = os.getenv('FOUNDATIONPOSE_CACHE_DIR', os.path.expanduser('~/.cache/foundationpose'))
+    self.cache_dir = f'{cache_dir}/mesh_asset' if cache_dir else None
+    self.max_size = max_size
+    self.lru = OrderedDict()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+
+  @staticmethod
+  def make_key(mesh, model_normals, max_tex_size=None, lod_min_faces=None):
+    import hashlib
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(mesh.vertices, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(mesh.faces, dtype=np.int64).tobytes())
+    if model_normals is not None:
+      h.update(np.ascontiguousarray(model_normals, dtype=np.float64).tobytes())
+    if isinstance(mesh.visual, trimesh.visual.texture.TextureVisuals):
+      h.update(b'tex')
+      if mesh.visual.uv is not None:
+        h.update(np.ascontiguousarray(mesh.visual.uv, dtype=np.float64).tobytes())
+      if mesh.visual.material and mesh.visual.material.image:
+        h.update(np.ascontiguousarray(mesh.visual.material.image.convert('RGB')).tobytes())
+    elif mesh.visual.vertex_colors is not None:
+      h.update(np.ascontiguousarray(mesh.visual.vertex_colors, dtype=np.uint8).tobytes())
+    h.update(str(max_tex_size).encode())
+    h.update(str(lod_min_faces).encode())
+    return f'v{MeshAssetCache.version}_{h.hexdigest()}'
+
+
+  @staticmethod
+  def compute(mesh, model_normals, max_tex_size=None, lod_min_faces=None):
+    '''
+    @mesh: mesh in its original frame
+    Return: dict of meta (json-able) and arrays (np)
+    '''
+    max_xyz = mesh.vertices.max(axis=0)
+    min_xyz = mesh.vertices.min(axis=0)
+    model_center = (min_xyz+max_xyz)/2
+    mesh = mesh.copy()
+    mesh.vertices = mesh.vertices - model_center.reshape(1,3)
+
+    diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=None)
+    vox_size = max(diameter/20.0, 0.003)
+    pcd = toOpen3dCloud(mesh.vertices, normals=model_normals)
+    pcd = pcd.voxel_down_sample(vox_size)
+    arrays = {
+      'model_center': np.asarray(model_center, dtype=np.float64),
+      'pts': np.asarray(pcd.points, dtype=np.float32),
+      'normals': np.asarray(pcd.normals, dtype=np.float32),
+    }
+    for k,v in make_mesh_arrays(mesh, max_tex_size=max_tex_size, lod_min_faces=lod_min_faces).items():
+      arrays[f'mesh_{k}'] = v
+    return {'meta': {'diameter': float(diameter)}, 'arrays': arrays}
+
+
+  def load(self, cache_path):
+    with open(f'{cache_path}/meta.json','r') as ff:
+      meta = json.load(ff)
+    arrays = {}
+    for k in meta['array_names']:
+      arrays[k] = np.load(f'{cache_path}/{k}.npy', mmap_mode='r')
+    return {'meta': meta, 'arrays': arrays}
+
+
+  def save(self, cache_path, asset):
+    tmp_path = f'{cache_path}.{os.getpid()}.{uuid4().hex}.tmp'
+    os.makedirs(tmp_path)
+    try:
+      for k,v in asset['arrays'].items():
+        np.save(f'{tmp_path}/{k}.npy', v)
+      meta = dict(asset['meta'])
+      meta['array_names'] = list(asset['arrays'].keys())
+      with open(f'{tmp_path}/meta.json','w') as ff:
+        json.dump(meta, ff)
+      os.replace(tmp_path, cache_path)
+    finally:
+      if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path, ignore_errors=True)   # Another process got there first
+
+
+  def get(self, mesh, model_normals, max_tex_size=None, lod_min_faces=None):
+    key = self.make_key(mesh, model_normals, max_tex_size=max_tex_size, lod_min_faces=lod_min_faces)
+    if key in self.lru:
+      self.lru.move_to_end(key)
+      self.hits += 1
+      return self.lru[key]
+
+    asset = None
+    cache_path = None
+    if self.cache_dir is not None:
+      cache_path = f'{self.cache_dir}/{key}'
+      if os.path.exists(f'{cache_path}/meta.json'):
+        try:
+          asset = self.load(cache_path)
+          self.disk_hits += 1
+          logging.info(f'mesh asset loaded from {cache_path}')
+        except Exception as e:
+          logging.info(f'WARN: failed to load {cache_path}, recomputing. {e}')
+          asset = None
+
+    if asset is None:
+      self.misses += 1
+      asset = self.compute(mesh, model_normals, max_tex_size=max_tex_size, lod_min_faces=lod_min_faces)
+      if cache_path is not None:
+        try:
+          os.makedirs(self.cache_dir, exist_ok=True)
+          self.save(cache_path, asset)
+        except Exception as e:
+          logging.info(f'WARN: failed to write {cache_path}. {e}')
+
+    self.lru[key] = asset
+    while len(self.lru)>self.max_size:
+      self.lru.popitem(last=False)
+    return asset
+
+
+mesh_asset_cache = MeshAssetCache()
+
 
 
 class FoundationPose:
-  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/'):
+  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/', device='cuda', max_tex_size=None, lod_min_faces=None):
+    '''
+    @device: where tensors, networks and rendering live. On cpu the rasterization falls back to pytorch3d and no glctx is needed
+    @max_tex_size: textures are downsized to this. Default derived from the networks' input_resize, see default_max_tex_size
+    @lod_min_faces: meshes with more faces also get decimated levels of detail, rendered by the refiner and scorer where triangles are sub-pixel, see make_mesh_lods. None (default) always renders the full mesh
+    '''
     self.gt_pose = None
+    self.device = torch.device(device)
     self.ignore_normal_flip = True
     self.debug = debug
     self.debug_dir = debug_dir
     os.makedirs(debug_dir, exist_ok=True)
 
-    self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
-    self.make_rotation_grid(min_n_views=40, inplane_step=60)
-
     self.glctx = glctx
 
     if scorer is not None:
       self.scorer = scorer
     else:
-      self.scorer = ScorePredictor()
+      self.scorer = ScorePredictor(device=self.device)
 
     if refiner is not None:
       self.refiner = refiner
     else:
-      self.refiner = PoseRefinePredictor()
+      self.refiner = PoseRefinePredictor(device=self.device)
+
+    if max_tex_size is None:
+      max_tex_size = default_max_tex_size(list(self.scorer.cfg['input_resize'])+list(self.refiner.cfg['input_resize']))
+    self.max_tex_size = max_tex_size
+    self.lod_min_faces = lod_min_faces
+
+    self.render_cache = RenderCache()
+    if list(self.scorer.cfg['input_resize'])!=list(self.refiner.cfg['input_resize']) or self.scorer.cfg['crop_ratio']!=self.refiner.cfg['crop_ratio']:
+      logging.info(f"refiner and scorer crops differ, renders are not shared between them")
+
+    self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
+    self.make_rotation_grid(min_n_views=40, inplane_step=60)
 
     self.pose_last = None   # Used for tracking; per the centered mesh
+    self.ob_id = None
+    self.pose_stream = None   # If set, e.g. to a pose_stream.PoseStreamPublisher, register and track_one push every pose to it
+    self.frame_id = 0   # Counts register, register_many and track_one calls, stamped on the streamed poses when the caller gives no frame_id
 
 
   def reset_object(self, model_pts, model_normals, symmetry_tfs=None, mesh=None):
-    max_xyz = mesh.vertices.max(axis=0)
-    min_xyz = mesh.vertices.min(axis=0)
-    self.model_center = (min_xyz+max_xyz)/2
-    if mesh is not None:
-      self.mesh_ori = mesh.copy()
-      mesh = mesh.copy()
-      mesh.vertices = mesh.vertices - self.model_center.reshape(1,3)
-
-    model_pts = mesh.vertices
-    self.diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=10000)
+    asset = mesh_asset_cache.get(mesh, model_normals, max_tex_size=self.max_tex_size, lod_min_faces=self.lod_min_faces)
+    self.model_center = np.array(asset['arrays']['model_center'])
+    self.mesh_ori = mesh.copy()
+    mesh = mesh.copy()
+    mesh.vertices = mesh.vertices - self.model_center.reshape(1,3)
+
+    self.diameter = asset['meta']['diameter']
     self.vox_size = max(self.diameter/20.0, 0.003)
     logging.info(f'self.diameter:{self.diameter}, vox_size:{self.vox_size}')
     self.dist_bin = self.vox_size/2
     self.angle_bin = 20  # Deg
-    pcd = toOpen3dCloud(model_pts, normals=model_normals)
-    pcd = pcd.voxel_down_sample(self.vox_size)
-    self.max_xyz = np.asarray(pcd.points).max(axis=0)
-    self.min_xyz = np.asarray(pcd.points).min(axis=0)
-    self.pts = torch.tensor(np.asarray(pcd.points), dtype=torch.float32, device='cuda')
-    self.normals = F.normalize(torch.tensor(np.asarray(pcd.normals), dtype=torch.float32, device='cuda'), dim=-1)
+    pts = np.asarray(asset['arrays']['pts'])
+    self.max_xyz = pts.max(axis=0)
+    self.min_xyz = pts.min(axis=0)
+    self.pts = torch.tensor(pts, dtype=torch.float32, device=self.device)
+    self.normals = F.normalize(torch.tensor(np.asarray(asset['arrays']['normals']), dtype=torch.float32, device=self.device), dim=-1)
     logging.info(f'self.pts:{self.pts.shape}')
-    self.mesh_path = None
     self.mesh = mesh
-    if self.mesh is not None:
-      self.mesh_path = f'/tmp/{uuid.uuid4()}.obj'
-      self.mesh.export(self.mesh_path)
-    self.mesh_tensors = make_mesh_tensors(self.mesh)
+    mesh_arrays = {k[len('mesh_'):]: v for k,v in asset['arrays'].items() if k.startswith('mesh_')}
+    self.mesh_tensors = mesh_arrays_to_tensors(mesh_arrays, device=self.device)
 
     if symmetry_tfs is None:
-      self.symmetry_tfs = torch.eye(4).float().cuda()[None]
+      self.symmetry_tfs = torch.eye(4, device=self.device).float()[None]
     else:
-      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device='cuda', dtype=torch.float)
+      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device=self.device, dtype=torch.float)
+
+    if getattr(self, 'rot_grid_cfg', None) is not None:
+      self.make_rotation_grid(*self.rot_grid_cfg)
 
     logging.info("reset done")
 
 
 
+  def make_object_data(self, mesh, model_normals=None, symmetry_tfs=None):
+    '''Everything register_many needs about one object, without changing the object set by reset_object. Built from the mesh asset and rotation grid caches
+    @mesh: trimesh in the object frame
+    Return: dict
+    '''
+    if model_normals is None:
+      model_normals = mesh.vertex_normals
+    if symmetry_tfs is None:
+      symmetry_tfs = np.eye(4)[None]
+    asset = mesh_asset_cache.get(mesh, model_normals, max_tex_size=self.max_tex_size, lod_min_faces=self.lod_min_faces)
+    model_center = np.array(asset['arrays']['model_center'])
+    mesh_centered = mesh.copy()
+    mesh_centered.vertices = mesh_centered.vertices - model_center.reshape(1,3)
+    mesh_arrays = {k[len('mesh_'):]: v for k,v in asset['arrays'].items() if k.startswith('mesh_')}
+    min_n_views, inplane_step = getattr(self, 'rot_grid_cfg', (40,60))
+    rot_grid = rot_grid_cache.get(min_n_views, inplane_step, np.asarray(symmetry_tfs))
+    tf_to_center = torch.eye(4, dtype=torch.float, device=self.device)
+    tf_to_center[:3,3] = -torch.as_tensor(model_center, device=self.device, dtype=torch.float)
+    return {
+      'mesh': mesh_centered,
+      'mesh_tensors': mesh_arrays_to_tensors(mesh_arrays, device=self.device),
+      'diameter': asset['meta']['diameter'],
+      'model_center': model_center,
+      'rot_grid': torch.as_tensor(rot_grid, device=self.device, dtype=torch.float),
+      'tf_to_center': tf_to_center,
+    }
+
+
   def get_tf_to_centered_mesh(self):
-    tf_to_center = torch.eye(4, dtype=torch.float, device='cuda')
-    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device='cuda', dtype=torch.float)
+    tf_to_center = torch.eye(4, dtype=torch.float, device=self.device)
+    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device=self.device, dtype=torch.float)
     return tf_to_center
 
 
   def to_device(self, s='cuda:0'):
+    self.device = torch.device(s)
     for k in self.__dict__:
       self.__dict__[k] = self.__dict__[k]
       if torch.is_tensor(self.__dict__[k]) or isinstance(self.__dict__[k], nn.Module):
         logging.info(f"Moving {k} to device {s}")
         self.__dict__[k] = self.__dict__[k].to(s)
-    for k in self.mesh_tensors:
-      logging.info(f"Moving {k} to device {s}")
-      self.mesh_tensors[k] = self.mesh_tensors[k].to(s)
+    logging.info(f"Moving mesh_tensors to device {s}")
+    self.mesh_tensors = mesh_tensors_to(self.mesh_tensors, s)
+    self.render_cache.clear()   # Renders on the old device, keyed by the old mesh_tensors
     if self.refiner is not None:
       self.refiner.model.to(s)
+      self.refiner.device = self.device
     if self.scorer is not None:
       self.scorer.model.to(s)
-    if self.glctx is not None:
+      self.scorer.device = self.device
+    if self.device.type!='cuda':
+      self.glctx = None
+    elif self.glctx is not None:
       self.glctx = dr.RasterizeCudaContext(s)
 
 
 
   def make_rotation_grid(self, min_n_views=40, inplane_step=60):
-    cam_in_obs = sample_views_icosphere(n_views=min_n_views)
-    logging.info(f'cam_in_obs:{cam_in_obs.shape}')
-    rot_grid = []
-    for i in range(len(cam_in_obs)):
-      for inplane_rot in np.deg2rad(np.arange(0, 360, inplane_step)):
-        cam_in_ob = cam_in_obs[i]
-        R_inplane = euler_matrix(0,0,inplane_rot)
-        cam_in_ob = cam_in_ob@R_inplane
-        ob_in_cam = np.linalg.inv(cam_in_ob)
-        rot_grid.append(ob_in_cam)
-
-    rot_grid = np.asarray(rot_grid)
-    logging.info(f"rot_grid:{rot_grid.shape}")
-    rot_grid = mycpp.cluster_poses(30, 99999, rot_grid, self.symmetry_tfs.data.cpu().numpy())
-    rot_grid = np.asarray(rot_grid)
-    logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
-    self.rot_grid = torch.as_tensor(rot_grid, device='cuda', dtype=torch.float)
+    self.rot_grid_cfg = (min_n_views, inplane_step)
+    symmetry_tfs = self.symmetry_tfs.data.cpu().numpy()
+    key = RotationGridCache.make_key(min_n_views, inplane_step, symmetry_tfs)
+    if getattr(self, 'rot_grid_key', None)==key:
+      return
+    rot_grid = rot_grid_cache.get(min_n_views, inplane_step, symmetry_tfs)
+    self.rot_grid = torch.as_tensor(rot_grid, device=self.device, dtype=torch.float)
+    self.rot_grid_key = key
     logging.info(f"self.rot_grid: {self.rot_grid.shape}")
 
 
-  def generate_random_pose_hypo(self, K, rgb, depth, mask, scene_pts=None):
+  def generate_random_pose_hypo(self, K, rgb, depth, mask, scene_pts=None, center=None):
     '''
     @scene_pts: torch tensor (N,3)
+    @center: (3,) translation of the hypotheses, default guess_translation
     '''
     ob_in_cams = self.rot_grid.clone()
-    center = self.guess_translation(depth=depth, mask=mask, K=K)
-    ob_in_cams[:,:3,3] = torch.tensor(center, device='cuda', dtype=torch.float).reshape(1,3)
+    if center is None:
+      center = self.guess_translation(depth=depth, mask=mask, K=K)
+    ob_in_cams[:,:3,3] = torch.as_tensor(center, device=self.device, dtype=torch.float).reshape(1,3)
     return ob_in_cams
 
 
+  def generate_hierarchical_pose_hypo(self, K, rgb, depth, mask, center, coarse_cfg=(10,90), fine_cfg=None, topk=4, radius=45):
+    '''Coarse-to-fine hypotheses. A sparse rotation grid is scored as is with the ScorePredictor, then only the rotations of the fine grid that are
+    within radius (degree, up to symmetry) of the topk coarse rotations are kept
+    @coarse_cfg, fine_cfg: (min_n_views, inplane_step). fine_cfg defaults to the grid of make_rotation_grid
+    @center: (3,) translation given to every hypothesis
+    Return: (N,4,4) tensor wrt. the centered mesh, and the number of coarse hypotheses rendered for scoring
+    '''
+    if fine_cfg is None:
+      fine_cfg = self.rot_grid_cfg
+    symmetry_tfs = self.symmetry_tfs.data.cpu().numpy()
+    center = torch.as_tensor(center.reshape(1,3), device=self.device, dtype=torch.float)
+    coarse = torch.as_tensor(rot_grid_cache.get(*coarse_cfg, symmetry_tfs), device=self.device, dtype=torch.float)
+    coarse[:,:3,3] = center
+    scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=coarse, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, render_cache=self.render_cache)
+    top = coarse[scores.argsort(descending=True)[:topk]]
+
+    fine = torch.as_tensor(rot_grid_cache.get(*fine_cfg, symmetry_tfs), device=self.device, dtype=torch.float)
+    R_tops = top[:,None,:3,:3]@self.symmetry_tfs[None,:,:3,:3]   #(T,S,3,3)
+    cos = ((fine[:,None,None,:3,:3]*R_tops[None]).sum(dim=(-1,-2))-1)/2   # trace(R_fine^T@R_top)
+    near = (torch.arccos(cos.clip(-1,1))<radius/180.0*np.pi).reshape(len(fine),-1).any(dim=1)
+    poses = fine[near] if near.any() else top
+    poses[:,:3,3] = center
+    logging.info(f'hierarchical search: {len(coarse)} coarse, {len(poses)}/{len(fine)} fine kept')
+    return poses, len(coarse)
+
+
   def guess_translation(self, depth, mask, K):
-    vs,us = np.where(mask>0)
-    if len(us)==0:
-      logging.info(f'mask is all zero')
-      return np.zeros((3))
-    uc = (us.min()+us.max())/2.0
-    vc = (vs.min()+vs.max())/2.0
-    valid = mask.astype(bool) & (depth>=0.001)
-    if not valid.any():
-      logging.info(f"valid is empty")
-      return np.zeros((3))
-
-    zc = np.median(depth[valid])
-    center = (np.linalg.inv(K)@np.asarray([uc,vc,1]).reshape(3,1))*zc
+    '''Back-projection of the mask's bounding box center at the median depth of the mask. Computed on the device without syncing with the host
+    @depth, mask: (H,W) np array or tensor
+    Return: (3,) tensor, zeros if the mask has no valid depth
+    '''
+    mask = torch.as_tensor(mask, device=self.device)>0
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    bbox, _ = mask_bbox_torch(mask)
+    uc = (bbox[0]+bbox[2])/2.0
+    vc = (bbox[1]+bbox[3])/2.0
+    valid = (mask & (depth>=0.001)).reshape(-1)
+    n_valid = valid.sum()
+    zs = torch.where(valid, depth.reshape(-1), torch.full_like(depth.reshape(-1), np.inf)).sort().values
+    mid = torch.stack([(n_valid-1).clip(min=0)//2, n_valid//2]).clip(max=len(zs)-1)
+    zc = zs.index_select(0, mid).mean()   # Same as np.median over the valid depths
+    K_inv = torch.as_tensor(np.linalg.inv(K), device=self.device, dtype=torch.float)
+    center = K_inv@torch.stack([uc, vc, torch.ones_like(uc)])*zc
+    center = torch.where(n_valid>0, center, torch.zeros_like(center))
 
     if self.debug>=2:
-      pcd = toOpen3dCloud(center.reshape(1,3))
+      pcd = toOpen3dCloud(center.data.cpu().numpy().reshape(1,3))
       o3d.io.write_point_cloud(f'{self.debug_dir}/init_center.ply', pcd)
 
-    return center.reshape(3)
+    return center
 
 
-  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5):
+  def prescore_hypotheses(self, poses, K, depth, ob_mask, mesh_tensors=None, mesh_diameter=None, render_size=64):
+    '''Cheap ranking of pose hypotheses before refinement. Every hypothesis is rendered at low resolution (depth only) in a window around the observed mask,
+    and compared against the observed mask (silhouette IoU) and depth (residual after removing the mean offset, relative to the diameter)
+    @poses: (N,4,4) tensor wrt. the centered mesh
+    @depth: (H,W) observed depth
+    Return: (N,) tensor, higher is better
+    '''
+    if mesh_tensors is None:
+      mesh_tensors = self.mesh_tensors
+    if mesh_diameter is None:
+      mesh_diameter = self.diameter
+    H,W = depth.shape[:2]
+    mask_ob = torch.as_tensor(ob_mask, device=self.device)>0
+    bbox, _ = mask_bbox_torch(mask_ob)
+    uc = (bbox[0]+bbox[2])/2.0
+    vc = (bbox[1]+bbox[3])/2.0
+    radius = torch.maximum(bbox[2]-bbox[0], bbox[3]-bbox[1])/2.0*1.5+1
+    left = (uc-radius).reshape(1)
+    top = (vc-radius).reshape(1)
+    tf_to_crop = torch.eye(3, device=self.device)[None]
+    tf_to_crop[:,0,0] = render_size/(2*radius)
+    tf_to_crop[:,1,1] = render_size/(2*radius)
+    tf_to_crop[:,0,2] = -left*render_size/(2*radius)
+    tf_to_crop[:,1,2] = -top*render_size/(2*radius)
+    bbox2d_crop = torch.as_tensor(np.array([0, 0, render_size-1, render_size-1]).reshape(2,2), device=self.device, dtype=torch.float)
+    bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crop.inverse()).reshape(-1,4)
+
+    depth_ob = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    mask_ob = mask_ob.float()
+    obs = kornia.geometry.transform.warp_perspective(torch.stack([depth_ob, mask_ob], dim=0)[None], tf_to_crop, dsize=(render_size, render_size), mode='nearest', align_corners=False)[0]
+    depth_ob = obs[0]
+    mask_ob = obs[1]>0
+
+    scores = []
+    bs = 512
+    for b in range(0, len(poses), bs):
+      _, depth_r, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poses[b:b+bs], glctx=self.glctx, mesh_tensors=mesh_tensors, output_size=(render_size, render_size), bbox2d=bbox2d_ori.expand(len(poses[b:b+bs]),-1), device=self.device)
+      mask_r = depth_r>=0.001
+      iou = (mask_r & mask_ob).sum(dim=(1,2)) / (mask_r | mask_ob).sum(dim=(1,2)).clip(min=1)
+      both = mask_r & mask_ob & (depth_ob>=0.001)
+      n_both = both.sum(dim=(1,2)).clip(min=1)
+      diff = (depth_r-depth_ob)*both
+      diff = (diff - (diff.sum(dim=(1,2))/n_both).reshape(-1,1,1))*both
+      residual = diff.abs().sum(dim=(1,2))/n_both
+      scores.append(iou - residual/mesh_diameter)
+    return torch.cat(scores, dim=0)
+
+
+  @stage_profiler.wrap('register')
+  @float_textures()
+  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5, prescore_topk=None, search='flat', search_cfg={}, frame_time=None, frame_id=None):
     '''Copmute pose from given pts to self.pcd
-    @pts: (N,3) np array, downsampled scene points
+    @rgb, depth, ob_mask: np arrays or tensors. They are moved to self.device once and the registration stays there; the pose is returned as a tensor if depth is one, else as np array
+    @prescore_topk: if set, only the best this many hypotheses according to prescore_hypotheses go through refinement and scoring
+    @search: flat (the whole rotation grid) / hierarchical (see generate_hierarchical_pose_hypo, search_cfg holds its keyword arguments)
+    @frame_time: time.time() when the frame arrived, stamped on the pose sent to self.pose_stream. Default when the call starts
+    @frame_id: the caller's frame number, stamped on the pose sent to self.pose_stream. Default self.frame_id, which only counts this estimator's calls
+    After the call, self.n_rendered is the number of hypothesis renders this registration took. To count its host-device synchronizations and copies, run it under a SyncCounter
     '''
+    frame_time = time.time() if frame_time is None else frame_time
+    frame_id = self.next_frame_id(frame_id)
     set_seed(0)
+    self.render_cache.new_frame()
     logging.info('Welcome')
+    self.n_rendered = 0
+    self.ob_id = ob_id
 
-    if self.glctx is None:
+    if self.glctx is None and self.device.type=='cuda':
       if glctx is None:
-        self.glctx = dr.RasterizeCudaContext()
+        self.glctx = dr.RasterizeCudaContext(self.device)
         # self.glctx = dr.RasterizeGLContext()
       else:
         self.glctx = glctx
 
+    return_tensor = isinstance(depth, torch.Tensor)
 
     # 确保 depth 是 2D 灰度图
     if depth.ndim == 3:
@@ -177,65 +531,87 @@ class FoundationPose:
     elif depth.ndim == 4:
         depth = depth.squeeze(0).squeeze(-1)
 
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+    with stage_profiler.stage('depth_filter'):
+      rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+      depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+      ob_mask = torch.as_tensor(ob_mask, device=self.device)>0
+      depth = erode_depth(depth, radius=2, device=str(self.device))
+      depth = bilateral_filter_depth(depth, radius=2, device=str(self.device))
+      xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device=self.device)[None], zfar=np.inf)[0]
 
     if self.debug>=2:
-      xyz_map = depth2xyzmap(depth, K)
-      valid = xyz_map[...,2]>=0.001
-      pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
+      rgb_np = rgb.data.cpu().numpy().astype(np.uint8)
+      xyz_map_np = xyz_map.data.cpu().numpy()
+      valid = xyz_map_np[...,2]>=0.001
+      pcd = toOpen3dCloud(xyz_map_np[valid], rgb_np[valid])
       o3d.io.write_point_cloud(f'{self.debug_dir}/scene_raw.ply',pcd)
-      cv2.imwrite(f'{self.debug_dir}/ob_mask.png', (ob_mask*255.0).clip(0,255))
+      cv2.imwrite(f'{self.debug_dir}/ob_mask.png', ob_mask.data.cpu().numpy().astype(np.uint8)*255)
 
     normal_map = None
-    valid = (depth>=0.001) & (ob_mask>0)
-    if valid.sum()<4:
+    with stage_profiler.stage('guess_translation'):
+      center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+    valid = (depth>=0.001) & ob_mask
+    if valid.sum()<4:   # The one synchronization before the result
       logging.info(f'valid too small, return')
-      pose = np.eye(4)
-      pose[:3,3] = self.guess_translation(depth=depth, mask=ob_mask, K=K)
-      return pose
+      pose = torch.eye(4, device=self.device)
+      pose[:3,3] = center
+      self.publish_pose(pose, frame_id, score=0, frame_time=frame_time)
+      return pose if return_tensor else pose.data.cpu().numpy()
 
     if self.debug>=2:
-      imageio.imwrite(f'{self.debug_dir}/color.png', rgb)
-      cv2.imwrite(f'{self.debug_dir}/depth.png', (depth*1000).astype(np.uint16))
-      valid = xyz_map[...,2]>=0.001
-      pcd = toOpen3dCloud(xyz_map[valid], rgb[valid])
+      imageio.imwrite(f'{self.debug_dir}/color.png', rgb_np)
+      cv2.imwrite(f'{self.debug_dir}/depth.png', (depth.data.cpu().numpy()*1000).astype(np.uint16))
+      valid_np = xyz_map_np[...,2]>=0.001
+      pcd = toOpen3dCloud(xyz_map_np[valid_np], rgb_np[valid_np])
       o3d.io.write_point_cloud(f'{self.debug_dir}/scene_complete.ply',pcd)
 
     self.H, self.W = depth.shape[:2]
     self.K = K
-    self.ob_id = ob_id
     self.ob_mask = ob_mask
 
-    poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None)
-    poses = poses.data.cpu().numpy()
-    logging.info(f'poses:{poses.shape}')
-    center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
-
-    poses = torch.as_tensor(poses, device='cuda', dtype=torch.float)
-    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device='cuda')
-
-    add_errs = self.compute_add_err_to_gt_pose(poses)
-    logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
-
-    xyz_map = depth2xyzmap(depth, K)
-    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2)
+    with stage_profiler.stage('hypotheses'):
+      if search=='flat':
+        poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None, center=center)
+        logging.info(f'poses:{poses.shape}')
+      elif search=='hierarchical':
+        poses, n_coarse = self.generate_hierarchical_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, center=center, **search_cfg)
+        self.n_rendered += n_coarse
+      else:
+        raise RuntimeError(f'unknown search {search}')
+
+    if prescore_topk is not None and prescore_topk<len(poses):
+      with stage_profiler.stage('prescore'):
+        prescores = self.prescore_hypotheses(poses, K=K, depth=depth, ob_mask=ob_mask)
+      self.n_rendered += len(poses)
+      poses = poses[prescores.argsort(descending=True)[:prescore_topk]]
+      logging.info(f'after prescore, poses:{poses.shape}')
+    self.n_rendered += len(poses)*(iteration+1)   # Refine iterations plus scoring
+
+    ########## Printing tensor values syncs with the host, only done when debugging
+    if self.debug>=1:
+      add_errs = self.compute_add_err_to_gt_pose(poses)
+      logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
+
+    with stage_profiler.stage('refine'):
+      poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2, render_cache=self.render_cache)
     if vis is not None:
       imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
 
-    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
+    with stage_profiler.stage('score'):
+      scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2, render_cache=self.render_cache)
+    logging.info(f'render cache {self.render_cache.stats()}')
+    self.render_cache.clear()
     if vis is not None:
       imageio.imwrite(f'{self.debug_dir}/vis_score.png', vis)
 
-    add_errs = self.compute_add_err_to_gt_pose(poses)
-    logging.info(f"final, add_errs min:{add_errs.min()}")
-
-    ids = torch.as_tensor(scores).argsort(descending=True)
-    logging.info(f'sort ids:{ids}')
+    ids = scores.argsort(descending=True)
     scores = scores[ids]
     poses = poses[ids]
-
-    logging.info(f'sorted scores:{scores}')
+    if self.debug>=1:
+      add_errs = self.compute_add_err_to_gt_pose(poses)
+      logging.info(f"final, add_errs min:{add_errs.min()}")
+      logging.info(f'sort ids:{ids}')
+      logging.info(f'sorted scores:{scores}')
 
     best_pose = poses[0]@self.get_tf_to_centered_mesh()
     self.pose_last = poses[0]
@@ -244,34 +620,262 @@ class FoundationPose:
     self.poses = poses
     self.scores = scores
 
-    return best_pose.data.cpu().numpy()
+    self.publish_pose(best_pose, frame_id, score=scores[0], frame_time=frame_time)
+    return best_pose if return_tensor else best_pose.data.cpu().numpy()
+
+
+  @stage_profiler.wrap('register_many')
+  @float_textures()
+  def register_many(self, K, rgb, depth, ob_masks, objects, glctx=None, iteration=5, extra=None, prescore_topk=None, ob_ids=None, frame_time=None, frame_id=None):
+    '''Register several objects in the same frame. Hypotheses of all objects are refined and scored in shared batches
+    @ob_masks: list of (H,W) masks
+    @objects: list of trimesh or of make_object_data outputs, same length as ob_masks. Pass the latter to avoid preparing the objects every frame
+    @extra: if given, filled with per object 'pose_last' (wrt. the centered mesh, None if the mask is unusable), 'scores' and 'objects'
+    @prescore_topk: per object, see register
+    @ob_ids: object id of each mask, stamped on the poses sent to self.pose_stream. Default the index in ob_masks
+    @frame_time, frame_id: see register
+    Return: list of (4,4) poses in each mesh frame, tensors if depth is one, else np arrays
+    '''
+    if extra is None:
+      extra = {}
+    frame_time = time.time() if frame_time is None else frame_time
+    frame_id = self.next_frame_id(frame_id)
+    if ob_ids is None:
+      ob_ids = list(range(len(ob_masks)))
+    set_seed(0)
+    self.render_cache.new_frame()
+    logging.info('Welcome')
+    objects = [self.make_object_data(ob) if isinstance(ob, trimesh.Trimesh) else ob for ob in objects]
+
+    if self.glctx is None and self.device.type=='cuda':
+      if glctx is None:
+        self.glctx = dr.RasterizeCudaContext(self.device)
+      else:
+        self.glctx = glctx
+
+    return_tensor = isinstance(depth, torch.Tensor)
+    to_out = lambda pose: pose if return_tensor else pose.data.cpu().numpy()
+    if depth.ndim == 3:
+      depth = depth[..., 0]
+    elif depth.ndim == 4:
+        depth = depth.squeeze(0).squeeze(-1)
+
+    with stage_profiler.stage('depth_filter'):
+      rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+      depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+      depth = erode_depth(depth, radius=2, device=str(self.device))
+      depth = bilateral_filter_depth(depth, radius=2, device=str(self.device))
+
+    out_poses = [None]*len(objects)
+    pose_last = [None]*len(objects)
+    scores_out = [None]*len(objects)
+    poses = []
+    ob_ids = []
+    for i_ob, (ob, ob_mask) in enumerate(zip(objects, ob_masks)):
+      ob_mask = torch.as_tensor(ob_mask, device=self.device)>0
+      with stage_profiler.stage('guess_translation'):
+        center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+      valid = (depth>=0.001) & ob_mask
+      if valid.sum()<4:
+        logging.info(f'object {i_ob} valid too small')
+        pose = torch.eye(4, device=self.device)
+        pose[:3,3] = center
+        out_poses[i_ob] = to_out(pose)
+        self.publish_pose(pose, frame_id, score=0, frame_time=frame_time, ob_id=ob_ids[i_ob])
+        continue
+      poses_cur = ob['rot_grid'].clone()
+      poses_cur[:,:3,3] = center.reshape(1,3)
+      if prescore_topk is not None and prescore_topk<len(poses_cur):
+        with stage_profiler.stage('prescore'):
+          prescores = self.prescore_hypotheses(poses_cur, K=K, depth=depth, ob_mask=ob_mask, mesh_tensors=ob['mesh_tensors'], mesh_diameter=ob['diameter'])
+        poses_cur = poses_cur[prescores.argsort(descending=True)[:prescore_topk]]
+      poses.append(poses_cur)
+      ob_ids.append(torch.full((len(poses_cur),), i_ob, dtype=torch.long, device=self.device))
+
+    if len(poses)>0:
+      poses = torch.cat(poses, dim=0)
+      ob_ids = torch.cat(ob_ids, dim=0)
+      logging.info(f'poses:{poses.shape}')
+      meshes = [ob['mesh'] for ob in objects]
+      mesh_tensors = [ob['mesh_tensors'] for ob in objects]
+      mesh_diameters = [ob['diameter'] for ob in objects]
+
+      xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device=self.device)[None], zfar=np.inf)[0]
+      with stage_profiler.stage('refine'):
+        poses, vis = self.refiner.predict(mesh=meshes, mesh_tensors=mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=mesh_diameters, iteration=iteration, get_vis=self.debug>=2, ob_ids=ob_ids, render_cache=self.render_cache)
+      if vis is not None:
+        imageio.imwrite(f'{self.debug_dir}/vis_refiner_many.png', vis)
+
+      with stage_profiler.stage('score'):
+        scores, vis = self.scorer.predict(mesh=meshes, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, mesh_tensors=mesh_tensors, glctx=self.glctx, mesh_diameter=mesh_diameters, get_vis=self.debug>=2, ob_ids=ob_ids, render_cache=self.render_cache)
+      logging.info(f'render cache {self.render_cache.stats()}')
+      self.render_cache.clear()
+      if vis is not None:
+        imageio.imwrite(f'{self.debug_dir}/vis_score_many.png', vis)
+
+      for i_ob in torch.unique(ob_ids).tolist():
+        ids = torch.where(ob_ids==i_ob)[0]
+        order = ids[scores[ids].argsort(descending=True)]
+        pose_last[i_ob] = poses[order[0]]
+        scores_out[i_ob] = scores[order]
+        best_pose = poses[order[0]]@objects[i_ob]['tf_to_center']
+        out_poses[i_ob] = to_out(best_pose)
+        self.publish_pose(best_pose, frame_id, score=scores[order[0]], frame_time=frame_time, ob_id=ob_ids[i_ob])
+        if self.debug>=1:
+          logging.info(f'object {i_ob} best score:{scores[order[0]]}')
+
+    extra['pose_last'] = pose_last
+    extra['scores'] = scores_out
+    extra['objects'] = objects
+    return out_poses
+
+
+  def next_frame_id(self, frame_id=None):
+    '''Count the call, return frame_id if the caller gave one, else the count
+    '''
+    self.frame_id += 1
+    return self.frame_id if frame_id is None else frame_id
+
+
+  def publish_pose(self, pose, frame_id, score=float('nan'), frame_time=None, ob_id=None):
+    '''Send the (4,4) pose in the mesh frame to self.pose_stream as one binary message (see pose_stream.py)
+    @ob_id: default the ob_id given to register
+    '''
+    if self.pose_stream is None:
+      return
+    if isinstance(pose, torch.Tensor):
+      pose = pose.data.cpu().numpy()
+    if ob_id is None:
+      ob_id = self.ob_id
+    self.pose_stream.publish(pose, frame_id=frame_id, object_id=ob_id or 0, score=float(score), frame_time=frame_time)
 
 
   def compute_add_err_to_gt_pose(self, poses):
     '''
     @poses: wrt. the centered mesh
     '''
-    return -torch.ones(len(poses), device='cuda', dtype=torch.float)
+    return -torch.ones(len(poses), device=self.device, dtype=torch.float)
 
 
-  def track_one(self, rgb, depth, K, iteration, extra={}):
+  @stage_profiler.wrap('track_one')
+  @float_textures()
+  def track_one(self, rgb, depth, K, iteration, extra=None, converge_trans_thres=None, converge_rot_thres=None, frame_time=None, frame_id=None):
+    '''
+    @rgb, depth: np arrays or tensors. The pose is returned as a tensor if depth is one, else as np array
+    @converge_trans_thres, converge_rot_thres: meter, degree. If set, refinement stops early once the update is below them, see PoseRefinePredictor.predict. extra['n_active'] tells how many iterations ran
+    @frame_time, frame_id: see register. Tracked poses are not scored, they are streamed with score nan
+    '''
+    if extra is None:
+      extra = {}
+    frame_time = time.time() if frame_time is None else frame_time
+    frame_id = self.next_frame_id(frame_id)
     if self.pose_last is None:
       logging.info("Please init pose by register first")
       raise RuntimeError
     logging.info("Welcome")
 
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
-    logging.info("depth processing done")
+    self.render_cache.new_frame()
+    return_tensor = isinstance(depth, torch.Tensor)
+    with stage_profiler.stage('depth_filter'):
+      rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+      depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+      depth = erode_depth(depth, radius=2, device=str(self.device))
+      depth = bilateral_filter_depth(depth, radius=2, device=str(self.device))
+      logging.info("depth processing done")
 
-    xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device='cuda')[None], zfar=np.inf)[0]
+      xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device=self.device)[None], zfar=np.inf)[0]
 
-    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4).data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
+    with stage_profiler.stage('refine'):
+      pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2, converge_trans_thres=converge_trans_thres, converge_rot_thres=converge_rot_thres, extra=extra, render_cache=self.render_cache if self.debug>=2 else None)   # Only the visualization renders a pose twice
     logging.info("pose done")
+    self.render_cache.clear()
     if self.debug>=2:
       extra['vis'] = vis
     self.pose_last = pose
-    return (pose@self.get_tf_to_centered_mesh()).data.cpu().numpy().reshape(4,4)
+    pose = (pose@self.get_tf_to_centered_mesh()).reshape(4,4)
+    self.publish_pose(pose, frame_id, frame_time=frame_time)
+    return pose if return_tensor else pose.data.cpu().numpy()
+
 
 
+
+
+class MultiObjectTracker:
+  '''Tracks several objects with the networks of a single FoundationPose. Each object keeps its own mesh tensors, diameter and last pose,
+  and every refine iteration runs one batch over all tracked objects
+  '''
+  def __init__(self, est:FoundationPose):
+    self.est = est
+    self.objects = OrderedDict()   # name -> dict(data=make_object_data output, pose_last=(4,4) tensor wrt. the centered mesh or None)
+
+
+  def add_object(self, name, mesh, model_normals=None, symmetry_tfs=None):
+    self.objects[name] = {
+      'data': self.est.make_object_data(mesh, model_normals=model_normals, symmetry_tfs=symmetry_tfs),
+      'pose_last': None,
+    }
+
+
+  def remove_object(self, name):
+    self.objects.pop(name, None)
+
+
+  def set_pose(self, name, pose):
+    '''
+    @pose: (4,4) in the mesh frame, e.g. from an external detector
+    '''
+    data = self.objects[name]['data']
+    pose = torch.as_tensor(pose, device=self.est.device, dtype=torch.float)
+    self.objects[name]['pose_last'] = pose@data['tf_to_center'].inverse()
+
+
+  def register(self, K, rgb, depth, ob_masks, iteration=5):
+    '''
+    @ob_masks: dict name -> (H,W) mask
+    Return: dict name -> (4,4) np array in the mesh frame
+    '''
+    names = list(ob_masks.keys())
+    extra = {}
+    poses = self.est.register_many(K=K, rgb=rgb, depth=depth, ob_masks=[ob_masks[name] for name in names], objects=[self.objects[name]['data'] for name in names], iteration=iteration, extra=extra)
+    for name, pose_last in zip(names, extra['pose_last']):
+      self.objects[name]['pose_last'] = pose_last
+    return dict(zip(names, poses))
+
+
+  @stage_profiler.wrap('track')
+  @float_textures()
+  def track(self, rgb, depth, K, iteration, names=None, converge_trans_thres=None, converge_rot_thres=None, extra=None):
+    '''
+    @names: objects to track, default all registered ones
+    @converge_trans_thres, converge_rot_thres: meter, degree. Objects whose update falls below them leave the batch early, see PoseRefinePredictor.predict
+    @extra: if given, 'n_active' is set in it, see PoseRefinePredictor.predict
+    Return: dict name -> (4,4) np array in the mesh frame
+    '''
+    if names is None:
+      names = [name for name in self.objects if self.objects[name]['pose_last'] is not None]
+    for name in names:
+      if self.objects[name]['pose_last'] is None:
+        logging.info(f"Please init pose of {name} by register first")
+        raise RuntimeError
+    if len(names)==0:
+      return {}
+
+    device = self.est.device
+    if self.est.glctx is None and device.type=='cuda':
+      self.est.glctx = dr.RasterizeCudaContext(device)
+    with stage_profiler.stage('depth_filter'):
+      depth = torch.as_tensor(depth, device=device, dtype=torch.float)
+      depth = erode_depth(depth, radius=2, device=str(device))
+      depth = bilateral_filter_depth(depth, radius=2, device=str(device))
+      xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device=device)[None], zfar=np.inf)[0]
+
+    datas = [self.objects[name]['data'] for name in names]
+    ob_in_cams = torch.stack([self.objects[name]['pose_last'] for name in names], dim=0)
+    with stage_profiler.stage('refine'):
+      poses, _ = self.est.refiner.predict(mesh=[data['mesh'] for data in datas], mesh_tensors=[data['mesh_tensors'] for data in datas], rgb=rgb, depth=depth, K=K, ob_in_cams=ob_in_cams, normal_map=None, xyz_map=xyz_map, mesh_diameter=[data['diameter'] for data in datas], glctx=self.est.glctx, iteration=iteration, ob_ids=torch.arange(len(names), device=device), converge_trans_thres=converge_trans_thres, converge_rot_thres=converge_rot_thres, extra=extra)
+
+    out = {}
+    for i, name in enumerate(names):
+      self.objects[name]['pose_last'] = poses[i]
+      out[name] = (poses[i]@datas[i]['tf_to_center']).data.cpu().numpy().reshape(4,4)
+    return out
@@ -76,20 +76,18 @@ class PairH5Dataset(torch.utils.data.Dataset):
 
 
 
-  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1, device='cuda'):
     bs = len(batch.rgbAs)
     H,W = batch.rgbAs.shape[-2:]
-    mesh_radius = batch.mesh_diameters.cuda()/2
-    tf_to_crops = batch.tf_to_crops.cuda()
-    crop_to_oris = batch.tf_to_crops.inverse().cuda()  #(B,3,3)
-    batch.poseA = batch.poseA.cuda()
-    batch.Ks = batch.Ks.cuda()
+    mesh_radius = batch.mesh_diameters.to(device)/2
+    tf_to_crops = batch.tf_to_crops.to(device)
+    batch.poseA = batch.poseA.to(device)
+    batch.Ks = batch.Ks.to(device)
+    Ks_crop = (tf_to_crops@batch.Ks).expand(bs,3,3)   # Back-project the crop pixels directly, no detour through the original resolution
 
     if batch.xyz_mapAs is None:
-      depthAs_ori = kornia.geometry.transform.warp_perspective(batch.depthAs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
-      batch.xyz_mapAs = depth2xyzmap_batch(depthAs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
-      batch.xyz_mapAs = kornia.geometry.transform.warp_perspective(batch.xyz_mapAs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapAs = batch.xyz_mapAs.cuda()
+      batch.xyz_mapAs = depth2xyzmap_batch(batch.depthAs.to(device).expand(bs,-1,-1,-1)[:,0], Ks_crop, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
+    batch.xyz_mapAs = batch.xyz_mapAs.to(device)
     if self.cfg['normalize_xyz']:
       invalid = batch.xyz_mapAs[:,2:3]<0.001
     batch.xyz_mapAs = batch.xyz_mapAs-batch.poseA[:,:3,3].reshape(bs,3,1,1)
@@ -99,10 +97,8 @@ class PairH5Dataset(torch.utils.data.Dataset):
       batch.xyz_mapAs[invalid.expand(bs,3,-1,-1)] = 0
 
     if batch.xyz_mapBs is None:
-      depthBs_ori = kornia.geometry.transform.warp_perspective(batch.depthBs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
-      batch.xyz_mapBs = depth2xyzmap_batch(depthBs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
-      batch.xyz_mapBs = kornia.geometry.transform.warp_perspective(batch.xyz_mapBs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapBs = batch.xyz_mapBs.cuda()
+      batch.xyz_mapBs = depth2xyzmap_batch(batch.depthBs.to(device).expand(bs,-1,-1,-1)[:,0], Ks_crop, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
+    batch.xyz_mapBs = batch.xyz_mapBs.to(device)
     if self.cfg['normalize_xyz']:
       invalid = batch.xyz_mapBs[:,2:3]<0.001
     batch.xyz_mapBs = batch.xyz_mapBs-batch.poseA[:,:3,3].reshape(bs,3,1,1)
@@ -115,15 +111,15 @@ class PairH5Dataset(torch.utils.data.Dataset):
 
 
 
-  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1, device='cuda'):
     '''Transform the batch before feeding to the network
     !NOTE the H_ori, W_ori could be different at test time from the training data, and needs to be set
     '''
     bs = len(batch.rgbAs)
-    batch.rgbAs = batch.rgbAs.cuda().float()/255.0
-    batch.rgbBs = batch.rgbBs.cuda().float()/255.0
+    batch.rgbAs = batch.rgbAs.to(device).float()/255.0
+    batch.rgbBs = batch.rgbBs.to(device).float()/255.0
 
-    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound)
+    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound, device=device)
     return batch
 
 
@@ -134,20 +130,18 @@ class TripletH5Dataset(PairH5Dataset):
     super().__init__(cfg, h5_file, mode, max_num_key, cache_data=cache_data)
 
 
-  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_depth_to_xyzmap(self, batch:BatchPoseData, H_ori, W_ori, bound=1, device='cuda'):
     bs = len(batch.rgbAs)
     H,W = batch.rgbAs.shape[-2:]
-    mesh_radius = batch.mesh_diameters.cuda()/2
-    tf_to_crops = batch.tf_to_crops.cuda()
-    crop_to_oris = batch.tf_to_crops.inverse().cuda()  #(B,3,3)
-    batch.poseA = batch.poseA.cuda()
-    batch.Ks = batch.Ks.cuda()
+    mesh_radius = batch.mesh_diameters.to(device)/2
+    tf_to_crops = batch.tf_to_crops.to(device)
+    batch.poseA = batch.poseA.to(device)
+    batch.Ks = batch.Ks.to(device)
+    Ks_crop = (tf_to_crops@batch.Ks).expand(bs,3,3)   # Back-project the crop pixels directly, no detour through the original resolution
 
     if batch.xyz_mapAs is None:
-      depthAs_ori = kornia.geometry.transform.warp_perspective(batch.depthAs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
-      batch.xyz_mapAs = depth2xyzmap_batch(depthAs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
-      batch.xyz_mapAs = kornia.geometry.transform.warp_perspective(batch.xyz_mapAs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapAs = batch.xyz_mapAs.cuda()
+      batch.xyz_mapAs = depth2xyzmap_batch(batch.depthAs.to(device).expand(bs,-1,-1,-1)[:,0], Ks_crop, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
+    batch.xyz_mapAs = batch.xyz_mapAs.to(device)
     invalid = batch.xyz_mapAs[:,2:3]<0.1
     batch.xyz_mapAs = (batch.xyz_mapAs-batch.poseA[:,:3,3].reshape(bs,3,1,1))
     if self.cfg['normalize_xyz']:
@@ -156,10 +150,8 @@ class TripletH5Dataset(PairH5Dataset):
       batch.xyz_mapAs[invalid.expand(bs,3,-1,-1)] = 0
 
     if batch.xyz_mapBs is None:
-      depthBs_ori = kornia.geometry.transform.warp_perspective(batch.depthBs.cuda().expand(bs,-1,-1,-1), crop_to_oris, dsize=(H_ori, W_ori), mode='nearest', align_corners=False)
-      batch.xyz_mapBs = depth2xyzmap_batch(depthBs_ori[:,0], batch.Ks, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
-      batch.xyz_mapBs = kornia.geometry.transform.warp_perspective(batch.xyz_mapBs, tf_to_crops, dsize=(H,W), mode='nearest', align_corners=False)
-    batch.xyz_mapBs = batch.xyz_mapBs.cuda()
+      batch.xyz_mapBs = depth2xyzmap_batch(batch.depthBs.to(device).expand(bs,-1,-1,-1)[:,0], Ks_crop, zfar=np.inf).permute(0,3,1,2)  #(B,3,H,W)
+    batch.xyz_mapBs = batch.xyz_mapBs.to(device)
     invalid = batch.xyz_mapBs[:,2:3]<0.1
     batch.xyz_mapBs = (batch.xyz_mapBs-batch.poseA[:,:3,3].reshape(bs,3,1,1))
     if self.cfg['normalize_xyz']:
@@ -170,12 +162,12 @@ class TripletH5Dataset(PairH5Dataset):
     return batch
 
 
-  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1, device='cuda'):
     bs = len(batch.rgbAs)
-    batch.rgbAs = batch.rgbAs.cuda().float()/255.0
-    batch.rgbBs = batch.rgbBs.cuda().float()/255.0
+    batch.rgbAs = batch.rgbAs.to(device).float()/255.0
+    batch.rgbBs = batch.rgbBs.to(device).float()/255.0
 
-    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound)
+    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound, device=device)
     return batch
 
 
@@ -207,14 +199,14 @@ class PoseRefinePairH5Dataset(PairH5Dataset):
           break
 
 
-  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1):
+  def transform_batch(self, batch:BatchPoseData, H_ori, W_ori, bound=1, device='cuda'):
     '''Transform the batch before feeding to the network
     !NOTE the H_ori, W_ori could be different at test time from the training data, and needs to be set
     '''
     bs = len(batch.rgbAs)
-    batch.rgbAs = batch.rgbAs.cuda().float()/255.0
-    batch.rgbBs = batch.rgbBs.cuda().float()/255.0
+    batch.rgbAs = batch.rgbAs.to(device).float()/255.0
+    batch.rgbBs = batch.rgbBs.to(device).float()/255.0
 
-    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound)
+    batch = self.transform_depth_to_xyzmap(batch, H_ori, W_ori, bound=bound, device=device)
     return batch
 
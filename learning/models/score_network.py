@@ -88,3 +88,20 @@ class ScoreNetMultiPair(nn.Module):
     output['score_logit'] = self.linear(x).reshape(bs,L)  # (B,L)
 
     return output
+
+
+  def forward_groups(self, A, B, group_ids):
+    """Pairs of several objects in one batch. Features are extracted together, the cross attention only looks within a group
+    @A: (N,C,H,W)
+    @group_ids: (N,) tensor
+    """
+    output = {}
+    feats = self.extract_feat(A, B)   #(N, C)
+    score_logit = torch.zeros((len(A)), dtype=feats.dtype, device=feats.device)
+    for group_id in torch.unique(group_ids):
+      ids = torch.where(group_ids==group_id)[0]
+      x = feats[ids][None]
+      x, _ = self.att_cross(x, x, x)
+      score_logit[ids] = self.linear(x).reshape(-1).to(score_logit.dtype)
+    output['score_logit'] = score_logit  # (N)
+    return output
@@ -23,44 +23,41 @@ from datareader import *
 
 
 @torch.inference_mode()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None):
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None, device='cuda', ob_ids=None, render_cache:RenderCache=None, store_renders=False, lod_pix_per_meter=None):
+  '''
+  @ob_ids: (B,) tensor. If given, the poses belong to several objects: mesh_tensors is a list indexed by ob_ids and mesh_diameter is per pose (B,)
+  @render_cache: renders of poses already seen this frame are reused, see render_crop_batch
+  @store_renders: keep these renders in render_cache, when a later stage renders the same poses
+  @lod_pix_per_meter: see render_crop_batch
+  '''
   logging.info("Welcome make_crop_data_batch")
   H,W = depth.shape[:2]
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
+  tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=torch.as_tensor(ob_in_cams, dtype=torch.float, device=device), K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
+  tf_to_crops, uniq, inverse = dedup_crop_windows(tf_to_crops, out_size=(render_size[1], render_size[0]), quantize=cfg['crop_window_quantize'])
+  tf_uniq = tf_to_crops[uniq]
+  logging.info(f"{len(uniq)} unique crop windows for {len(tf_to_crops)} poses")
 
   logging.info("make tf_to_crops done")
 
   B = len(ob_in_cams)
-  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
-
-  bs = 512
-  rgb_rs = []
-  depth_rs = []
-  normal_rs = []
-  xyz_map_rs = []
-
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
-  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
-
-  for b in range(0,len(poseA),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    normal_rs.append(normal_r)
-    xyz_map_rs.append(extra['xyz_map'])
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)  #(B,1,H,W)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  Ks = torch.as_tensor(K, device='cuda', dtype=torch.float).reshape(1,3,3)
+  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+
+  with stage_profiler.stage('render'):
+    rgb_rs, depth_rs, normal_rs, xyz_map_rs = render_crop_batch(K=K, H=H, W=W, poses=poseA, tf_to_crops=tf_to_crops, output_size=cfg['input_resize'], mesh_tensors=mesh_tensors, glctx=glctx, get_normal=cfg['use_normal'], ob_ids=ob_ids, render_cache=render_cache, store=store_renders, lod_pix_per_meter=lod_pix_per_meter, device=device)
+  rgb_rs = rgb_rs.permute(0,3,1,2) * 255
+  depth_rs = depth_rs[:,None]  #(B,1,H,W)
+  xyz_map_rs = xyz_map_rs.permute(0,3,1,2)  #(B,3,H,W)
+  Ks = torch.as_tensor(K, device=device, dtype=torch.float).reshape(1,3,3)
   if cfg['use_normal']:
-    normal_rs = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+    normal_rs = normal_rs.permute(0,3,1,2)  #(B,3,H,W)
 
   logging.info("render done")
 
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+  with stage_profiler.stage('crop_observed'):
+    rgbBs = crop_to_windows(rgb, tf_uniq, dsize=render_size, mode='bilinear', device=device)[inverse]
+    xyz_mapBs = crop_to_windows(xyz_map, tf_uniq, dsize=render_size, mode='nearest', device=device)[inverse]  #(B,3,H,W)
   if rgb_rs.shape[-2:]!=cfg['input_resize']:
     rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
   else:
@@ -69,20 +66,20 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
     xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
   else:
     xyz_mapAs = xyz_map_rs
-  xyz_mapBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(xyz_map, device='cuda', dtype=torch.float).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)  #(B,3,H,W)
 
   if cfg['use_normal']:
     normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    normalBs = crop_to_windows(normal_map, tf_uniq, dsize=render_size, mode='nearest', device=device)[inverse]
   else:
     normalAs = None
     normalBs = None
 
   logging.info("warp done")
 
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
   pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1)
+  with stage_profiler.stage('transform'):
+    pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   logging.info("pose batch data done")
 
@@ -91,9 +88,10 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
 
 
 class PoseRefinePredictor:
-  def __init__(self,):
+  def __init__(self, device='cuda'):
     logging.info("welcome")
-    self.amp = True
+    self.device = torch.device(device)
+    self.amp = self.device.type=='cuda'
     self.run_name = "2023-10-28-18-33-37"
     model_name = 'model_best.pth'
     code_dir = os.path.dirname(os.path.realpath(__file__))
@@ -115,6 +113,8 @@ class PoseRefinePredictor:
       self.cfg['c_in'] = 4
     if 'crop_ratio' not in self.cfg or self.cfg['crop_ratio'] is None:
       self.cfg['crop_ratio'] = 1.2
+    if 'crop_window_quantize' not in self.cfg:
+      self.cfg['crop_window_quantize'] = None
     if 'n_view' not in self.cfg:
       self.cfg['n_view'] = 1
     if 'trans_rep' not in self.cfg:
@@ -132,27 +132,32 @@ class PoseRefinePredictor:
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test')
-    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
     logging.info("init done")
     self.last_trans_update = None
     self.last_rot_update = None
 
 
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5):
+  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5, ob_ids=None, converge_trans_thres=None, converge_rot_thres=None, extra=None, render_cache:RenderCache=None):
     '''
     @rgb: np array (H,W,3)
     @ob_in_cams: np array (N,4,4)
+    @ob_ids: (N,) object index of each pose, to refine several objects in one batch. mesh_tensors and mesh_diameter are then lists over objects
+    @converge_trans_thres: meter. With converge_rot_thres (degree), a pose whose update is below both is not refined further, and iterations stop early once all poses converged. iteration stays the upper bound
+    @extra: if given, 'n_active' is set in it to the number of poses refined at each iteration
+    @render_cache: shared with the scorer within a frame, see render_crop_batch. With get_vis, the first iteration's renders are stored for the visualization, and the visualization's renders of the refined poses for the scorer
     '''
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    if extra is None:
+      extra = {}
     logging.info(f'ob_in_cams:{ob_in_cams.shape}')
     tf_to_center = np.eye(4)
     ob_centered_in_cams = ob_in_cams
@@ -166,75 +171,113 @@ class PoseRefinePredictor:
     logging.info(f"trans_normalizer:{self.cfg['trans_normalizer']}, rot_normalizer:{self.cfg['rot_normalizer']}")
     bs = 1024
 
-    B_in_cams = torch.as_tensor(ob_centered_in_cams, device='cuda', dtype=torch.float)
+    B_in_cams = torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float)
 
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh_centered)
-
-    rgb_tensor = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth_tensor = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    xyz_map_tensor = torch.as_tensor(xyz_map, device='cuda', dtype=torch.float)
+      mesh_tensors = make_mesh_tensors(mesh_centered, device=self.device, max_tex_size=default_max_tex_size(self.cfg['input_resize']))
+    lod_pix_per_meter = crop_pix_per_meter(K, self.cfg['input_resize'], mesh_diameter, crop_ratio)   # Once per call from host values, the level of detail is then picked without a sync
+    if ob_ids is not None:
+      ob_ids = torch.as_tensor(ob_ids, device=self.device, dtype=torch.long)
+      mesh_diameter = torch.as_tensor(mesh_diameter, device=self.device, dtype=torch.float)[ob_ids]
+
+    rgb_tensor = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    xyz_map_tensor = torch.as_tensor(xyz_map, device=self.device, dtype=torch.float)
     trans_normalizer = self.cfg['trans_normalizer']
     if not isinstance(trans_normalizer, float):
-      trans_normalizer = torch.as_tensor(list(trans_normalizer), device='cuda', dtype=torch.float).reshape(1,3)
+      trans_normalizer = torch.as_tensor(list(trans_normalizer), device=self.device, dtype=torch.float).reshape(1,3)
 
+    check_converge = converge_trans_thres is not None or converge_rot_thres is not None
+    active = torch.arange(len(B_in_cams), device=self.device)
+    n_active = []
     for _ in range(iteration):
+      if len(active)==0:
+        break
+      n_active.append(len(active))
+      if ob_ids is None:
+        ob_ids_cur = None
+        mesh_diameter_cur = mesh_diameter
+      else:
+        ob_ids_cur = ob_ids[active]
+        mesh_diameter_cur = mesh_diameter[active]
       logging.info("making cropped data")
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
-      B_in_cams = []
+      with stage_profiler.stage('crop_render'):
+        pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams[active], mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter_cur, device=self.device, ob_ids=ob_ids_cur, render_cache=render_cache, store_renders=get_vis and len(n_active)==1, lod_pix_per_meter=lod_pix_per_meter)
+      B_in_cams_cur = []
+      converged = []
       for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
+        A = torch.cat([pose_data.rgbAs[b:b+bs].to(self.device), pose_data.xyz_mapAs[b:b+bs].to(self.device)], dim=1).float()
+        B = torch.cat([pose_data.rgbBs[b:b+bs].to(self.device), pose_data.xyz_mapBs[b:b+bs].to(self.device)], dim=1).float()
         logging.info("forward start")
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A,B)
-        for k in output:
-          output[k] = output[k].float()
+        with stage_profiler.stage('forward'):
+          with torch.autocast(device_type=self.device.type, enabled=self.amp):
+            output = self.model(A,B)
+          for k in output:
+            output[k] = output[k].float()
         logging.info("forward done")
-        if self.cfg['trans_rep']=='tracknet':
-          if not self.cfg['normalize_xyz']:
-            trans_delta = torch.tanh(output["trans"])*trans_normalizer
+        with stage_profiler.stage('pose_update'):
+          if self.cfg['trans_rep']=='tracknet':
+            if not self.cfg['normalize_xyz']:
+              trans_delta = torch.tanh(output["trans"])*trans_normalizer
+            else:
+              trans_delta = output["trans"]
+
+          elif self.cfg['trans_rep']=='deepim':
+            def project_and_transform_to_crop(centers):
+              uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
+              uvs = uvs/uvs[:,2:3]
+              uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
+              return uvs[:,:2]
+
+            rot_delta = output["rot"]
+            z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
+            uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
+            uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
+            uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().to(self.device))
+            center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device=self.device)], dim=-1)
+            center_pred = (pose_data.Ks[b:b+bs].inverse().to(self.device)@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
+            trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
+
           else:
             trans_delta = output["trans"]
 
-        elif self.cfg['trans_rep']=='deepim':
-          def project_and_transform_to_crop(centers):
-            uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
-            uvs = uvs/uvs[:,2:3]
-            uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
-            return uvs[:,:2]
-
-          rot_delta = output["rot"]
-          z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
-          uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
-          uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
-          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().cuda())
-          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device='cuda')], dim=-1)
-          center_pred = (pose_data.Ks[b:b+bs].inverse().cuda()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
-          trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
-
-        else:
-          trans_delta = output["trans"]
-
-        if self.cfg['rot_rep']=='axis_angle':
-          rot_mat_delta = torch.tanh(output["rot"])*self.cfg['rot_normalizer']
-          rot_mat_delta = so3_exp_map(rot_mat_delta).permute(0,2,1)
-        elif self.cfg['rot_rep']=='6d':
-          rot_mat_delta = rotation_6d_to_matrix(output['rot']).permute(0,2,1)
-        else:
-          raise RuntimeError
-
-        if self.cfg['normalize_xyz']:
-          trans_delta *= (mesh_diameter/2)
-
-        B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
-        B_in_cams.append(B_in_cam)
-
-      B_in_cams = torch.cat(B_in_cams, dim=0).reshape(len(ob_in_cams),4,4)
-
-    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device='cuda', dtype=torch.float)
-    torch.cuda.empty_cache()
+          if self.cfg['rot_rep']=='axis_angle':
+            rot_mat_delta = torch.tanh(output["rot"])*self.cfg['rot_normalizer']
+            rot_mat_delta = so3_exp_map(rot_mat_delta).permute(0,2,1)
+          elif self.cfg['rot_rep']=='6d':
+            rot_mat_delta = rotation_6d_to_matrix(output['rot']).permute(0,2,1)
+          else:
+            raise RuntimeError
+
+          if self.cfg['normalize_xyz']:
+            if ob_ids is None:
+              trans_delta *= (mesh_diameter/2)
+            else:
+              trans_delta *= (mesh_diameter_cur[b:b+bs]/2).reshape(-1,1)
+
+          B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
+          B_in_cams_cur.append(B_in_cam)
+
+          if check_converge:
+            converged_cur = torch.ones((len(B_in_cam)), dtype=torch.bool, device=self.device)
+            if converge_trans_thres is not None:
+              converged_cur &= trans_delta.norm(dim=-1)<converge_trans_thres
+            if converge_rot_thres is not None:
+              cos = ((rot_mat_delta.diagonal(dim1=-2, dim2=-1).sum(dim=-1)-1)/2).clip(-1,1)
+              converged_cur &= torch.arccos(cos)<converge_rot_thres/180.0*np.pi
+            converged.append(converged_cur)
+
+      B_in_cams = B_in_cams.clone()
+      B_in_cams[active] = torch.cat(B_in_cams_cur, dim=0).reshape(len(active),4,4)
+      if check_converge:
+        active = active[~torch.cat(converged, dim=0)]
+
+    logging.info(f'n_active per iteration: {n_active}')
+    extra['n_active'] = n_active
+    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device=self.device, dtype=torch.float)
+    if self.device.type=='cuda':
+      torch.cuda.empty_cache()
     self.last_trans_update = trans_delta
     self.last_rot_update = rot_mat_delta
 
@@ -242,7 +285,7 @@ class PoseRefinePredictor:
       logging.info("get_vis...")
       canvas = []
       padding = 2
-      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams, dtype=torch.float, device=self.device), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device, ob_ids=ob_ids, render_cache=render_cache, lod_pix_per_meter=lod_pix_per_meter)
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
         rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -266,7 +309,7 @@ class PoseRefinePredictor:
         canvas.append(row)
       canvas = make_grid_image(canvas, nrow=1, padding=padding, pad_value=255)
 
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device, ob_ids=ob_ids, render_cache=render_cache, store_renders=True, lod_pix_per_meter=lod_pix_per_meter)
       canvas_refined = []
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -289,7 +332,8 @@ class PoseRefinePredictor:
 
       canvas_refined = make_grid_image(canvas_refined, nrow=1, padding=padding, pad_value=255)
       canvas = make_grid_image([canvas, canvas_refined], nrow=2, padding=padding, pad_value=255)
-      torch.cuda.empty_cache()
+      if self.device.type=='cuda':
+        torch.cuda.empty_cache()
       return B_in_cams_out, canvas
 
     return B_in_cams_out, None
@@ -54,40 +54,37 @@ def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
 
 
 @torch.no_grad()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None):
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None, device='cuda', ob_ids=None, render_cache:RenderCache=None, store_renders=False, lod_pix_per_meter=None):
+  '''
+  @ob_ids: (B,) tensor. If given, the poses belong to several objects: mesh_tensors is a list indexed by ob_ids and mesh_diameter is per pose (B,)
+  @render_cache: renders of poses already seen this frame are reused, see render_crop_batch
+  @store_renders: keep these renders in render_cache, when a later stage renders the same poses
+  @lod_pix_per_meter: see render_crop_batch
+  '''
   logging.info("Welcome make_crop_data_batch")
   H,W = depth.shape[:2]
 
   args = []
   method = 'box_3d'
-  tf_to_crops = compute_crop_window_tf_batch(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
+  tf_to_crops = compute_crop_window_tf_batch(H=H, W=W, poses=torch.as_tensor(ob_in_cams, dtype=torch.float, device=device), K=K, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method=method, mesh_diameter=mesh_diameter)
+  tf_to_crops, uniq, inverse = dedup_crop_windows(tf_to_crops, out_size=(render_size[1], render_size[0]), quantize=cfg['crop_window_quantize'])
+  tf_uniq = tf_to_crops[uniq]
+  logging.info(f"{len(uniq)} unique crop windows for {len(tf_to_crops)} poses")
   logging.info("make tf_to_crops done")
 
   B = len(ob_in_cams)
-  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
-
-  bs = 512
-  rgb_rs = []
-  depth_rs = []
-  xyz_map_rs = []
-
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
-  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
-
-  for b in range(0,len(ob_in_cams),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    xyz_map_rs.append(extra['xyz_map'])
-
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+
+  with stage_profiler.stage('render'):
+    rgb_rs, depth_rs, _, xyz_map_rs = render_crop_batch(K=K, H=H, W=W, poses=poseAs, tf_to_crops=tf_to_crops, output_size=cfg['input_resize'], mesh_tensors=mesh_tensors, glctx=glctx, get_normal=cfg['use_normal'], ob_ids=ob_ids, render_cache=render_cache, store=store_renders, lod_pix_per_meter=lod_pix_per_meter, device=device)
+  rgb_rs = rgb_rs.permute(0,3,1,2) * 255
+  depth_rs = depth_rs[:,None]
+  xyz_map_rs = xyz_map_rs.permute(0,3,1,2)  #(B,3,H,W)
   logging.info("render done")
 
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  depthBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(depth, dtype=torch.float, device='cuda')[None,None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+  with stage_profiler.stage('crop_observed'):
+    rgbBs = crop_to_windows(rgb, tf_uniq, dsize=render_size, mode='bilinear', device=device)[inverse]
+    depthBs = crop_to_windows(depth, tf_uniq, dsize=render_size, mode='nearest', device=device)[inverse]
   if rgb_rs.shape[-2:]!=cfg['input_resize']:
     rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
     depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
@@ -103,11 +100,12 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
   normalAs = None
   normalBs = None
 
-  Ks = torch.as_tensor(K, dtype=torch.float).reshape(1,3,3).expand(len(rgbAs),3,3)
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+  Ks = torch.as_tensor(K, dtype=torch.float, device=device).reshape(1,3,3).expand(len(rgbAs),3,3)
+  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
 
   pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1)
+  with stage_profiler.stage('transform'):
+    pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   logging.info("pose batch data done")
 
@@ -115,8 +113,9 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
 
 
 class ScorePredictor:
-  def __init__(self, amp=True):
-    self.amp = amp
+  def __init__(self, amp=True, device='cuda'):
+    self.device = torch.device(device)
+    self.amp = amp and self.device.type=='cuda'
     self.run_name = "2024-01-11-20-02-45"
 
     model_name = 'model_best.pth'
@@ -141,29 +140,34 @@ class ScorePredictor:
       self.cfg['normalize_xyz'] = False
     if 'crop_ratio' not in self.cfg or self.cfg['crop_ratio'] is None:
       self.cfg['crop_ratio'] = 1.2
+    if 'crop_window_quantize' not in self.cfg:
+      self.cfg['crop_window_quantize'] = None
 
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1)
-    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
     logging.info("init done")
 
 
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None):
+  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, ob_ids=None, render_cache:RenderCache=None, store_renders=False):
     '''
     @rgb: np array (H,W,3)
+    @ob_ids: (N,) object index of each pose, to score several objects in one batch. mesh_tensors and mesh_diameter are then lists over objects, and poses only compete with poses of the same object
+    @render_cache: shared with the refiner within a frame, see render_crop_batch
+    @store_renders: keep the renders in render_cache for a later stage that renders the same poses again
     '''
     logging.info(f"ob_in_cams:{ob_in_cams.shape}")
-    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device)
 
     logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
@@ -172,12 +176,17 @@ class ScorePredictor:
     logging.info("making cropped data")
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh)
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device, max_tex_size=default_max_tex_size(self.cfg['input_resize']))
+    lod_pix_per_meter = crop_pix_per_meter(K, self.cfg['input_resize'], mesh_diameter, self.cfg['crop_ratio'])   # Once per call from host values, the level of detail is then picked without a sync
+    if ob_ids is not None:
+      ob_ids = torch.as_tensor(ob_ids, device=self.device, dtype=torch.long)
+      mesh_diameter = torch.as_tensor(mesh_diameter, device=self.device, dtype=torch.float)[ob_ids]
 
-    rgb = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
 
-    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter)
+    with stage_profiler.stage('crop_render'):
+      pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, device=self.device, ob_ids=ob_ids, render_cache=render_cache, store_renders=store_renders, lod_pix_per_meter=lod_pix_per_meter)
 
     def find_best_among_pairs(pose_data:BatchPoseData):
       logging.info(f'pose_data.rgbAs.shape[0]: {pose_data.rgbAs.shape[0]}')
@@ -185,12 +194,12 @@ class ScorePredictor:
       scores = []
       bs = pose_data.rgbAs.shape[0]
       for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
+        A = torch.cat([pose_data.rgbAs[b:b+bs].to(self.device), pose_data.xyz_mapAs[b:b+bs].to(self.device)], dim=1).float()
+        B = torch.cat([pose_data.rgbBs[b:b+bs].to(self.device), pose_data.xyz_mapBs[b:b+bs].to(self.device)], dim=1).float()
         if pose_data.normalAs is not None:
-          A = torch.cat([A, pose_data.normalAs.cuda().float()], dim=1)
-          B = torch.cat([B, pose_data.normalBs.cuda().float()], dim=1)
-        with torch.cuda.amp.autocast(enabled=self.amp):
+          A = torch.cat([A, pose_data.normalAs.to(self.device).float()], dim=1)
+          B = torch.cat([B, pose_data.normalBs.to(self.device).float()], dim=1)
+        with stage_profiler.stage('forward'), torch.autocast(device_type=self.device.type, enabled=self.amp):
           output = self.model(A, B, L=len(A))
         scores_cur = output["score_logit"].float().reshape(-1)
         ids.append(scores_cur.argmax()+b)
@@ -199,22 +208,33 @@ class ScorePredictor:
       scores = torch.cat(scores, dim=0).reshape(-1)
       return ids, scores
 
-    pose_data_iter = pose_data
-    global_ids = torch.arange(len(ob_in_cams), device='cuda', dtype=torch.long)
-    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device='cuda')
+    if ob_ids is None:
+      pose_data_iter = pose_data
+      global_ids = torch.arange(len(ob_in_cams), device=self.device, dtype=torch.long)
+      scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device=self.device)
 
-    while 1:
-      ids, scores = find_best_among_pairs(pose_data_iter)
-      if len(ids)==1:
-        scores_global[global_ids] = scores + 100
-        break
-      global_ids = global_ids[ids]
-      pose_data_iter = pose_data.select_by_indices(global_ids)
+      while 1:
+        ids, scores = find_best_among_pairs(pose_data_iter)
+        if len(ids)==1:
+          scores_global[global_ids] = scores + 100
+          break
+        global_ids = global_ids[ids]
+        pose_data_iter = pose_data.select_by_indices(global_ids)
 
-    scores = scores_global
+      scores = scores_global
+    else:
+      A = torch.cat([pose_data.rgbAs.to(self.device), pose_data.xyz_mapAs.to(self.device)], dim=1).float()
+      B = torch.cat([pose_data.rgbBs.to(self.device), pose_data.xyz_mapBs.to(self.device)], dim=1).float()
+      if pose_data.normalAs is not None:
+        A = torch.cat([A, pose_data.normalAs.to(self.device).float()], dim=1)
+        B = torch.cat([B, pose_data.normalBs.to(self.device).float()], dim=1)
+      with stage_profiler.stage('forward'), torch.autocast(device_type=self.device.type, enabled=self.amp):
+        output = self.model.forward_groups(A, B, group_ids=ob_ids)
+      scores = output["score_logit"].float().reshape(-1) + 100
 
     logging.info(f'forward done')
-    torch.cuda.empty_cache()
+    if self.device.type=='cuda':
+      torch.cuda.empty_cache()
 
     if get_vis:
       logging.info("get_vis...")
@@ -14,56 +14,160 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 #include <pybind11/eigen.h>
+#include <array>
+#include <unordered_map>
 
 namespace py = pybind11;
 
 
 
+namespace
+{
+
+using QuatCell = std::array<int,4>;
+
+struct QuatCellHash
+{
+  size_t operator()(const QuatCell &cell) const
+  {
+    size_t h = 0;
+    for (int d=0;d<4;d++)
+    {
+      h = h*1000003u ^ std::hash<int>()(cell[d]);
+    }
+    return h;
+  }
+};
+
+inline Eigen::Vector4f toHemisphereQuat(const Eigen::Matrix3f &R)
+{
+  Eigen::Quaternionf q(R);
+  q.normalize();
+  Eigen::Vector4f v(q.w(), q.x(), q.y(), q.z());
+  if (v(0)<0) v = -v;
+  return v;
+}
+
+inline QuatCell toCell(const Eigen::Vector4f &q, float cell_size)
+{
+  QuatCell cell;
+  for (int d=0;d<4;d++)
+  {
+    cell[d] = static_cast<int>(std::floor((q(d)+1.0f)/cell_size));
+  }
+  return cell;
+}
+
+} // namespace
+
+
+
 //@angle_diff: unit is degree
 //@dist_diff: unit is meter
+//Kept clusters are bucketed by their quaternion on a 4D grid whose cell is the chord length of the angle threshold,
+//so each candidate is only compared against clusters in the 3^4 neighboring cells of its symmetric variants.
 vectorMatrix4f cluster_poses(float angle_diff, float dist_diff, const vectorMatrix4f &poses_in, const vectorMatrix4f &symmetry_tfs)
 {
-  printf("num original candidates = %d\n",poses_in.size());
   vectorMatrix4f poses_out;
-  poses_out.push_back(poses_in[0]);
+  if (poses_in.empty()) return poses_out;
 
   const float radian_thres = angle_diff/180.0*M_PI;
+  const float half_angle = std::min(radian_thres/2.0f+1e-3f, float(M_PI/2));  // Margin against the exact test below
+  const float cell_size = std::max(std::sqrt(2.0f-2.0f*std::cos(half_angle)), 1e-3f);
 
+  std::unordered_map<QuatCell, std::vector<int>, QuatCellHash> buckets;
+  std::vector<int> visited_stamp;
+  auto add_cluster = [&](const Eigen::Matrix4f &pose)
+  {
+    const int id = poses_out.size();
+    poses_out.push_back(pose);
+    visited_stamp.push_back(-1);
+    buckets[toCell(toHemisphereQuat(pose.block<3,3>(0,0)), cell_size)].push_back(id);
+  };
+  add_cluster(poses_in[0]);
+
+  const int max_linear_scan = 64;   // Few clusters: the bucket lookup costs more than comparing against all of them
   for (int i=1;i<poses_in.size();i++)
   {
+    const Eigen::Matrix4f &cur_pose = poses_in[i];
+    const Eigen::Vector3f t1 = cur_pose.block(0,3,3,1);
     bool isnew = true;
-    Eigen::Matrix4f cur_pose = poses_in[i];
-    for (const auto &cluster:poses_out)
+    if (poses_out.size()<=max_linear_scan)
     {
-      Eigen::Vector3f t0 = cluster.block(0,3,3,1);
-      Eigen::Vector3f t1 = cur_pose.block(0,3,3,1);
-
-      if ((t0-t1).norm()>=dist_diff)
+      for (const auto &cluster:poses_out)
       {
-        continue;
+        Eigen::Vector3f t0 = cluster.block(0,3,3,1);
+        if ((t0-t1).norm()>=dist_diff)
+        {
+          continue;
+        }
+        for (const auto &tf: symmetry_tfs)
+        {
+          Eigen::Matrix4f cur_pose_tmp = cur_pose*tf;
+          float rot_diff = Utils::rotationGeodesicDistance(cur_pose_tmp.block(0,0,3,3), cluster.block(0,0,3,3));
+          if (rot_diff < radian_thres)
+          {
+            isnew = false;
+            break;
+          }
+        }
+        if (!isnew) break;
+      }
+      if (isnew)
+      {
+        add_cluster(poses_in[i]);
       }
+      continue;
+    }
 
-      for (const auto &tf: symmetry_tfs)
+    for (int s=0;s<symmetry_tfs.size() && isnew;s++)
+    {
+      const Eigen::Matrix4f cur_pose_tmp = cur_pose*symmetry_tfs[s];
+      const Eigen::Matrix3f R1 = cur_pose_tmp.block(0,0,3,3);
+      const Eigen::Vector4f q = toHemisphereQuat(R1);
+      const QuatCell center = toCell(q, cell_size);
+      const int n_sign = q(0)<cell_size? 2:1;   // Near the w=0 boundary, -q may land in another cell
+      for (int sign=0;sign<n_sign && isnew;sign++)
       {
-        Eigen::Matrix4f cur_pose_tmp = cur_pose*tf;
-        float rot_diff = Utils::rotationGeodesicDistance(cur_pose_tmp.block(0,0,3,3), cluster.block(0,0,3,3));
-        if (rot_diff < radian_thres)
+        const QuatCell c0 = sign==0? center : toCell(-q, cell_size);
+        for (int o=0;o<81 && isnew;o++)
         {
-          isnew = false;
-          break;
+          QuatCell cell = c0;
+          int code = o;
+          for (int d=0;d<4;d++)
+          {
+            cell[d] += code%3-1;
+            code /= 3;
+          }
+          auto it = buckets.find(cell);
+          if (it==buckets.end()) continue;
+          for (const int id:it->second)
+          {
+            if (visited_stamp[id]==i*int(symmetry_tfs.size())+s) continue;
+            visited_stamp[id] = i*int(symmetry_tfs.size())+s;
+            const Eigen::Matrix4f &cluster = poses_out[id];
+            const Eigen::Vector3f t0 = cluster.block(0,3,3,1);
+            if ((t0-t1).norm()>=dist_diff)
+            {
+              continue;
+            }
+            float rot_diff = Utils::rotationGeodesicDistance(R1, cluster.block(0,0,3,3));
+            if (rot_diff < radian_thres)
+            {
+              isnew = false;
+              break;
+            }
+          }
         }
       }
-
-      if (!isnew) break;
     }
 
     if (isnew)
     {
-      poses_out.push_back(poses_in[i]);
+      add_cluster(poses_in[i]);
     }
   }
 
-  printf("num of pose after clustering: %d\n",poses_out.size());
   return poses_out;
 }
 
@@ -3,7 +3,16 @@ import shutil
 import subprocess
 import time
 import json
+import select
+import struct
+import ctypes
+import ctypes.util
+import queue
+import threading
 from datetime import datetime
+from multiprocessing.connection import Client
+
+from pose_stream import indexed_address
 
 
 # 源文件目录（所有文件放在同一个文件夹）
@@ -12,8 +21,10 @@ OUTPUT_DIR = os.path.join(BASE_DIR, "outputs")
 
 # 已处理文件归档目录
 PROCESSED_DIR = os.path.join(BASE_DIR, "processed")
+# 处理失败的文件移到这里，方便排查，不会被当作新文件再处理
+FAILED_DIR = os.path.join(PROCESSED_DIR, "failed")
 
-# demodebug.py 读取的固定路径（目标目录基路径）
+# 各物体的 mesh 所在目录（demo_data/module_<对象名>/mesh/<对象名>.obj）
 DEMO_DATA_BASE = "/home/wyf/Projects/FoundationPose/demo_data"
 
 # 相机参数文件目录
@@ -23,9 +34,26 @@ CAM_K_DIR = "/home/wyf/Projects/FoundationPose/demo_data/cam_K"
 CONFIG_FILE = "/home/wyf/Projects/FoundationPose/configs/mydemo.json"
 
 # 监听配置
-CHECK_INTERVAL = 5  # 每5秒检查一次
+POLL_INTERVAL = 0.2  # inotify 不可用时的轮询间隔（秒）
+MASK_SETTLE = 0.3  # 多实例 mask 最后一个到达后再等这么久（秒）才派发
 running = True  # 控制循环
 
+# 常驻位姿估计进程（pose_worker.py），模型只加载一次
+# 多个进程共用一块 GPU，每个进程常驻 scorer/refiner 和自己负责的物体，显存够用时才加大 NUM_WORKERS
+WORKER_SCRIPT = "/home/wyf/Projects/FoundationPose/pose_worker.py"
+NUM_WORKERS = 2
+WORKER_ADDRESSES = [f"/tmp/foundationpose_worker_{i}.sock" for i in range(NUM_WORKERS)]
+WORKER_ADDRESS = WORKER_ADDRESSES[0]
+# 二进制位姿流（见 pose_stream.py），'host:port'、Unix socket 路径或 shm://name，None 时不推送
+# 每个常驻进程要用自己的地址（同一地址第二个进程会 bind 失败，shm 还会删掉前一个进程的 ring），按序号从这个地址派生
+POSE_STREAM_ADDRESS = "/tmp/foundationpose_pose_stream.sock"
+WORKER_POSE_STREAMS = {address: indexed_address(POSE_STREAM_ADDRESS, i) if POSE_STREAM_ADDRESS else None
+                       for i, address in enumerate(WORKER_ADDRESSES)}
+WORKER_AUTHKEY = b"foundationpose"
+WORKER_START_TIMEOUT = 300  # 等待模型加载完成
+JOB_TIMEOUT = 300
+worker_processes = {}  # address -> Popen，由本进程启动的常驻进程
+
 
 def parse_filename(filename):
     """解析文件名，提取相机型号和对象名
@@ -48,257 +76,326 @@ def parse_filename(filename):
     return file_type, camera_model, object_name
 
 
-def get_files_info():
-    """获取BASE_DIR中的文件信息
-    返回：(camera_model, object_name, rgb_file, mask_file, depth_file) 或 None
+class InotifyWatcher:
+    """用 inotify 监听目录，只在文件写完关闭（IN_CLOSE_WRITE）或被移动进来（IN_MOVED_TO）时报告，
+    不会拿到写了一半的 PNG。通过 ctypes 调用 libc，不依赖第三方包
     """
-    if not os.path.exists(BASE_DIR):
-        return None
-    
-    files = [f for f in os.listdir(BASE_DIR) if f.endswith('.png')]
-    
-    if len(files) < 3:
-        return None
-    
-    rgb_file = None
-    mask_file = None
-    depth_file = None
-    camera_model = None
-    object_name = None
-    
-    for filename in files:
-        file_type, cam_model, obj_name = parse_filename(filename)
-        
-        if file_type == 'color':
-            rgb_file = os.path.join(BASE_DIR, filename)
-            camera_model = cam_model
-            object_name = obj_name
-        elif file_type == 'mask':
-            mask_file = os.path.join(BASE_DIR, filename)
-        elif file_type == 'depth':
-            depth_file = os.path.join(BASE_DIR, filename)
-    
-    # 检查是否三个文件都找到了
-    if all([rgb_file, mask_file, depth_file, camera_model, object_name]):
-        return camera_model, object_name, rgb_file, mask_file, depth_file
-    
-    return None
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.directory = directory
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        if libc.inotify_add_watch(self.fd, directory.encode(), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch 失败: {directory}")
+
+    def wait(self, timeout):
+        """等待最多 timeout 秒，返回写完的文件名列表"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        names = []
+        i = 0
+        while i < len(data):
+            _, _, _, length = struct.unpack_from('iIII', data, i)   # wd, mask, cookie, len
+            name = data[i+16:i+16+length].rstrip(b'\0').decode()
+            i += 16+length
+            if name:
+                names.append(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """inotify 不可用时（非 Linux、网络文件系统）的退路：每 interval 秒扫描一次，
+    文件大小和修改时间连续两次扫描不变才算写完
+    """
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.last_stat = {}   # name -> (size, mtime)，上次扫描
+        self.reported = {}    # name -> (size, mtime)，已报告过的版本
+
+    def wait(self, timeout):
+        time.sleep(min(self.interval, timeout))
+        stats = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    stats[entry.name] = (st.st_size, st.st_mtime)
+        names = []
+        for name, stat in stats.items():
+            if stat[0] > 0 and self.last_stat.get(name) == stat and self.reported.get(name) != stat:
+                self.reported[name] = stat
+                names.append(name)
+        self.reported = {name: stat for name, stat in self.reported.items() if name in stats}   # 被归档的文件再出现时重新报告
+        self.last_stat = stats
+        return names
+
+    def close(self):
+        pass
+
+
+def make_watcher(directory):
+    """优先 inotify，失败时退回轮询"""
+    try:
+        watcher = InotifyWatcher(directory)
+        print(f"  监听方式: inotify")
+    except (OSError, AttributeError) as e:
+        watcher = PollingWatcher(directory)
+        print(f"  监听方式: 轮询（每{POLL_INTERVAL}秒），inotify 不可用: {e}")
+    return watcher
 
 
-def is_base_dir_ready():
-    """检查BASE_DIR是否有待处理的文件（三张图都齐全）"""
-    files_info = get_files_info()
-    return files_info is not None
+class TripletCollector:
+    """按 (camera_model, object_name) 收集 color/mask/depth，三类都到齐时产出一个任务
 
+    mask 可以是多实例的 mask_<相机型号>_<对象名>_<序号>.png，同一物体的多个实例合成一个任务。
+    这种情况下最后一个文件到达 settle 秒后才算齐，免得还在写的实例被拆成两个任务
+    """
+    def __init__(self, settle=MASK_SETTLE):
+        self.settle = settle
+        self.files = {}     # (file_type, camera_model, 文件名中的对象名) -> path
+        self.updated = {}   # (camera_model, 文件名中的对象名) -> 最后一个文件到达的时间
+        self.n_ready = 0    # 已到齐的组数，作为 frame_id
+
+    def add(self, filename):
+        file_type, camera_model, object_name = parse_filename(filename)
+        if file_type not in ('color', 'mask', 'depth'):
+            return
+        self.files[(file_type, camera_model, object_name)] = os.path.join(BASE_DIR, filename)
+        self.updated[(camera_model, object_name)] = time.time()
+
+    def instance_masks(self, camera_model, object_name):
+        """Returns: {序号: path}，mask_<相机型号>_<对象名>_<序号>.png"""
+        masks = {}
+        for (file_type, camera, name), path in self.files.items():
+            suffix = name[len(object_name)+1:]
+            if (file_type == 'mask' and camera == camera_model and name.startswith(object_name + '_') and suffix.isdigit()
+                    and ('color', camera, name) not in self.files):   # 另一个物体名恰好以 _<数字> 结尾
+                masks[int(suffix)] = path
+        return masks
+
+    def pop_ready(self):
+        """
+        Returns:
+            list of dict(camera_model, object_name, rgb_file, depth_file, mask_files, drop_time, frame_id)
+            drop_time 是这一组文件中最晚写完的修改时间，即这一组到齐的时刻
+            frame_id 是到齐的第几组，随推送的位姿发送，在所有常驻进程之间不重复
+        """
+        now = time.time()
+        ready = []
+        for (file_type, camera_model, object_name) in list(self.files.keys()):
+            if file_type != 'color' or ('depth', camera_model, object_name) not in self.files:
+                continue
+            plain = self.files.get(('mask', camera_model, object_name))
+            instances = self.instance_masks(camera_model, object_name)
+            if plain is None and not instances:
+                continue
+            if instances:
+                names = [object_name] + [f"{object_name}_{i}" for i in instances]
+                if now - max(self.updated.get((camera_model, name), 0) for name in names) < self.settle:
+                    continue
+            mask_files = ([plain] if plain else []) + [instances[i] for i in sorted(instances)]
+            files_info = {
+                'camera_model': camera_model,
+                'object_name': object_name,
+                'rgb_file': self.files.pop(('color', camera_model, object_name)),
+                'depth_file': self.files.pop(('depth', camera_model, object_name)),
+                'mask_files': mask_files,
+            }
+            self.files.pop(('mask', camera_model, object_name), None)
+            for i in instances:
+                self.files.pop(('mask', camera_model, f"{object_name}_{i}"))
+                self.updated.pop((camera_model, f"{object_name}_{i}"), None)
+            self.updated.pop((camera_model, object_name), None)
+            paths = [files_info['rgb_file'], files_info['depth_file']] + mask_files
+            if not all(os.path.exists(path) for path in paths):
+                continue
+            files_info['drop_time'] = max(os.path.getmtime(path) for path in paths)
+            self.n_ready += 1
+            files_info['frame_id'] = self.n_ready
+            ready.append(files_info)
+        return ready
+
+    def wait_time(self, default):
+        """有多实例任务在等 settle 时，监听只等到它可以派发"""
+        now = time.time()
+        remaining = [self.settle - (now - updated) for updated in self.updated.values() if now - updated < self.settle]
+        return max(0.01, min(remaining + [default]))
+
+
+def read_run_settings():
+    """从配置文件读取迭代次数和 debug 等级（只读，不再按对象改写配置文件）
 
-def copy_camera_params(camera_model, target_dir):
-    """根据相机型号复制对应的相机参数文件
-    
-    Args:
-        camera_model: 相机型号 (d435 或 d435i)
-        target_dir: 目标目录路径
+    Returns:
+        dict: {'est_refine_iter', 'debug'}
     """
-    # 源相机参数文件
-    src_cam_k = os.path.join(CAM_K_DIR, f"{camera_model}.txt")
-    
-    # 目标相机参数文件
-    dst_cam_k = os.path.join(target_dir, "cam_K.txt")
-    
-    if not os.path.exists(src_cam_k):
-        print(f"[WARNING] 相机参数文件不存在: {src_cam_k}")
-        return False
-    
+    settings = {'est_refine_iter': 10, 'debug': 2}
     try:
-        shutil.copy2(src_cam_k, dst_cam_k)
-        print(f"  ✓ 相机参数: {camera_model}.txt -> cam_K.txt")
-        return True
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        settings.update({k: config[k] for k in settings if k in config})
     except Exception as e:
-        print(f"[ERROR] 复制相机参数失败: {e}")
-        return False
+        print(f"[WARNING] 读取配置文件失败，使用默认设置: {e}")
+    return settings
 
 
-def update_config_file(object_name):
-    """更新配置文件中的object_name
-    
-    Args:
-        object_name: 对象名称（如：needle_box_base）
-    
+def submit_job(job, timeout=JOB_TIMEOUT, address=WORKER_ADDRESS):
+    """把任务发给常驻进程并等待结果
+
+    Returns:
+        dict: {'ok', 'pose', 'timings', 'error'}
+    """
+    with Client(address, family='AF_UNIX', authkey=WORKER_AUTHKEY) as conn:
+        conn.send(job)
+        if not conn.poll(timeout):
+            return {'ok': False, 'error': f'超时（超过{timeout}秒）'}
+        return conn.recv()
+
+
+def start_worker(address=WORKER_ADDRESS):
+    """没有在运行时启动常驻进程，不等它加载完模型
+
     Returns:
-        bool: 更新是否成功
+        bool: 是否已经就绪
     """
     try:
-        # 读取现有配置
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-        
-        # 更新所有包含对象名的路径
-        config['mesh_file'] = f"/home/wyf/Projects/FoundationPose/demo_data/module_{object_name}/mesh/{object_name}.obj"
-        config['test_scene_dir'] = f"/home/wyf/Projects/FoundationPose/demo_data/module_{object_name}"
-        config['debug_dir'] = f"debug/{object_name}"
-        
-        # 写回配置文件
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
-        
-        print(f"  ✓ 配置文件已更新:")
-        print(f"    - mesh_file: module_{object_name}/mesh/{object_name}.obj")
-        print(f"    - test_scene_dir: module_{object_name}")
-        print(f"    - debug_dir: debug/{object_name}")
-        
+        return submit_job({'cmd': 'ping'}, timeout=10, address=address)['ok']
+    except (FileNotFoundError, ConnectionRefusedError, EOFError):
+        pass
+
+    process = worker_processes.get(address)
+    if process is None or process.poll() is not None:
+        print(f"启动常驻位姿估计进程: {WORKER_SCRIPT} ({address})")
+        cmd = ["python3", WORKER_SCRIPT, "--address", address]
+        if WORKER_POSE_STREAMS.get(address):
+            cmd += ["--pose_stream", WORKER_POSE_STREAMS[address]]
+        worker_processes[address] = subprocess.Popen(cmd)
+    return False
+
+
+def ensure_worker(address=WORKER_ADDRESS):
+    """确认常驻进程在运行，没有时启动并等待它加载完模型
+
+    Returns:
+        bool: 是否就绪
+    """
+    if start_worker(address):
         return True
-        
-    except FileNotFoundError:
-        print(f"[ERROR] 配置文件不存在: {CONFIG_FILE}")
-        return False
-    except json.JSONDecodeError as e:
-        print(f"[ERROR] 配置文件JSON格式错误: {e}")
-        return False
-    except Exception as e:
-        print(f"[ERROR] 更新配置文件失败: {e}")
-        return False
 
+    process = worker_processes[address]
+    begin = time.time()
+    while time.time()-begin < WORKER_START_TIMEOUT:
+        if process.poll() is not None:
+            print(f"[ERROR] 常驻进程退出，返回码: {process.returncode}")
+            return False
+        try:
+            if submit_job({'cmd': 'ping'}, timeout=10, address=address)['ok']:
+                print(f"  ✓ 常驻进程就绪（{address}，{time.time()-begin:.1f}秒）")
+                return True
+        except (FileNotFoundError, ConnectionRefusedError, EOFError):
+            time.sleep(0.5)
+    print(f"[ERROR] 常驻进程 {WORKER_START_TIMEOUT} 秒内未就绪")
+    return False
+
+
+def stop_worker():
+    """关闭由本进程启动的常驻进程"""
+    for address, process in worker_processes.items():
+        if process.poll() is not None:
+            continue
+        try:
+            submit_job({'cmd': 'shutdown'}, timeout=10, address=address)
+            process.wait(timeout=10)
+        except Exception:
+            process.kill()
+
+
+def process_batch(files_info, address=WORKER_ADDRESS):
+    """处理一组文件，多个 mask 时同一物体的多个实例一起 register
 
-def process_batch():
-    """处理一批文件"""
-    
-    # 获取文件信息
-    files_info = get_files_info()
-    
-    if files_info is None:
-        print("[ERROR] 文件不完整或无法识别")
-        return
-    
-    camera_model, object_name, rgb_file, mask_file, depth_file = files_info
-    
-    print("="*70)
-    print(f"开始处理图像...")
-    print(f"  相机型号: {camera_model}")
-    print(f"  对象名称: {object_name}")
-    print(f"  源目录: {BASE_DIR}")
-    print("="*70)
-    
-    # 显示源文件信息
-    print(f"\n源文件:")
-    print(f"  RGB:   {os.path.basename(rgb_file)}")
-    print(f"  Mask:  {os.path.basename(mask_file)}")
-    print(f"  Depth: {os.path.basename(depth_file)}")
-    
-    # 构建目标目录 (只用对象名，不含相机型号)
-    DEMO_DATA_DIR = os.path.join(DEMO_DATA_BASE, f"module_{object_name}")
-    FIXED_RGB = os.path.join(DEMO_DATA_DIR, "rgb", "new.png")
-    FIXED_MASK = os.path.join(DEMO_DATA_DIR, "masks", "new.png")
-    FIXED_DEPTH = os.path.join(DEMO_DATA_DIR, "depth", "new.png")
-    
-    print(f"\n目标目录: {DEMO_DATA_DIR}")
+    Args:
+        files_info: TripletCollector.pop_ready 返回的 dict
+        address: 处理它的常驻进程
+    Returns:
+        bool: 是否成功
+    """
+    camera_model = files_info['camera_model']
+    object_name = files_info['object_name']
+    mask_files = files_info['mask_files']
+    tag = f"{camera_model}_{object_name}"
+    
+    print(f"\n[{tag}] 开始处理 ({address})")
+    print(f"  RGB:   {os.path.basename(files_info['rgb_file'])}")
+    print(f"  Mask:  {', '.join(os.path.basename(f) for f in mask_files)}")
+    print(f"  Depth: {os.path.basename(files_info['depth_file'])}")
+    
+    cam_K_file = os.path.join(CAM_K_DIR, f"{camera_model}.txt")
+    if not os.path.exists(cam_K_file):
+        print(f"[ERROR] [{tag}] 相机参数文件不存在: {cam_K_file}")
+        return False
     
-    # 确保目标目录存在
-    os.makedirs(os.path.join(DEMO_DATA_DIR, "rgb"), exist_ok=True)
-    os.makedirs(os.path.join(DEMO_DATA_DIR, "masks"), exist_ok=True)
-    os.makedirs(os.path.join(DEMO_DATA_DIR, "depth"), exist_ok=True)
-
-    # 更新配置文件
-    print(f"\n更新配置文件...")
-    if not update_config_file(object_name):
-        print("[WARNING] 配置文件更新失败，继续处理...")
-
-    # 复制文件到固定路径
-    print(f"\n复制文件到目标路径...")
+    # 图像路径和内参直接随任务发给常驻进程，不再复制到 demo_data，也不改写 mydemo.json
+    job = {
+        'cmd': 'run',
+        'mesh_file': os.path.join(DEMO_DATA_BASE, f"module_{object_name}", "mesh", f"{object_name}.obj"),
+        'cam_K_file': cam_K_file,
+        'rgb_file': files_info['rgb_file'],
+        'depth_file': files_info['depth_file'],
+        'debug_dir': f"debug/{object_name}",
+        'frame_time': files_info['drop_time'],   # 推送的位姿从文件到齐开始计延迟
+        'frame_id': files_info.get('frame_id'),
+        **read_run_settings(),
+    }
+    if len(mask_files) > 1:
+        job['mask_files'] = mask_files
+    else:
+        job['mask_file'] = mask_files[0]
+
     try:
-        # 先删除旧文件（确保没有残留）
-        for fixed_file in [FIXED_RGB, FIXED_MASK, FIXED_DEPTH]:
-            if os.path.exists(fixed_file):
-                os.remove(fixed_file)
-        
-        # 复制新文件
-        shutil.copy2(rgb_file, FIXED_RGB)
-        shutil.copy2(mask_file, FIXED_MASK)
-        shutil.copy2(depth_file, FIXED_DEPTH)
-        
-        # 验证文件已复制
-        assert os.path.exists(FIXED_RGB), f"RGB 复制失败: {FIXED_RGB}"
-        assert os.path.exists(FIXED_MASK), f"Mask 复制失败: {FIXED_MASK}"
-        assert os.path.exists(FIXED_DEPTH), f"Depth 复制失败: {FIXED_DEPTH}"
-        
-        print(f"  ✓ RGB  -> rgb/new.png")
-        print(f"  ✓ Mask -> masks/new.png")
-        print(f"  ✓ Depth-> depth/new.png")
-        
-    except Exception as e:
-        print(f"[ERROR] 文件复制失败: {e}")
-        return
-    
-    # 复制相机参数文件
-    print(f"\n复制相机参数文件...")
-    if not copy_camera_params(camera_model, DEMO_DATA_DIR):
-        print("[WARNING] 相机参数复制失败，继续处理...")
-    
-    # 给文件系统一点时间同步
-    time.sleep(0.2)
+        if not ensure_worker(address):
+            print(f"  ✗ [{tag}] 常驻进程不可用")
+            return False
 
-    # 准备输出目录
-    out_dir = os.path.join(OUTPUT_DIR, f"{camera_model}_{object_name}")
-    os.makedirs(out_dir, exist_ok=True)
+        result = submit_job(job, address=address)
 
-    # 设置环境变量
-    env = {**os.environ, "DEBUG_DIR_OVERRIDE": out_dir}
+        if result['ok']:
+            timings = ', '.join([f"{k}={v:.2f}s" for k, v in result['timings'].items()])
+            print(f"✓ [{tag}] 处理成功，{len(mask_files)} 个实例 ({timings})，结果保存至: {job['debug_dir']}")
+            return True
+        print(f"✗ [{tag}] 运行出错")
+        print(result['error'])
 
-    print(f"\n运行 demodebug.py...")
-    print(f"  输出目录: {out_dir}")
-    
-    # 调用 demodebug.py
-    try:
-        result = subprocess.run([
-        "python3",
-        "/home/wyf/Projects/FoundationPose/demodebug.py",
-        "--config", CONFIG_FILE
-        ],
-        capture_output=True,  # 捕获 stdout 和 stderr
-        text=True,            # 以文本形式返回
-        timeout=300
-        )
-
-        if result.returncode == 0:
-            print("✓ 处理成功")
-        else:
-            print("✗ 运行出错")
-            print("----- STDOUT -----")
-            print(result.stdout)
-            print("----- STDERR -----")
-            print(result.stderr)
-
-                
-    except subprocess.TimeoutExpired:
-        print(f"  ✗ 处理超时（超过5分钟）")
     except Exception as e:
-        print(f"  ✗ 运行出错: {e}")
+        print(f"  ✗ [{tag}] 运行出错: {e}")
+    return False
 
-    print(f"\n[完成] 结果保存至: {out_dir}")
-    print("="*70)
 
-
-def archive_processed_files():
-    """将处理完的文件移动到processed目录"""
+def archive_processed_files(files_info, failed=False):
+    """将这一组处理完的文件移动到processed目录（失败的移到processed/failed），同目录下其他对象的文件不动"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    archived_dir = os.path.join(PROCESSED_DIR, timestamp)
+    archived_dir = os.path.join(FAILED_DIR if failed else PROCESSED_DIR, f"{timestamp}_{files_info['camera_model']}_{files_info['object_name']}")  # 并行的任务可能在同一秒结束
     
     print(f"\n归档处理完的文件到: {archived_dir}")
     
     try:
-        # 获取BASE_DIR下所有png文件
-        png_files = [f for f in os.listdir(BASE_DIR) 
-                     if f.endswith('.png') and os.path.isfile(os.path.join(BASE_DIR, f))]
-        
-        if not png_files:
-            print("  (无文件需要归档)")
-            return
-        
         os.makedirs(archived_dir, exist_ok=True)
         
-        # 移动所有png文件
         moved_count = 0
-        for filename in png_files:
-            src = os.path.join(BASE_DIR, filename)
-            dst = os.path.join(archived_dir, filename)
+        for src in [files_info['rgb_file'], files_info['depth_file']] + files_info['mask_files']:
+            if not os.path.exists(src):
+                continue
+            dst = os.path.join(archived_dir, os.path.basename(src))
             shutil.move(src, dst)
             moved_count += 1
         
@@ -309,48 +406,168 @@ def archive_processed_files():
         print(f"✗ 归档失败: {e}")
 
 
+class JobScheduler:
+    """把到齐的任务排队，分给多个常驻进程并行处理
+
+    同一物体总是分给同一个进程（mesh 和旋转网格在那里常驻），同一物体的任务因此串行，
+    不同物体并行。新物体分给负责物体最少、队列最短的进程
+    """
+    def __init__(self, addresses=WORKER_ADDRESSES):
+        self.addresses = addresses
+        self.queues = [queue.Queue() for _ in addresses]
+        self.affinity = {}   # object_name -> 进程序号
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latencies = {'wait': [], 'run': [], 'total': []}   # 秒，到齐->开始，开始->结束，到齐->结束
+        self.n_failed = 0
+        self.threads = [threading.Thread(target=self.worker_loop, args=(i,), daemon=True) for i in range(len(addresses))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, files_info):
+        object_name = files_info['object_name']
+        with self.lock:
+            i = self.affinity.get(object_name)
+            if i is None:
+                n_objects = [list(self.affinity.values()).count(k) for k in range(len(self.addresses))]
+                i = min(range(len(self.addresses)), key=lambda k: (n_objects[k], self.queues[k].qsize()))
+                self.affinity[object_name] = i
+        self.queues[i].put(files_info)
+        print(f"  -> 进程{i} 排队，当前队列深度: {self.queue_depth()}")
+
+    def worker_loop(self, i):
+        while True:
+            files_info = self.queues[i].get()
+            if files_info is None:
+                break
+            start = time.time()
+            with self.lock:
+                self.in_flight += 1
+            try:
+                ok = process_batch(files_info, address=self.addresses[i])
+            except Exception as e:
+                print(f"[ERROR] 任务异常: {e}")
+                ok = False
+            tag = f"{files_info['camera_model']}_{files_info['object_name']}"
+            if not ok:
+                print(f"[ERROR] [{tag}] 处理失败，输入文件移到 {FAILED_DIR}")
+            archive_processed_files(files_info, failed=not ok)
+            end = time.time()
+            with self.lock:
+                self.in_flight -= 1
+                self.n_failed += not ok
+                self.latencies['wait'].append(max(0.0, start - files_info['drop_time']))
+                self.latencies['run'].append(end - start)
+                self.latencies['total'].append(max(0.0, end - files_info['drop_time']))
+            print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {tag} {'完成' if ok else '失败'}（进程{i}），"
+                  f"排队 {self.latencies['wait'][-1]*1000:.0f}ms，处理 {self.latencies['run'][-1]*1000:.0f}ms")
+            self.print_metrics()
+
+    def queue_depth(self):
+        """排队中（还没开始）的任务数"""
+        return sum(q.qsize() for q in self.queues)
+
+    def metrics(self):
+        """
+        Returns:
+            dict: 队列深度、处理中/完成/失败的任务数，以及各段延迟的 p50/max（毫秒）
+        """
+        with self.lock:
+            out = {
+                'queue_depth': self.queue_depth(),
+                'queue_depth_per_worker': [q.qsize() for q in self.queues],
+                'in_flight': self.in_flight,
+                'done': len(self.latencies['run']),
+                'failed': self.n_failed,
+            }
+            for name, values in self.latencies.items():
+                if values:
+                    values = sorted(values)
+                    out[f'{name}_p50_ms'] = values[len(values)//2] * 1000
+                    out[f'{name}_max_ms'] = values[-1] * 1000
+        return out
+
+    def print_metrics(self):
+        m = self.metrics()
+        line = f"  队列深度={m['queue_depth']} {m['queue_depth_per_worker']}，处理中={m['in_flight']}，完成={m['done']}，失败={m['failed']}"
+        if m['done']:
+            line += (f"，到齐->开始 p50={m['wait_p50_ms']:.0f}ms max={m['wait_max_ms']:.0f}ms"
+                     f"，到齐->完成 p50={m['total_p50_ms']:.0f}ms max={m['total_max_ms']:.0f}ms")
+        print(line)
+
+    def close(self, drain=True):
+        """停止派发。drain=False 时丢弃还在排队的任务，只等正在处理的完成"""
+        if not drain:
+            dropped = 0
+            for q in self.queues:
+                while True:
+                    try:
+                        q.get_nowait()
+                        dropped += 1
+                    except queue.Empty:
+                        break
+            if dropped:
+                print(f"[WARNING] 丢弃 {dropped} 个排队中的任务")
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
 def monitor_and_process():
-    """主监听循环"""
+    """主监听循环，文件写完即触发，三件齐了立即排队，由 JobScheduler 并行处理"""
     global running
     
     print("\n" + "="*70)
     print("文件监听服务已启动")
     print(f"监听目录: {BASE_DIR}")
     print(f"配置文件: {CONFIG_FILE}")
-    print(f"检查间隔: {CHECK_INTERVAL}秒")
+    watcher = make_watcher(BASE_DIR)
     print("\n文件格式要求 (所有文件放在同一目录):")
     print("  - color_<相机型号>_<对象名>.png")
     print("  - mask_<相机型号>_<对象名>.png")
     print("  - depth_<相机型号>_<对象名>.png")
+    print("  - 多个实例时: mask_<相机型号>_<对象名>_<序号>.png")
     print("\n示例:")
     print("  - color_d435i_needle_box_base.png")
     print("  - mask_d435i_needle_box_base.png")
     print("  - depth_d435i_needle_box_base.png")
+    print("  - mask_d435i_pipette_0.png, mask_d435i_pipette_1.png")
     print("\n支持的相机型号: d435, d435i")
+    print(f"常驻进程数: {len(WORKER_ADDRESSES)}")
+    if POSE_STREAM_ADDRESS:
+        print(f"位姿流: {', '.join(WORKER_POSE_STREAMS.values())}")
     print("\n按 Ctrl+C 停止监听")
     print("="*70 + "\n")
     
+    collector = TripletCollector()
+    scheduler = JobScheduler()
+    # 启动前已经放好的文件
+    names = sorted(f for f in os.listdir(BASE_DIR) if os.path.isfile(os.path.join(BASE_DIR, f)))
+    drain = True
+    
     try:
         while running:
-            # 检查是否有文件需要处理
-            if is_base_dir_ready():
-                print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 检测到新文件，开始处理...")
-                
-                # 处理文件
-                process_batch()
-                
-                # 归档已处理的文件
-                archive_processed_files()
-                
-                print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 等待下一批文件...")
+            for name in names:
+                collector.add(name)
+            for files_info in collector.pop_ready():
+                print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {files_info['camera_model']}_{files_info['object_name']} "
+                      f"文件已齐（{len(files_info['mask_files'])} 个 mask）")
+                scheduler.submit(files_info)
             
-            time.sleep(CHECK_INTERVAL)
+            names = watcher.wait(timeout=collector.wait_time(1.0))
             
     except KeyboardInterrupt:
         print("\n\n" + "="*70)
         print("收到停止信号，正在退出...")
         print("="*70)
         running = False
+        drain = False
+    finally:
+        watcher.close()
+        scheduler.close(drain=drain)
+        scheduler.print_metrics()
+        stop_worker()
 
 
 if __name__ == "__main__":
@@ -358,6 +575,7 @@ if __name__ == "__main__":
     os.makedirs(BASE_DIR, exist_ok=True)
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     os.makedirs(PROCESSED_DIR, exist_ok=True)
+    os.makedirs(FAILED_DIR, exist_ok=True)
     
     # 检查配置文件是否存在
     if not os.path.exists(CONFIG_FILE):
@@ -370,5 +588,11 @@ if __name__ == "__main__":
         print(f"  - {CAM_K_DIR}/d435.txt")
         print(f"  - {CAM_K_DIR}/d435i.txt")
     
+    # 提前启动常驻进程，第一批文件不用等模型加载（先全部启动，再逐个等就绪）
+    for address in WORKER_ADDRESSES:
+        start_worker(address)
+    for address in WORKER_ADDRESSES:
+        ensure_worker(address)
+
     # 启动监听
     monitor_and_process()
\ No newline at end of file
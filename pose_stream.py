@@ -0,0 +1,336 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# NVIDIA CORPORATION and its licensors retain all intellectual property
+# and proprietary rights in and to this software, related documentation
+# and any modifications thereto.  Any use, reproduction, disclosure or
+# distribution of this software and related documentation without an express
+# license agreement from NVIDIA CORPORATION is strictly prohibited.
+
+
+'''Streams poses to consumers as fixed size binary messages, see FoundationPose.pose_stream
+Addresses: 'host:port' (TCP), a path (Unix socket) or 'shm://name' (shared memory ring buffer). The publisher side listens / creates the ring, subscribers attach
+python pose_stream.py --subscribe 127.0.0.1:9100        # stand-in consumer, prints each pose and its latency
+python pose_stream.py --bench shm://foundationpose --n_msgs 2000
+'''
+
+import os,time,struct,socket,select,threading,argparse,logging
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+
+########## frame time (when the frame arrived), publish time, frame id, object id, score, top 3 rows of ob_in_cam
+POSE_MSG = struct.Struct('<ddQIf12f')
+SHM_HEADER = struct.Struct('<QQ')   # messages written, capacity
+
+
+def pack_pose_msg(pose, frame_id, object_id=0, score=float('nan'), frame_time=None):
+  '''
+  @pose: (4,4) np array
+  @frame_time: time.time() when the frame arrived, default now
+  '''
+  now = time.time()
+  if frame_time is None:
+    frame_time = now
+  return POSE_MSG.pack(frame_time, now, frame_id, object_id, score, *np.asarray(pose, dtype=np.float32).reshape(4,4)[:3].reshape(-1))
+
+
+def unpack_pose_msg(buf):
+  '''
+  Return: dict of frame_time, pub_time, frame_id, object_id, score, pose (4,4)
+  '''
+  vals = POSE_MSG.unpack(buf)
+  pose = np.eye(4)
+  pose[:3] = np.asarray(vals[5:]).reshape(3,4)
+  return {'frame_time': vals[0], 'pub_time': vals[1], 'frame_id': vals[2], 'object_id': vals[3], 'score': vals[4], 'pose': pose}
+
+
+def parse_address(address):
+  if address.startswith('shm://'):
+    return 'shm', address[len('shm://'):]
+  if ':' in address and not address.startswith('/'):
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+  return socket.AF_UNIX, address
+
+
+def indexed_address(address, index):
+  '''Address of the index-th of several publishers started from one base address, since each needs its own: the port is offset for TCP, _{index} is appended to a shm name or to a Unix socket path before its extension
+  '''
+  family, addr = parse_address(address)
+  if family=='shm':
+    return f'shm://{addr}_{index}'
+  if family==socket.AF_INET:
+    return f'{addr[0]}:{addr[1]+index}'
+  root, ext = os.path.splitext(addr)
+  return f'{root}_{index}{ext}'
+
+
+class SocketPosePublisher:
+  '''Listens on a TCP or Unix socket; each message goes to every connected subscriber. A subscriber that cannot keep up or disconnected is dropped
+  '''
+  def __init__(self, address, send_timeout=0.05):
+    self.address = address
+    self.send_timeout = send_timeout
+    family, addr = parse_address(address)
+    if family==socket.AF_UNIX and os.path.exists(addr):
+      os.remove(addr)
+    self.server = socket.socket(family, socket.SOCK_STREAM)
+    if family==socket.AF_INET:
+      self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind(addr)
+    self.server.listen(8)
+    self.family = family
+    self.subscribers = []
+    self.lock = threading.Lock()
+    self.running = True
+    self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+    self.thread.start()
+    logging.info(f'pose stream listening on {address}')
+
+
+  def accept_loop(self):
+    while self.running:
+      readable, _, _ = select.select([self.server], [], [], 0.2)
+      if not readable:
+        continue
+      try:
+        conn, _ = self.server.accept()
+      except OSError:
+        break
+      conn.settimeout(self.send_timeout)
+      if self.family==socket.AF_INET:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      with self.lock:
+        self.subscribers.append(conn)
+
+
+  def send(self, msg):
+    with self.lock:
+      alive = []
+      for conn in self.subscribers:
+        try:
+          conn.sendall(msg)
+          alive.append(conn)
+        except OSError as e:
+          logging.info(f'dropping pose subscriber: {e}')
+          conn.close()
+      self.subscribers = alive
+
+
+  def close(self):
+    self.running = False
+    self.thread.join()
+    with self.lock:
+      for conn in self.subscribers:
+        conn.close()
+      self.subscribers = []
+    self.server.close()
+
+
+class ShmPosePublisher:
+  '''Ring buffer of the last capacity messages in shared memory. The writer never blocks; a subscriber that falls behind by more than capacity loses the overwritten messages
+  '''
+  def __init__(self, name, capacity=1024):
+    self.name = name
+    self.capacity = capacity
+    try:
+      shared_memory.SharedMemory(name=name).unlink()   # Left over by a crashed publisher
+    except FileNotFoundError:
+      pass
+    self.shm = shared_memory.SharedMemory(name=name, create=True, size=SHM_HEADER.size+capacity*POSE_MSG.size)
+    self.n_written = 0
+    SHM_HEADER.pack_into(self.shm.buf, 0, 0, capacity)
+
+
+  def send(self, msg):
+    offset = SHM_HEADER.size+(self.n_written%self.capacity)*POSE_MSG.size
+    self.shm.buf[offset:offset+POSE_MSG.size] = msg
+    self.n_written += 1
+    SHM_HEADER.pack_into(self.shm.buf, 0, self.n_written, self.capacity)   # Publish the slot only after it is complete
+
+
+  def close(self):
+    self.shm.close()
+    self.shm.unlink()
+
+
+class PoseStreamPublisher:
+  '''What FoundationPose.pose_stream expects: publish(pose, frame_id, object_id, score, frame_time)
+  '''
+  def __init__(self, address, **kwargs):
+    self.address = address
+    if parse_address(address)[0]=='shm':
+      self.transport = ShmPosePublisher(parse_address(address)[1], **kwargs)
+    else:
+      self.transport = SocketPosePublisher(address, **kwargs)
+    self.n_published = 0
+
+
+  def publish(self, pose, frame_id, object_id=0, score=float('nan'), frame_time=None):
+    self.transport.send(pack_pose_msg(pose, frame_id, object_id=object_id, score=score, frame_time=frame_time))
+    self.n_published += 1
+
+
+  def close(self):
+    self.transport.close()
+
+
+
+class PoseStreamSubscriber:
+  '''Local stand-in for a robot side consumer. recv() returns the unpacked message with recv_time added, or None on timeout
+  '''
+  def __init__(self, address, connect_timeout=10):
+    self.address = address
+    family, addr = parse_address(address)
+    self.family = family
+    if family=='shm':
+      begin = time.time()
+      while True:
+        try:
+          self.shm = shared_memory.SharedMemory(name=addr)
+          resource_tracker.unregister(self.shm._name, 'shared_memory')   # Attached, not owned: the publisher unlinks it
+          break
+        except FileNotFoundError:
+          if time.time()-begin>connect_timeout:
+            raise
+          time.sleep(0.05)
+      self.n_read, self.capacity = SHM_HEADER.unpack_from(self.shm.buf, 0)   # Only messages from now on
+      self.n_lost = 0
+    else:
+      begin = time.time()
+      while True:
+        try:
+          self.sock = socket.socket(family, socket.SOCK_STREAM)
+          self.sock.connect(addr)
+          break
+        except (FileNotFoundError, ConnectionRefusedError):
+          self.sock.close()
+          if time.time()-begin>connect_timeout:
+            raise
+          time.sleep(0.05)
+      self.buf = b''
+
+
+  def recv(self, timeout=1.0):
+    if self.family=='shm':
+      return self.recv_shm(timeout)
+    deadline = time.time()+timeout
+    while len(self.buf)<POSE_MSG.size:
+      readable, _, _ = select.select([self.sock], [], [], max(0, deadline-time.time()))
+      if not readable:
+        return None
+      data = self.sock.recv(65536)
+      if not data:
+        raise ConnectionError('pose stream closed')
+      self.buf += data
+    msg = unpack_pose_msg(self.buf[:POSE_MSG.size])
+    self.buf = self.buf[POSE_MSG.size:]
+    msg['recv_time'] = time.time()
+    return msg
+
+
+  def recv_shm(self, timeout, poll_interval=1e-4):
+    deadline = time.time()+timeout
+    while True:
+      n_written = SHM_HEADER.unpack_from(self.shm.buf, 0)[0]
+      if n_written>self.n_read:
+        break
+      if time.time()>deadline:
+        return None
+      time.sleep(poll_interval)
+    if n_written-self.n_read>self.capacity:
+      self.n_lost += n_written-self.capacity-self.n_read
+      self.n_read = n_written-self.capacity
+    offset = SHM_HEADER.size+(self.n_read%self.capacity)*POSE_MSG.size
+    buf = bytes(self.shm.buf[offset:offset+POSE_MSG.size])
+    if SHM_HEADER.unpack_from(self.shm.buf, 0)[0]-self.n_read>self.capacity:   # Overwritten while copying
+      return self.recv_shm(max(0, deadline-time.time()), poll_interval)
+    self.n_read += 1
+    msg = unpack_pose_msg(buf)
+    msg['recv_time'] = time.time()
+    return msg
+
+
+  def close(self):
+    if self.family=='shm':
+      self.shm.close()
+    else:
+      self.sock.close()
+
+
+
+def latency_stats(msgs):
+  '''
+  @msgs: outputs of PoseStreamSubscriber.recv
+  Return: dict of frame_to_delivery (frame arrival -> received, includes the estimation) and transport (published -> received) percentiles in ms
+  '''
+  out = {'n_msgs': len(msgs)}
+  for name, begin_key in [('frame_to_delivery', 'frame_time'), ('transport', 'pub_time')]:
+    lat = np.asarray([msg['recv_time']-msg[begin_key] for msg in msgs])*1000
+    if len(lat)>0:
+      out[f'{name}_p50_ms'] = float(np.percentile(lat, 50))
+      out[f'{name}_p99_ms'] = float(np.percentile(lat, 99))
+      out[f'{name}_max_ms'] = float(lat.max())
+  return out
+
+
+def run_subscriber(address, n_msgs=None, verbose=True):
+  sub = PoseStreamSubscriber(address)
+  msgs = []
+  try:
+    while n_msgs is None or len(msgs)<n_msgs:
+      msg = sub.recv(timeout=5.0)
+      if msg is None:
+        if n_msgs is not None:
+          break
+        continue
+      msgs.append(msg)
+      if verbose:
+        logging.info(f"frame {msg['frame_id']} object {msg['object_id']} score {msg['score']:.3f} t {msg['pose'][:3,3]} frame->delivery {(msg['recv_time']-msg['frame_time'])*1000:.2f}ms transport {(msg['recv_time']-msg['pub_time'])*1000:.3f}ms")
+  except KeyboardInterrupt:
+    pass
+  finally:
+    sub.close()
+  return latency_stats(msgs)
+
+
+def bench_subscriber(address, n_msgs, conn):
+  conn.send(run_subscriber(address, n_msgs=n_msgs, verbose=False))
+
+
+def bench(address, n_msgs=2000, rate=1000):
+  '''Publisher here, stand-in subscriber in a child process, n_msgs poses at the given rate (Hz)
+  '''
+  import multiprocessing
+  pub = PoseStreamPublisher(address)
+  parent_conn, child_conn = multiprocessing.Pipe()
+  proc = multiprocessing.Process(target=bench_subscriber, args=(address, n_msgs, child_conn))
+  proc.start()
+  if parse_address(address)[0]!='shm':
+    while len(pub.transport.subscribers)==0:
+      time.sleep(0.01)
+  else:
+    time.sleep(0.5)
+  pose = np.eye(4)
+  for i in range(n_msgs):
+    pub.publish(pose, frame_id=i, score=1.0)
+    time.sleep(1.0/rate)
+  stats = parent_conn.recv()
+  proc.join()
+  pub.close()
+  return stats
+
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--subscribe', type=str, default=None, help="address to receive from, 'host:port', a Unix socket path or shm://name")
+  parser.add_argument('--bench', type=str, default=None, help='measure transport latency over this address')
+  parser.add_argument('--n_msgs', type=int, default=2000)
+  parser.add_argument('--rate', type=float, default=1000)
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO, format='[%(funcName)s()] %(message)s')   # Same as Utils.set_logging_format, without importing torch on the consumer side
+  if args.subscribe is not None:
+    logging.info(run_subscriber(args.subscribe))
+  elif args.bench is not None:
+    logging.info(bench(args.bench, n_msgs=args.n_msgs, rate=args.rate))
@@ -0,0 +1,196 @@
+"""常驻的位姿估计进程
+
+scorer、refiner 和 RasterizeCudaContext 只在启动时加载一次，每个物体的 FoundationPose（mesh、旋转网格）加载后常驻，
+pipeline.py 通过本地 socket 提交任务，每次处理只剩推理的开销，不再需要为每批文件重新启动 demodebug.py。
+
+启动：python3 pose_worker.py
+任务：dict，由 pipeline.submit_job 发送，返回 {'ok', 'pose', 'timings', 'error'}
+      {'cmd': 'run', 'mesh_file', 'K' 或 'cam_K_file', 'rgb'/'depth'/'mask' 数组或 'rgb_file'/'depth_file'/'mask_file',
+       'debug_dir', 可选 'est_refine_iter', 'debug', 'send', 'frame_time', 'frame_id'} 单帧 register，图像直接解码，不经过 demo_data 目录
+       用 'masks' / 'mask_files' 列表代替单个 mask 时，同一物体的多个实例一次 register_many，'pose' 为列表
+      {'cmd': 'run', 'config': mydemo.json 路径} 按配置跑整个 test_scene_dir（与 demodebug.py 相同）
+      {'cmd': 'ping'} 检查是否就绪，{'cmd': 'shutdown'} 退出
+"""
+import os
+import argparse
+import json
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.connection import Listener
+
+from demodebug import *   # 先于 torch 设置 CUDA_VISIBLE_DEVICES
+from pipeline import WORKER_ADDRESS, WORKER_AUTHKEY
+from result_publisher import ResultPublisher, ROBOT_POSE_ADDRESS
+from pose_stream import PoseStreamPublisher
+
+
+class PoseWorker:
+    def __init__(self, max_objects=4, pose_address=ROBOT_POSE_ADDRESS, pose_stream=None):
+        """
+        Args:
+            max_objects: 常驻的物体数，超过时丢弃最久未使用的
+            pose_address: 机器人端的位姿 socket，None 时只通过 SCP 上传
+            pose_stream: 设置时每个 register/track_one 的位姿以二进制消息推送到这里（见 pose_stream.py），
+                         object_id 是物体在本进程里的编号，frame_time 和 frame_id 取自任务（图像到达时间和帧号）
+                         多个常驻进程各用自己的地址，见 pipeline.WORKER_POSE_STREAMS
+        """
+        begin = time.time()
+        self.scorer = ScorePredictor()
+        self.refiner = PoseRefinePredictor()
+        self.glctx = dr.RasterizeCudaContext()
+        self.max_objects = max_objects
+        self.objects = OrderedDict()   # mesh_file -> dict(est, mesh, to_origin, bbox)
+        self.publisher = ResultPublisher(pose_address=pose_address)   # SSH 连接常驻，上传在后台
+        self.pose_stream = PoseStreamPublisher(pose_stream) if pose_stream else None
+        self.object_ids = {}   # mesh_file -> 推送位姿用的物体编号，被换出后再加载也不变
+        logging.info(f"networks loaded in {time.time()-begin:.1f}s")
+
+
+    def get_object(self, mesh_file, debug, debug_dir):
+        """取出常驻的 estimator，没有时加载 mesh 新建一个，scorer/refiner/glctx 共用"""
+        os.makedirs(debug_dir, exist_ok=True)
+        if mesh_file in self.objects:
+            self.objects.move_to_end(mesh_file)
+            ob = self.objects[mesh_file]
+            ob['est'].debug = debug
+            ob['est'].debug_dir = debug_dir
+            return ob
+
+        mesh, to_origin, bbox = load_mesh(mesh_file)
+        est = FoundationPose(
+            model_pts=mesh.vertices,
+            model_normals=mesh.vertex_normals,
+            mesh=mesh,
+            scorer=self.scorer,
+            refiner=self.refiner,
+            debug_dir=debug_dir,
+            debug=debug,
+            glctx=self.glctx
+        )
+        est.pose_stream = self.pose_stream
+        self.object_ids.setdefault(mesh_file, len(self.object_ids))
+        self.objects[mesh_file] = {'est': est, 'mesh': mesh, 'to_origin': to_origin, 'bbox': bbox}
+        while len(self.objects) > self.max_objects:
+            self.objects.popitem(last=False)
+        logging.info(f"loaded {mesh_file}, {len(self.objects)} objects resident")
+        return self.objects[mesh_file]
+
+
+    def run_frame_job(self, job):
+        """单帧任务：图像和内参随任务传入，不读写 demo_data 和 mydemo.json"""
+        timings = {}
+        begin = time.time()
+        if 'rgb' in job:
+            color, depth = job['rgb'], job['depth']
+            masks = [m.astype(bool) for m in job['masks']] if 'masks' in job else [job['mask'].astype(bool)]
+        else:
+            mask_files = job['mask_files'] if 'mask_files' in job else [job['mask_file']]
+            color, depth, mask = load_frame(job['rgb_file'], job['depth_file'], mask_files[0])
+            masks = [mask] + [load_mask(f) for f in mask_files[1:]]
+        K = np.asarray(job['K']).reshape(3, 3) if 'K' in job else np.loadtxt(job['cam_K_file']).reshape(3, 3)
+        timings['decode_s'] = time.time()-begin
+
+        begin = time.time()
+        cfg = {'est_refine_iter': job.get('est_refine_iter', 10), 'debug': job.get('debug', 2)}
+        set_seed(0)
+        debug_dir = job['debug_dir']
+        ob = self.get_object(job['mesh_file'], cfg['debug'], debug_dir)
+        timings['load_s'] = time.time()-begin
+
+        begin = time.time()
+        multi = 'masks' in job or 'mask_files' in job
+        if multi:
+            if 'data' not in ob:
+                ob['data'] = ob['est'].make_object_data(ob['mesh'])
+            pose, files = run_frame_many(ob['est'], ob['data'], ob['to_origin'], ob['bbox'], K, color, depth, masks, cfg, debug_dir,
+                                         ob_id=self.object_ids[job['mesh_file']], frame_time=job.get('frame_time'), frame_id=job.get('frame_id'))
+        else:
+            pose, files = run_frame(ob['est'], ob['mesh'], ob['to_origin'], ob['bbox'], K, color, depth, masks[0], cfg, debug_dir,
+                             ob_id=self.object_ids[job['mesh_file']], frame_time=job.get('frame_time'), frame_id=job.get('frame_id'))
+        timings['infer_s'] = time.time()-begin
+
+        if job.get('send', True):
+            begin = time.time()
+            send_results(files, self.publisher, pose, os.path.splitext(os.path.basename(job['mesh_file']))[0])
+            timings['send_s'] = time.time()-begin
+        if multi:
+            return {'ok': True, 'pose': [np.asarray(p).reshape(4, 4) for p in pose], 'timings': timings}
+        return {'ok': True, 'pose': np.asarray(pose).reshape(4, 4), 'timings': timings}
+
+
+    def run(self, job):
+        """执行一个任务，带 config 时等同于运行一次 demodebug.py --config job['config']"""
+        if 'config' not in job:
+            return self.run_frame_job(job)
+        timings = {}
+        begin = time.time()
+        with open(job['config'], 'r') as f:
+            cfg = json.load(f)
+        set_seed(0)
+        debug_dir = cfg['debug_dir']
+        ob = self.get_object(cfg['mesh_file'], cfg['debug'], debug_dir)
+        timings['load_s'] = time.time()-begin
+
+        begin = time.time()
+        pose, files = run_scene(ob['est'], ob['mesh'], ob['to_origin'], ob['bbox'], cfg['test_scene_dir'], cfg, debug_dir)
+        timings['infer_s'] = time.time()-begin
+
+        begin = time.time()
+        send_results(files, self.publisher, pose, os.path.splitext(os.path.basename(cfg['mesh_file']))[0])
+        timings['send_s'] = time.time()-begin
+        return {'ok': True, 'pose': None if pose is None else np.asarray(pose).reshape(4, 4), 'timings': timings}
+
+
+    def handle(self, job):
+        cmd = job.get('cmd', 'run')
+        if cmd == 'ping':
+            return {'ok': True, 'objects': list(self.objects.keys())}
+        if cmd == 'run':
+            try:
+                return self.run(job)
+            except Exception as e:
+                traceback.print_exc()
+                return {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        return {'ok': False, 'error': f'unknown cmd {cmd}'}
+
+
+    def serve(self, address=WORKER_ADDRESS, authkey=WORKER_AUTHKEY):
+        """逐个处理连接上的任务，直到收到 shutdown"""
+        if os.path.exists(address):
+            os.remove(address)   # 上次异常退出留下的 socket 文件
+        with Listener(address, family='AF_UNIX', authkey=authkey) as listener:
+            print(f"[worker] 已就绪，监听 {address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:   # 例如 authkey 不对
+                    print(f"[worker] 拒绝连接: {e}")
+                    continue
+                with conn:
+                    try:
+                        job = conn.recv()
+                    except EOFError:
+                        continue
+                    if job.get('cmd') == 'shutdown':
+                        self.publisher.close()   # 传完排队的结果再退出
+                        if self.pose_stream is not None:
+                            self.pose_stream.close()
+                        conn.send({'ok': True})
+                        break
+                    conn.send(self.handle(job))
+        print("[worker] 已退出")
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', type=str, default=WORKER_ADDRESS, help="Unix socket path")
+    parser.add_argument('--max_objects', type=int, default=4)
+    parser.add_argument('--pose_address', type=str, default=ROBOT_POSE_ADDRESS, help="机器人端位姿 socket，'host:port' 或 Unix socket 路径")
+    parser.add_argument('--pose_stream', type=str, default=None, help="二进制位姿流的地址，'host:port'、Unix socket 路径或 shm://name")
+    args = parser.parse_args()
+
+    set_logging_format()
+    worker = PoseWorker(max_objects=args.max_objects, pose_address=args.pose_address, pose_stream=args.pose_stream)
+    worker.serve(args.address)
@@ -0,0 +1,253 @@
+"""把位姿结果传给机器人端
+
+ResultPublisher 保持一条 SSH 连接常驻，上传放到后台线程排队，估计流程不再等握手和传输：
+  - 位姿 txt 和可视化图片作为一批用同一个 SCP 会话上传；同一物体连续积压的多批只传每个远程文件的最新内容，
+    不同物体的结果（远程文件名相同）按顺序各传一次，不会互相覆盖掉
+  - 设置了 pose_address 时，位姿先通过 TCP / Unix socket 直接推送（一行 json），不用等图片上传
+
+本地测试：
+  python3 result_publisher.py --listen 127.0.0.1:9000          # 机器人端的 TCP 替身，打印收到的位姿
+  python3 result_publisher.py --push 127.0.0.1:9000             # 推送一个测试位姿
+  python3 result_publisher.py --upload ob_in_cam/object_in_camera.txt --host 127.0.0.1 --username $USER --password ... \\
+      --remote_dir /tmp/received_files                           # 对本机 sshd 测试上传
+"""
+import os
+import io
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+
+import numpy as np
+import paramiko
+from scp import SCPClient
+
+
+# 机器人端
+ROBOT_HOST = '10.12.58.80'
+ROBOT_PORT = 22
+ROBOT_USERNAME = 'elwg'
+ROBOT_PASSWORD = 'elwg224'
+ROBOT_POSE_PATH = '/home/elwg/dowload/ConnectionWithRobot (copy)/connectWithSever/received_files/object_in_camera.txt'
+ROBOT_VIS_PATH = '/home/elwg/dowload/ConnectionWithRobot (copy)/connectWithSever/received_files/vis_pem.png'
+ROBOT_POSE_ADDRESS = None  # 例如 '10.12.58.80:9000'，机器人端开了位姿 socket 时设置
+
+
+def parse_address(address):
+    """'host:port' -> (AF_INET, (host, port))，其他视为 Unix socket 路径"""
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class PosePusher:
+    """常驻的 socket 连接，每个位姿发一行 json：{"object", "instance", "time", "pose": 16 个数}，断开后下次发送时重连"""
+    def __init__(self, address, timeout=2.0):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        family, addr = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(addr)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+    def push(self, pose, object_name=None, instance=0):
+        """
+        Returns:
+            bool: 是否发送成功，失败不抛异常，不影响后面的上传
+        """
+        msg = json.dumps({
+            'object': object_name,
+            'instance': instance,
+            'time': time.time(),
+            'pose': np.asarray(pose, dtype=float).reshape(16).tolist(),
+        }) + '\n'
+        with self.lock:
+            for attempt in range(2):   # 连接可能已被对端关掉，重连一次
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall(msg.encode())
+                    return True
+                except OSError as e:
+                    self.close_socket()
+                    if attempt == 1:
+                        print(f"✗ 位姿推送失败 ({self.address}): {e}")
+        return False
+
+    def close_socket(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class ResultPublisher:
+    def __init__(self, hostname=ROBOT_HOST, port=ROBOT_PORT, username=ROBOT_USERNAME, password=ROBOT_PASSWORD, pose_address=ROBOT_POSE_ADDRESS):
+        """
+        Args:
+            pose_address: 'host:port' 或 Unix socket 路径，None 时只通过 SCP 传结果
+        """
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pusher = PosePusher(pose_address) if pose_address else None
+        self.ssh = None
+        self.queue = queue.Queue()
+        self.stats = {'batches': 0, 'files': 0, 'skipped': 0, 'connects': 0, 'errors': 0}
+        self.thread = threading.Thread(target=self.upload_loop, daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        """复用现有连接，断开时才重新握手"""
+        if self.ssh is not None and self.ssh.get_transport() is not None and self.ssh.get_transport().is_active():
+            return self.ssh
+        self.close_ssh()
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.hostname, self.port, self.username, self.password)
+        ssh.get_transport().set_keepalive(30)
+        self.ssh = ssh
+        self.stats['connects'] += 1
+        print(f"已连接到远程主机: {self.hostname}")
+        return ssh
+
+    def close_ssh(self):
+        if self.ssh is not None:
+            self.ssh.close()
+            self.ssh = None
+
+    def publish(self, files, pose=None, object_name=None):
+        """推送位姿并把文件放进上传队列，立即返回
+
+        Args:
+            files: {远程路径: 本地文件}，内容在调用时读出，之后本地文件被覆盖也不影响这一批
+            pose: (4,4) 或其列表（多实例），有 pose_address 时直接推送
+        """
+        if self.pusher is not None and pose is not None:
+            poses = pose if isinstance(pose, (list, tuple)) else [pose]
+            for instance, p in enumerate(poses):
+                self.pusher.push(p, object_name=object_name, instance=instance)
+
+        batch = {}
+        for remote_path, local_file in files.items():
+            try:
+                with open(local_file, 'rb') as f:
+                    batch[remote_path] = f.read()
+            except OSError as e:
+                print(f"✗ 读取 {local_file} 失败: {e}")
+        if batch:
+            self.queue.put((object_name, batch))
+
+    def upload_loop(self):
+        stop = False
+        while not stop:
+            items = [self.queue.get()]
+            while items[-1] is not None:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = items[-1] is None
+            # 同一物体连续的几批合成一批，同一个远程文件只传最新的内容；
+            # 不同物体写的是同样的远程文件名，只能按顺序分别上传，合并会丢掉前一个物体的位姿
+            groups = []   # [(object_name, batch)]
+            for object_name, batch in items[:-1] if stop else items:
+                if groups and groups[-1][0] == object_name:
+                    n_files = len(groups[-1][1]) + len(batch)
+                    groups[-1][1].update(batch)
+                    self.stats['skipped'] += n_files - len(groups[-1][1])
+                else:
+                    groups.append((object_name, dict(batch)))
+            for _, batch in groups:
+                self.upload(batch)
+            for _ in items:
+                self.queue.task_done()
+
+    def upload(self, batch):
+        for attempt in range(2):   # 常驻连接可能已经断了，重连一次
+            try:
+                begin = time.time()
+                ssh = self.connect()
+                with SCPClient(ssh.get_transport()) as scp:
+                    for remote_path, data in batch.items():
+                        scp.putfo(io.BytesIO(data), remote_path)
+                self.stats['batches'] += 1
+                self.stats['files'] += len(batch)
+                print(f"✓ 上传 {len(batch)} 个文件 ({(time.time()-begin)*1000:.0f}ms)")
+                return True
+            except Exception as e:
+                self.close_ssh()
+                if attempt == 1:
+                    self.stats['errors'] += 1
+                    print(f"✗ 连接或传输失败: {e}")
+        return False
+
+    def flush(self):
+        """等队列里的上传全部完成"""
+        self.queue.join()
+
+    def close(self):
+        """传完排队的文件后关闭连接"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.close_ssh()
+        if self.pusher is not None:
+            self.pusher.close_socket()
+
+
+def serve_stand_in(address):
+    """机器人端位姿 socket 的替身：打印每个收到的位姿和从发出到收到的延迟"""
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(addr):
+        os.remove(addr)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(addr)
+    server.listen(4)
+    print(f"[stand-in] 监听 {address}")
+    while True:
+        conn, peer = server.accept()
+        print(f"[stand-in] 连接: {peer}")
+        with conn, conn.makefile('r') as f:
+            for line in f:
+                msg = json.loads(line)
+                pose = np.asarray(msg['pose']).reshape(4, 4)
+                print(f"[stand-in] {msg['object']}#{msg['instance']} 延迟 {(time.time()-msg['time'])*1000:.2f}ms 平移 {pose[:3, 3]}")
+        print("[stand-in] 连接关闭")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--listen', type=str, default=None, help="运行位姿 socket 替身，'host:port' 或 Unix socket 路径")
+    parser.add_argument('--push', type=str, default=None, help="向该地址推送一个测试位姿")
+    parser.add_argument('--upload', type=str, nargs='+', default=None, help="通过 SCP 上传这些文件")
+    parser.add_argument('--host', type=str, default=ROBOT_HOST)
+    parser.add_argument('--port', type=int, default=ROBOT_PORT)
+    parser.add_argument('--username', type=str, default=ROBOT_USERNAME)
+    parser.add_argument('--password', type=str, default=ROBOT_PASSWORD)
+    parser.add_argument('--remote_dir', type=str, default=os.path.dirname(ROBOT_POSE_PATH))
+    args = parser.parse_args()
+
+    if args.listen is not None:
+        serve_stand_in(args.listen)
+    else:
+        publisher = ResultPublisher(args.host, args.port, args.username, args.password, pose_address=args.push)
+        files = {os.path.join(args.remote_dir, os.path.basename(f)): f for f in (args.upload or [])}
+        publisher.publish(files, pose=np.eye(4) if args.push else None, object_name='test')
+        publisher.close()
+        print(publisher.stats)
@@ -9,6 +9,7 @@
 
 from estimater import *
 from datareader import *
+from pose_stream import PoseStreamPublisher
 import argparse
 
 
@@ -21,10 +22,14 @@ if __name__=='__main__':
   parser.add_argument('--track_refine_iter', type=int, default=2)
   parser.add_argument('--debug', type=int, default=2)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
+  parser.add_argument('--profile_out', type=str, default=None, help='if set, stage timings are written there as Chrome trace json and summarized at the end')
+  parser.add_argument('--pose_stream', type=str, default=None, help="if set, every pose is streamed there ('host:port', Unix socket path or shm://name), see pose_stream.py for a subscriber")
   args = parser.parse_args()
 
   set_logging_format()
   set_seed(0)
+  if args.profile_out is not None:
+    stage_profiler.enabled = True
 
   mesh = trimesh.load(args.mesh_file)
 
@@ -39,17 +44,20 @@ if __name__=='__main__':
   refiner = PoseRefinePredictor()
   glctx = dr.RasterizeCudaContext()
   est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx)
+  if args.pose_stream is not None:
+    est.pose_stream = PoseStreamPublisher(args.pose_stream)
   logging.info("estimator initialization done")
 
   reader = YcbineoatReader(video_dir=args.test_scene_dir, shorter_side=None, zfar=np.inf)
 
   for i in range(len(reader.color_files)):
     logging.info(f'i:{i}')
+    frame_time = time.time()
     color = reader.get_color(i)
     depth = reader.get_depth(i)
     if i==0:
       mask = reader.get_mask(0).astype(bool)
-      pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter)
+      pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter, frame_time=frame_time)
 
       if debug>=3:
         m = mesh.copy()
@@ -60,7 +68,7 @@ if __name__=='__main__':
         pcd = toOpen3dCloud(xyz_map[valid], color[valid])
         o3d.io.write_point_cloud(f'{debug_dir}/scene_complete.ply', pcd)
     else:
-      pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter)
+      pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter, frame_time=frame_time)
 
     os.makedirs(f'{debug_dir}/ob_in_cam', exist_ok=True)
     np.savetxt(f'{debug_dir}/ob_in_cam/{reader.id_strs[i]}.txt', pose.reshape(4,4))
@@ -77,3 +85,9 @@ if __name__=='__main__':
       os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
       imageio.imwrite(f'{debug_dir}/track_vis/{reader.id_strs[i]}.png', vis)
 
+  if args.profile_out is not None:
+    stage_profiler.export_chrome_trace(args.profile_out)
+    logging.info(f'stage timings, trace saved to {args.profile_out}\n{stage_profiler.summary_table()}')
+
+  if est.pose_stream is not None:
+    est.pose_stream.close()
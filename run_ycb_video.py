@@ -131,6 +131,48 @@ def run_pose_estimation():
 
 
 
+def run_pose_estimation_batched():
+  '''Same as run_pose_estimation, but all objects of a frame are registered together with register_many
+  '''
+  wp.force_load(device='cuda')
+  video_dirs = sorted(glob.glob(f'{opt.ycbv_dir}/test/*'))
+  res = NestDict()
+
+  reader_tmp = YcbVideoReader(video_dirs[0])
+  glctx = dr.RasterizeCudaContext()
+  mesh_tmp = trimesh.primitives.Box(extents=np.ones((3)), transform=np.eye(4))
+  est = FoundationPose(model_pts=mesh_tmp.vertices.copy(), model_normals=mesh_tmp.vertex_normals.copy(), symmetry_tfs=None, mesh=mesh_tmp, scorer=None, refiner=None, glctx=glctx, debug_dir=opt.debug_dir, debug=opt.debug)
+
+  objects = {}
+  for ob_id in reader_tmp.ob_ids:
+    if opt.use_reconstructed_mesh:
+      mesh = reader_tmp.get_reconstructed_mesh(ob_id, ref_view_dir=opt.ref_view_dir)
+    else:
+      mesh = reader_tmp.get_gt_mesh(ob_id)
+    objects[ob_id] = est.make_object_data(mesh, model_normals=mesh.vertex_normals.copy(), symmetry_tfs=reader_tmp.symmetry_tfs[ob_id])
+
+  for video_dir in video_dirs:
+    reader = YcbVideoReader(video_dir, zfar=1.5)
+    video_id = reader.get_video_id()
+    for i_frame in range(len(reader.color_files)):
+      if not reader.is_keyframe(i_frame):
+        continue
+      id_str = reader.id_strs[i_frame]
+      color = reader.get_color(i_frame)
+      depth = reader.get_depth(i_frame)
+      scene_ob_ids = [ob_id for ob_id in reader.get_instance_ids_in_image(i_frame) if ob_id in objects]
+      logging.info(f"video:{video_id}, id_str:{id_str}, ob_ids:{scene_ob_ids}")
+      if len(scene_ob_ids)==0:
+        continue
+      ob_masks = [get_mask(reader, i_frame, ob_id, detect_type=detect_type) for ob_id in scene_ob_ids]
+      poses = est.register_many(K=reader.K, rgb=color, depth=depth, ob_masks=ob_masks, objects=[objects[ob_id] for ob_id in scene_ob_ids], iteration=5)
+      for ob_id, pose in zip(scene_ob_ids, poses):
+        res[video_id][id_str][ob_id] = pose
+
+  with open(f'{opt.debug_dir}/ycbv_res.yml','w') as ff:
+    yaml.safe_dump(make_yaml_dumpable(res), ff)
+
+
 if __name__=='__main__':
   parser = argparse.ArgumentParser()
   code_dir = os.path.dirname(os.path.realpath(__file__))
@@ -139,6 +181,7 @@ if __name__=='__main__':
   parser.add_argument('--ref_view_dir', type=str, default="/mnt/9a72c439-d0a7-45e8-8d20-d7a235d02763/DATASET/YCB_Video/bowen_addon/ref_views_16")
   parser.add_argument('--debug', type=int, default=0)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
+  parser.add_argument('--batch_objects', type=int, default=0, help='register all objects of a frame in one batch')
   opt = parser.parse_args()
   os.environ["YCB_VIDEO_DIR"] = opt.ycbv_dir
 
@@ -146,4 +189,7 @@ if __name__=='__main__':
 
   detect_type = 'mask'   # mask / box / detected
 
-  run_pose_estimation()
+  if opt.batch_objects:
+    run_pose_estimation_batched()
+  else:
+    run_pose_estimation()
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+Utils = pytest.importorskip('Utils')
+from scipy.spatial.transform import Rotation
+
+
+def cluster_poses_loop(angle_diff, dist_diff, poses_in, symmetry_tfs):
+  '''Direct port of the linear scan in mycpp/src/app/pybind_api.cpp
+  '''
+  radian_thres = angle_diff/180.0*np.pi
+  poses_out = [poses_in[0]]
+  for cur_pose in poses_in[1:]:
+    isnew = True
+    for cluster in poses_out:
+      if np.linalg.norm(cluster[:3,3]-cur_pose[:3,3])>=dist_diff:
+        continue
+      for tf in symmetry_tfs:
+        R1 = (cur_pose@tf)[:3,:3]
+        cos = np.clip((np.trace(R1@cluster[:3,:3].T)-1)/2, -1, 1)
+        if np.arccos(cos)<radian_thres:
+          isnew = False
+          break
+      if not isnew:
+        break
+    if isnew:
+      poses_out.append(cur_pose)
+  return np.asarray(poses_out)
+
+
+def make_poses(n, seed=0):
+  rng = np.random.default_rng(seed)
+  poses = np.tile(np.eye(4), (n,1,1))
+  poses[:,:3,:3] = Rotation.random(n, random_state=seed).as_matrix()
+  poses[:,:3,3] = rng.uniform(-0.05, 0.05, (n,3))
+  return poses.astype(np.float32)
+
+
+def make_symmetry_tfs(name):
+  if name=='none':
+    angles = np.zeros((0))
+  elif name=='discrete':
+    angles = np.array([180])
+  else:
+    angles = np.arange(5, 360, 5)
+  tfs = np.tile(np.eye(4), (len(angles)+1,1,1))
+  if len(angles)>0:
+    tfs[1:,:3,:3] = Rotation.from_euler('z', angles[:,None], degrees=True).as_matrix()
+  return tfs.astype(np.float32)
+
+
+@pytest.mark.parametrize('sym_name', ['none', 'discrete', 'continuous'])
+@pytest.mark.parametrize('dist_diff', [0.04, 99999])
+def test_matches_loop(sym_name, dist_diff):
+  poses = make_poses(400)
+  symmetry_tfs = make_symmetry_tfs(sym_name)
+  out = Utils.cluster_poses(30, dist_diff, poses, symmetry_tfs)
+  ref = cluster_poses_loop(30, dist_diff, poses, symmetry_tfs)
+  assert out.dtype==np.float32
+  assert 1<len(out)<len(poses)
+  np.testing.assert_array_equal(out, ref)
+
+
+def test_duplicates():
+  poses = make_poses(20)
+  out = Utils.cluster_poses(30, 99999, np.concatenate([poses, poses]), make_symmetry_tfs('none'))
+  np.testing.assert_array_equal(out, cluster_poses_loop(30, 99999, poses, make_symmetry_tfs('none')))
+  assert len(Utils.cluster_poses(30, 99999, poses[:1], make_symmetry_tfs('none')))==1
+
+
+@pytest.mark.parametrize('bs', [1, 7, 64])
+def test_buckets(bs):
+  poses = make_poses(300, seed=2)
+  rng = np.random.default_rng(2)
+  axes = rng.normal(size=(60,3))
+  axes /= np.linalg.norm(axes, axis=-1, keepdims=True)
+  poses[::5,:3,:3] = Rotation.from_rotvec(axes*np.deg2rad(rng.uniform(170,190,(60,1)))).as_matrix()   # Quaternions near w=0, where q and -q fall in different cells
+  symmetry_tfs = make_symmetry_tfs('discrete')
+  out = Utils.cluster_poses(12, 0.06, poses, symmetry_tfs, bs=bs)
+  assert len(out)>64   # Past the linear scan, so kept clusters are looked up in their cells
+  np.testing.assert_array_equal(out, cluster_poses_loop(12, 0.06, poses, symmetry_tfs))
+
+
+@pytest.mark.skipif(getattr(Utils, 'mycpp', None) is None, reason='mycpp is not built')
+@pytest.mark.parametrize('sym_name', ['none', 'discrete', 'continuous'])
+def test_matches_mycpp(sym_name):
+  poses = make_poses(2000, seed=1)   # More kept clusters than the C++ linear scan limit, so its bucket lookup is used too
+  symmetry_tfs = make_symmetry_tfs(sym_name)
+  out = Utils.cluster_poses(30, 99999, poses, symmetry_tfs)
+  np.testing.assert_array_equal(out, np.asarray(Utils.mycpp.cluster_poses(30, 99999, poses, symmetry_tfs)))
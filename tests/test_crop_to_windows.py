@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+torch = pytest.importorskip('torch')
+import torch.nn.functional as F
+Utils = pytest.importorskip('Utils')
+
+
+def warp_perspective_reference(img, M, dsize, mode):
+  '''What kornia.geometry.transform.warp_perspective(..., align_corners=False) computes, written out so the test does not need kornia
+  '''
+  B,_,H,W = img.shape
+  h,w = dsize
+  def normal_transform_pixel(H, W):
+    return torch.tensor([[2/(W-1),0,-1],[0,2/(H-1),-1],[0,0,1]], dtype=torch.float)
+  src_from_dst = torch.inverse(normal_transform_pixel(h,w)@M@torch.inverse(normal_transform_pixel(H,W)))
+  ys,xs = torch.meshgrid(torch.linspace(-1,1,h), torch.linspace(-1,1,w), indexing='ij')
+  pts = torch.stack([xs,ys,torch.ones_like(xs)], dim=0).reshape(3,-1)
+  grid = src_from_dst@pts[None]
+  grid = (grid[:,:2]/grid[:,2:3]).permute(0,2,1).reshape(B,h,w,2)
+  return F.grid_sample(img, grid, mode=mode, padding_mode='zeros', align_corners=False)
+
+
+def make_windows():
+  tfs = []
+  for cx,cy,size in [(100,120,80), (110,130,90), (500,400,120), (620,20,100), (320,240,60)]:   # Two overlapping, the rest apart or partly outside the image
+    tf = np.eye(3)
+    tf[0,0] = tf[1,1] = 160/size
+    tf[0,2] = -(cx-size/2)*tf[0,0]
+    tf[1,2] = -(cy-size/2)*tf[1,1]
+    tfs.append(tf)
+  return torch.as_tensor(np.array(tfs), dtype=torch.float)
+
+
+def test_matches_warp_perspective():
+  img = np.random.default_rng(0).random((480,640,3)).astype(np.float32)*255
+  tfs = make_windows()
+  img_t = torch.as_tensor(img).permute(2,0,1)[None].expand(len(tfs),-1,-1,-1)
+
+  out = Utils.crop_to_windows(img, tfs, dsize=(160,160), mode='bilinear', device='cpu')
+  ref = warp_perspective_reference(img_t, tfs, (160,160), 'bilinear')
+  assert torch.allclose(out, ref, atol=0.05)
+
+  # Nearest may only differ where the sampling position falls exactly between two pixels
+  out = Utils.crop_to_windows(img, tfs, dsize=(160,160), mode='nearest', device='cpu')
+  ref = warp_perspective_reference(img_t, tfs, (160,160), 'nearest')
+  assert ((out-ref).abs()>0.05).any(dim=1).float().mean()<0.005
+
+
+def test_group_crop_windows():
+  groups = Utils.group_crop_windows([(0,0,10,10), (5,5,20,20), (100,100,110,110), (19,0,30,5)])
+  assert sorted(sorted(ids) for _,ids in groups)==[[0,1,3], [2]]
+  box = [box for box,ids in groups if 2 in ids][0]
+  assert list(box)==[100,100,110,110]
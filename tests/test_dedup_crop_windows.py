@@ -0,0 +1,40 @@
+import pytest
+torch = pytest.importorskip('torch')
+Utils = pytest.importorskip('Utils')
+
+
+def make_tfs(windows, out_size):
+  '''
+  @windows: list of (left, top, width, height)
+  '''
+  tfs = torch.eye(3)[None].repeat(len(windows),1,1)
+  for i,(left,top,width,height) in enumerate(windows):
+    tfs[i,0,0] = out_size[0]/width
+    tfs[i,1,1] = out_size[1]/height
+    tfs[i,0,2] = -left*tfs[i,0,0]
+    tfs[i,1,2] = -top*tfs[i,1,1]
+  return tfs
+
+
+def test_exact():
+  out_size = (160,160)
+  windows = [(10,20,100,100), (50,60,80,80), (10,20,100,100), (0,0,200,200), (50,60,80,80), (10,20,100,100)]
+  tfs = make_tfs(windows, out_size)
+  tfs_out, uniq, inverse = Utils.dedup_crop_windows(tfs, out_size)
+  assert tfs_out is tfs
+  assert sorted(uniq.tolist())==[0,1,3]   # First pose of each window
+  assert len(set(inverse.tolist()))==3
+  assert inverse[0]==inverse[2]==inverse[5] and inverse[1]==inverse[4]
+  assert torch.equal(tfs[uniq[inverse]], tfs)   # Every pose is cropped with its window's transform
+
+
+def test_quantize():
+  out_size = (160,160)
+  windows = [(10.2,20.1,100.3,99.8), (9.9,19.8,99.9,100.2), (14,20,100,100), (10,20,100,100)]
+  tfs = make_tfs(windows, out_size)
+  tfs_out, uniq, inverse = Utils.dedup_crop_windows(tfs, out_size, quantize=2)
+  assert sorted(uniq.tolist())==[0,2]
+  assert inverse[0]==inverse[1]==inverse[3]!=inverse[2]
+  torch.testing.assert_close(tfs_out[0], make_tfs([(10,20,100,100)], out_size)[0])
+  torch.testing.assert_close(tfs_out[2], make_tfs([(14,20,100,100)], out_size)[0])
+  assert torch.equal(tfs_out[uniq[inverse]], tfs_out)
@@ -0,0 +1,38 @@
+import threading
+import numpy as np
+import pytest
+torch = pytest.importorskip('torch')
+Utils = pytest.importorskip('Utils')
+
+
+def make_mesh_tensors():
+  return Utils.mesh_arrays_to_tensors({'tex': np.random.default_rng(0).integers(0, 256, (1,8,8,3)).astype(np.uint8)}, device='cpu')
+
+
+def test_converted_once_per_context():
+  mesh_tensors = make_mesh_tensors()
+  tex, mips = Utils.get_float_texture(mesh_tensors, with_mips=True)
+  assert torch.allclose(tex*255, mesh_tensors['tex'].float())
+  assert len(mips)==len(mesh_tensors['tex_mips'])
+  assert Utils.get_float_texture(mesh_tensors, with_mips=False)[0] is not tex   # No context, converted every call
+
+  with Utils.float_textures():
+    tex, _ = Utils.get_float_texture(mesh_tensors, with_mips=False)
+    with Utils.float_textures():
+      tex2, mips = Utils.get_float_texture(mesh_tensors, with_mips=True)
+    assert tex2 is tex
+    assert Utils.get_float_texture(mesh_tensors, with_mips=True)[1] is mips   # Still cached after the inner context
+  assert Utils.get_float_texture(mesh_tensors, with_mips=False)[0] is not tex   # Released by the outer one
+
+
+def test_per_thread():
+  mesh_tensors = make_mesh_tensors()
+  out = {}
+  def run():
+    out['tex'] = Utils.get_float_texture(mesh_tensors, with_mips=False)[0]
+  with Utils.float_textures():
+    tex = Utils.get_float_texture(mesh_tensors, with_mips=False)[0]
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+  assert out['tex'] is not tex
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import pytest
+estimater = pytest.importorskip('estimater')
+import trimesh
+
+
+def make_mesh(color=(200,100,50,255)):
+  mesh = trimesh.creation.box(extents=(0.1,0.2,0.05))
+  mesh.apply_translation([0.3,0,0])
+  mesh.visual.vertex_colors = np.tile(np.array(color, dtype=np.uint8), (len(mesh.vertices),1))
+  return mesh
+
+
+def test_loaded_with_mmap(tmp_path):
+  mesh = make_mesh()
+  asset = estimater.MeshAssetCache(cache_dir=str(tmp_path)).get(mesh, mesh.vertex_normals)
+  assert asset['meta']['diameter']==pytest.approx(np.linalg.norm([0.1,0.2,0.05]))
+  np.testing.assert_allclose(asset['arrays']['model_center'], [0.3,0,0], atol=1e-12)
+
+  cache = estimater.MeshAssetCache(cache_dir=str(tmp_path))
+  loaded = cache.get(mesh.copy(), mesh.vertex_normals)
+  assert cache.disk_hits==1
+  assert loaded['meta']['diameter']==asset['meta']['diameter']
+  assert set(loaded['arrays'].keys())==set(asset['arrays'].keys())
+  for k,v in loaded['arrays'].items():
+    assert isinstance(v, np.memmap) and not v.flags.writeable, k   # Paged in on use, and shared with the file
+    np.testing.assert_array_equal(v, asset['arrays'][k])
+  assert cache.get(mesh, mesh.vertex_normals) is loaded
+
+
+def test_saved_by_rename(tmp_path):
+  mesh = make_mesh()
+  cache = estimater.MeshAssetCache(cache_dir=str(tmp_path))
+  asset = cache.get(mesh, mesh.vertex_normals)
+  key = estimater.MeshAssetCache.make_key(mesh, mesh.vertex_normals)
+  assert os.listdir(cache.cache_dir)==[key]   # The temporary directory was renamed
+  assert sorted(os.listdir(f'{cache.cache_dir}/{key}'))==sorted([f'{k}.npy' for k in asset['arrays']]+['meta.json'])
+
+  with pytest.raises(OSError):   # Another process got there first: its entry stays, ours is dropped
+    cache.save(f'{cache.cache_dir}/{key}', cache.compute(make_mesh(color=(0,0,255,255)), mesh.vertex_normals))
+  assert os.listdir(cache.cache_dir)==[key]
+  np.testing.assert_array_equal(cache.load(f'{cache.cache_dir}/{key}')['arrays']['mesh_vertex_color'][0], [200,100,50])
+
+  os.remove(f'{cache.cache_dir}/{key}/meta.json')   # meta.json is what marks an entry complete
+  other = estimater.MeshAssetCache(cache_dir=str(tmp_path))
+  other.get(mesh, mesh.vertex_normals)
+  assert (other.disk_hits, other.misses)==(0,1)
+
+
+def test_version_bump(tmp_path, monkeypatch):
+  mesh = make_mesh()
+  key = estimater.MeshAssetCache.make_key(mesh, mesh.vertex_normals)
+  assert estimater.MeshAssetCache.make_key(mesh, None)!=key
+  assert estimater.MeshAssetCache.make_key(mesh, mesh.vertex_normals, max_tex_size=512)!=key
+  assert estimater.MeshAssetCache.make_key(mesh, mesh.vertex_normals, lod_min_faces=20000)!=key
+  assert estimater.MeshAssetCache.make_key(make_mesh(color=(0,0,255,255)), mesh.vertex_normals)!=key
+  estimater.MeshAssetCache(cache_dir=str(tmp_path)).get(mesh, mesh.vertex_normals)
+
+  monkeypatch.setattr(estimater.MeshAssetCache, 'version', estimater.MeshAssetCache.version+1)
+  assert estimater.MeshAssetCache.make_key(mesh, mesh.vertex_normals)!=key
+  cache = estimater.MeshAssetCache(cache_dir=str(tmp_path))
+  cache.get(mesh, mesh.vertex_normals)
+  assert (cache.disk_hits, cache.misses)==(0,1)
+  assert len(os.listdir(cache.cache_dir))==2
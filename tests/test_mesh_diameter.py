@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+Utils = pytest.importorskip('Utils')
+from scipy.spatial.distance import pdist
+
+
+def make_clouds():
+  rng = np.random.default_rng(0)
+  sphere = rng.normal(size=(3000,3))
+  sphere /= np.linalg.norm(sphere, axis=-1, keepdims=True)   # Many near ties for the farthest pair
+  grid = np.stack(np.meshgrid(*[np.linspace(0,1,12)]*3, indexing='ij'), axis=-1).reshape(-1,3)   # Exact ties
+  return {
+    'uniform': rng.uniform(-1, 1, (2000,3)),
+    'elongated': rng.normal(size=(2500,3))*[0.3,0.02,0.01],
+    'sphere': sphere,
+    'grid': grid,
+    'duplicates': np.repeat(rng.uniform(size=(50,3)), 20, axis=0),
+  }
+
+
+@pytest.mark.parametrize('name', list(make_clouds().keys()))
+@pytest.mark.parametrize('leaf_size', [1, 16, 256])
+def test_matches_brute_force(name, leaf_size):
+  pts = make_clouds()[name]
+  assert Utils.farthest_pair_distance(pts, leaf_size=leaf_size)==pytest.approx(pdist(pts).max(), rel=1e-12)
+
+
+def test_degenerate():
+  assert Utils.farthest_pair_distance(np.zeros((0,3)))==0
+  assert Utils.farthest_pair_distance(np.ones((1,3)))==0
+  assert Utils.farthest_pair_distance(np.ones((5,3)))==0
+  assert Utils.farthest_pair_distance(np.array([[0,0,0],[3,4,0]]))==pytest.approx(5)
+
+
+@pytest.mark.parametrize('name', list(make_clouds().keys())+['flat', 'line'])
+def test_hull_exact(name):
+  rng = np.random.default_rng(1)
+  clouds = make_clouds()
+  clouds['flat'] = np.concatenate([rng.uniform(size=(500,2)), np.zeros((500,1))], axis=-1)   # Qhull fails on coplanar points
+  clouds['line'] = np.outer(rng.uniform(size=300), [1,2,3])
+  pts = clouds[name]
+  assert Utils.compute_mesh_diameter(model_pts=pts, n_sample=None)==pytest.approx(pdist(pts).max(), rel=1e-12)
+
+
+def test_sampled_lower_bound():
+  pts = make_clouds()['elongated']
+  np.random.seed(0)
+  assert Utils.compute_mesh_diameter(model_pts=pts)<=pdist(pts).max()
+  assert Utils.compute_mesh_diameter(model_pts=pts[:1000])==pytest.approx(pdist(pts[:1000]).max(), rel=1e-12)   # Not above n_sample: exact
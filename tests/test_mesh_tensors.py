@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+torch = pytest.importorskip('torch')
+Utils = pytest.importorskip('Utils')
+
+
+def make_arrays():
+  '''Textured mesh with one level of detail, the layout of make_mesh_arrays
+  '''
+  rng = np.random.default_rng(0)
+  faces = np.array([[0,1,2],[0,2,3]], dtype=np.int32)
+  return {
+    'tex': rng.integers(0, 256, (1,8,8,3)).astype(np.uint8),
+    'uv_idx': faces.copy(),
+    'uv': rng.random((4,2)).astype(np.float32),
+    'pos': rng.random((4,3)).astype(np.float32),
+    'faces': faces,
+    'vnormals': rng.random((4,3)).astype(np.float32),
+    'lod1_pos': rng.random((3,3)).astype(np.float32),
+    'lod1_faces': faces[:1],
+    'lod1_vnormals': rng.random((3,3)).astype(np.float32),
+    'lod1_vertex_color': rng.integers(0, 256, (3,3)).astype(np.uint8),
+    'lod_edge_len': np.array([0.01, 0.04]),
+  }
+
+
+def test_layout():
+  mesh_tensors = Utils.mesh_arrays_to_tensors(make_arrays(), device='cpu')
+  assert mesh_tensors['tex'].dtype==torch.uint8
+  assert [tuple(mip.shape[1:3]) for mip in mesh_tensors['tex_mips']]==[(4,4), (2,2), (1,1)]
+  assert mesh_tensors['lod_edge_len']==[0.01, 0.04]
+  assert mesh_tensors['uv_idx'] is mesh_tensors['faces']
+  assert set(mesh_tensors['lods'][0].keys())=={'pos','faces','vnormals','vertex_color'}
+
+
+def test_mesh_tensors_to():
+  mesh_tensors = Utils.mesh_arrays_to_tensors(make_arrays(), device='cpu')
+  moved = Utils.mesh_tensors_to(mesh_tensors, 'meta')
+  assert moved is not mesh_tensors
+  assert mesh_tensors['pos'].device.type=='cpu'   # The original, possibly shared, is left alone
+  for k in ['tex','uv','pos','faces','vnormals']:
+    assert moved[k].device.type=='meta'
+  assert all(mip.device.type=='meta' for mip in moved['tex_mips'])
+  assert len(moved['tex_mips'])==len(mesh_tensors['tex_mips'])
+  assert all(v.device.type=='meta' for lod in moved['lods'] for v in lod.values())
+  assert moved['lod_edge_len']==[0.01, 0.04]
+  assert moved['uv_idx'] is moved['faces']
+
+
+def test_lod_from_crop_window():
+  K = np.array([[600.0,0,320],[0,580,240],[0,0,1]])
+  poses = torch.eye(4)[None].repeat(3,1,1)
+  poses[:,:3,3] = torch.tensor([[0,0,0.5],[0.1,-0.05,0.9],[-0.1,0,2.0]])
+  tf_to_crops = Utils.compute_crop_window_tf_batch(H=480, W=640, poses=poses, K=K, crop_ratio=1.2, out_size=(160,160), method='box_3d', mesh_diameter=0.2)
+  pix_per_meter = Utils.crop_pix_per_meter(K, (160,160), 0.2, crop_ratio=1.2)
+  torch.testing.assert_close(K[0,0]*tf_to_crops[:,0,0]/poses[:,2,3], torch.full((3,), pix_per_meter), rtol=0.03, atol=0)   # Same for every distance, up to the rounded window
+  assert Utils.crop_pix_per_meter(K, (160,160), [0.2,0.4], crop_ratio=1.2)==pytest.approx([pix_per_meter, pix_per_meter/2])
+
+  mesh_tensors = {'pos': 'full', 'lod_edge_len': [0.001,0.004,0.016], 'lods': [{'pos': 'lod1'}, {'pos': 'lod2'}]}
+  assert Utils.select_mesh_lod(mesh_tensors, pix_per_meter=100)['pos']=='lod1'
+  assert Utils.select_mesh_lod(mesh_tensors, pix_per_meter=10)['pos']=='lod2'
+  assert Utils.select_mesh_lod(mesh_tensors, pix_per_meter=2000) is mesh_tensors
+  assert Utils.select_mesh_lod(mesh_tensors, pix_per_meter=None) is mesh_tensors
@@ -0,0 +1,99 @@
+import os
+import time
+
+import pytest
+
+import pipeline
+
+
+def touch(directory, name):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b'png')
+    return path
+
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'BASE_DIR', str(tmp_path))
+    monkeypatch.setattr(pipeline, 'PROCESSED_DIR', str(tmp_path / 'processed'))
+    monkeypatch.setattr(pipeline, 'FAILED_DIR', str(tmp_path / 'processed' / 'failed'))
+    return tmp_path
+
+
+def test_triplet_single_mask(dirs):
+    collector = pipeline.TripletCollector(settle=0)
+    for name in ['color_d435i_box.png', 'mask_d435i_box.png']:
+        touch(dirs, name)
+        collector.add(name)
+    assert collector.pop_ready() == []   # depth 还没到
+    touch(dirs, 'depth_d435i_box.png')
+    collector.add('depth_d435i_box.png')
+    ready = collector.pop_ready()
+    assert len(ready) == 1
+    assert ready[0]['object_name'] == 'box' and ready[0]['camera_model'] == 'd435i'
+    assert ready[0]['mask_files'] == [os.path.join(dirs, 'mask_d435i_box.png')]
+    assert collector.pop_ready() == []
+
+
+def test_triplet_instance_masks(dirs):
+    collector = pipeline.TripletCollector(settle=0.2)
+    names = ['color_d435i_box.png', 'depth_d435i_box.png', 'mask_d435i_box_1.png', 'mask_d435i_box_0.png',
+             # 另一个物体 box_2 有自己的 color，它的 mask 不算 box 的实例
+             'color_d435i_box_2.png', 'depth_d435i_box_2.png', 'mask_d435i_box_2.png']
+    for name in names:
+        touch(dirs, name)
+        collector.add(name)
+    ready = collector.pop_ready()
+    assert [info['object_name'] for info in ready] == ['box_2']   # box 的实例还在 settle
+    assert 0 < collector.wait_time(1.0) <= 0.2
+
+    time.sleep(0.25)
+    ready = collector.pop_ready()
+    assert len(ready) == 1
+    assert ready[0]['mask_files'] == [os.path.join(dirs, f'mask_d435i_box_{i}.png') for i in [0, 1]]
+    assert ready[0]['frame_id'] == 2   # 按到齐的先后编号
+    assert collector.files == {} and collector.updated == {}
+
+
+def test_worker_pose_streams(monkeypatch):
+    popen_cmds = []
+    monkeypatch.setattr(pipeline.subprocess, 'Popen', lambda cmd: popen_cmds.append(cmd))
+    monkeypatch.setattr(pipeline, 'worker_processes', {})
+    monkeypatch.setattr(pipeline, 'WORKER_SCRIPT', 'pose_worker.py')
+    for address in pipeline.WORKER_ADDRESSES:
+        pipeline.start_worker(address)
+    streams = [cmd[cmd.index('--pose_stream') + 1] for cmd in popen_cmds]
+    assert len(streams) == len(pipeline.WORKER_ADDRESSES) == len(set(streams))   # 每个常驻进程一个地址
+
+
+def make_files_info(dirs, object_name):
+    return {
+        'camera_model': 'd435i',
+        'object_name': object_name,
+        'rgb_file': touch(dirs, f'color_d435i_{object_name}.png'),
+        'depth_file': touch(dirs, f'depth_d435i_{object_name}.png'),
+        'mask_files': [touch(dirs, f'mask_d435i_{object_name}.png')],
+        'drop_time': time.time(),
+    }
+
+
+def test_archive_only_on_success(dirs, monkeypatch):
+    def process_batch(files_info, address):
+        if files_info['object_name'] == 'bad':
+            raise RuntimeError('worker crashed')
+        return files_info['object_name'] == 'good'
+    monkeypatch.setattr(pipeline, 'process_batch', process_batch)
+
+    scheduler = pipeline.JobScheduler(addresses=['a', 'b'])
+    for name in ['good', 'bad', 'failed']:
+        scheduler.submit(make_files_info(dirs, name))
+    scheduler.close(drain=True)
+
+    processed = [d for d in os.listdir(dirs / 'processed') if d != 'failed']
+    failed = os.listdir(dirs / 'processed' / 'failed')
+    assert len(processed) == 1 and processed[0].endswith('_d435i_good')
+    assert sorted(d.split('_', 2)[2] for d in failed) == ['d435i_bad', 'd435i_failed']
+    assert len(os.listdir(dirs / 'processed' / 'failed' / failed[0])) == 3   # color, depth, mask 留着排查
+    assert not any(f.endswith('.png') for f in os.listdir(dirs))
+    assert scheduler.metrics()['failed'] == 2
@@ -0,0 +1,62 @@
+import os
+import uuid
+import numpy as np
+import pytest
+
+import pose_stream
+
+
+def make_pose():
+  pose = np.eye(4)
+  pose[:3,:3] = [[0,-1,0],[1,0,0],[0,0,1]]
+  pose[:3,3] = [0.1, -0.2, 0.75]
+  return pose
+
+
+def test_round_trip():
+  pose = make_pose()
+  msg = pose_stream.unpack_pose_msg(pose_stream.pack_pose_msg(pose, frame_id=2**40+3, object_id=7, score=0.5, frame_time=123.25))
+  assert len(pose_stream.pack_pose_msg(pose, 0))==pose_stream.POSE_MSG.size
+  assert msg['frame_id']==2**40+3
+  assert msg['object_id']==7
+  assert msg['score']==0.5
+  assert msg['frame_time']==123.25
+  assert msg['pub_time']>=123.25
+  np.testing.assert_array_equal(msg['pose'], pose.astype(np.float32))   # Sent as float32
+  np.testing.assert_array_equal(msg['pose'][3], [0,0,0,1])
+
+
+def test_round_trip_defaults():
+  msg = pose_stream.unpack_pose_msg(pose_stream.pack_pose_msg(make_pose().tolist(), frame_id=0))
+  assert np.isnan(msg['score'])
+  assert msg['object_id']==0
+  assert msg['frame_time']==msg['pub_time']
+
+
+def test_indexed_address():
+  assert pose_stream.indexed_address('127.0.0.1:5600', 2)=='127.0.0.1:5602'
+  assert pose_stream.indexed_address('shm://poses', 1)=='shm://poses_1'
+  assert pose_stream.indexed_address('/tmp/poses.sock', 0)=='/tmp/poses_0.sock'
+  assert pose_stream.parse_address(pose_stream.indexed_address('/tmp/poses', 3))==(pose_stream.socket.AF_UNIX, '/tmp/poses_3')
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='no shared memory')
+def test_shm_ring(monkeypatch):
+  address = f'shm://test_pose_stream_{uuid.uuid4().hex[:8]}'
+  pub = pose_stream.PoseStreamPublisher(address, capacity=4)
+  try:
+    with monkeypatch.context() as m:
+      m.setattr(pose_stream.resource_tracker, 'unregister', lambda *args: None)   # Same process as the publisher, whose registration must stay
+      sub = pose_stream.PoseStreamSubscriber(address, connect_timeout=1)
+    try:
+      pose = make_pose()
+      for i in range(6):   # Overruns the ring: the two oldest are lost
+        pub.publish(pose, frame_id=i, object_id=1)
+      frame_ids = [sub.recv(timeout=0.1)['frame_id'] for _ in range(4)]
+      assert frame_ids==[2,3,4,5]
+      assert sub.n_lost==2
+      assert sub.recv(timeout=0.01) is None
+    finally:
+      sub.close()
+  finally:
+    pub.close()
@@ -0,0 +1,79 @@
+import pytest
+torch = pytest.importorskip('torch')
+Utils = pytest.importorskip('Utils')
+
+
+def make_entry(n=10):
+  return (torch.zeros((n,n,3)), torch.zeros((n,n)), None, torch.zeros((n,n,3)))   # 700 floats, 2800 bytes for n=10
+
+
+def test_keys():
+  cache = Utils.RenderCache()
+  poses = torch.eye(4)[None].repeat(3,1,1)
+  poses[1,0,3] = 0.1
+  poses[2,0,3] = 1e-7   # Below trans_quant, same key as the first
+  tf_to_crops = torch.eye(3)[None].repeat(3,1,1)
+  keys = cache.make_keys(['a','a','a'], poses, tf_to_crops, settings=((160,160), False))
+  assert keys[0]!=keys[1]
+  assert keys[0]==keys[2]
+  assert cache.make_keys(['b'], poses[:1], tf_to_crops[:1], settings=((160,160), False))[0]!=keys[0]
+  assert cache.make_keys(['a'], poses[:1], tf_to_crops[:1], settings=((128,128), False))[0]!=keys[0]
+
+
+def test_hits_and_byte_bound():
+  cache = Utils.RenderCache(max_bytes=3*2800)
+  batch = torch.zeros((2,10,10,3))
+  cache.put('a', (batch[0], torch.zeros((10,10)), None, torch.zeros((10,10,3))))
+  assert cache.entries['a'][0]._base is None   # Copied, not a view keeping the batch alive
+  assert cache.n_bytes==2800
+  assert cache.get('a') is not None
+  assert cache.get('b') is None
+  assert cache.stats()['hit_rate']==0.5
+
+  for key in ['b','c']:
+    cache.put(key, make_entry())
+  cache.get('a')   # Most recently used now, 'b' is the oldest
+  cache.put('d', make_entry())
+  assert list(cache.entries.keys())==['c','a','d']
+  assert cache.n_bytes==3*2800
+
+  cache.put('e', make_entry(20))   # Larger than the bound by itself
+  assert len(cache.entries)==0 and cache.n_bytes==0
+
+  cache.put('a', make_entry())
+  cache.clear()
+  assert cache.n_bytes==0 and cache.stats()['hits']==2   # Stats last until the next frame
+  cache.new_frame()
+  assert cache.stats()['hits']==0
+
+
+def test_refiner_vis_then_scorer(monkeypatch):
+  '''The refiner's visualization stores the refined poses' renders, the scorer then crops the same poses with the same settings
+  '''
+  n_rendered = []
+  def fake_render(ob_in_cams, output_size, extra, **kwargs):
+    n_rendered.append(len(ob_in_cams))
+    extra['xyz_map'] = torch.zeros((len(ob_in_cams),*output_size,3))
+    return torch.rand((len(ob_in_cams),*output_size,3)), torch.rand((len(ob_in_cams),*output_size)), None
+  monkeypatch.setattr(Utils, 'nvdiffrast_render', fake_render)
+
+  K = torch.tensor([[500.0,0,320],[0,500,240],[0,0,1]])
+  poses = torch.eye(4)[None].repeat(4,1,1)
+  poses[:,2,3] = torch.tensor([0.5,0.6,0.7,0.8])
+  mesh_tensors = {}
+  def render(crop_ratio, store):
+    tf_to_crops = Utils.compute_crop_window_tf_batch(H=480, W=640, poses=poses, K=K, crop_ratio=crop_ratio, out_size=(16,16), method='box_3d', mesh_diameter=0.2)
+    return Utils.render_crop_batch(K=K, H=480, W=640, poses=poses, tf_to_crops=tf_to_crops, output_size=(16,16), mesh_tensors=mesh_tensors, render_cache=cache, store=store, device='cpu')
+
+  cache = Utils.RenderCache()
+  cache.new_frame()
+  stored = render(crop_ratio=1.2, store=True)   # Refiner, get_vis
+  scored = render(crop_ratio=1.2, store=False)   # Scorer
+  assert n_rendered==[4]
+  assert (cache.hits, cache.misses)==(4,4)
+  for a,b in zip(stored, scored):
+    assert (a is None and b is None) or torch.equal(a, b)
+
+  render(crop_ratio=1.3, store=False)   # Another crop window, nothing to reuse
+  assert n_rendered==[4,4]
+  assert (cache.hits, cache.misses)==(4,8)
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('paramiko')
+pytest.importorskip('scp')
+import result_publisher
+from result_publisher import ResultPublisher, ROBOT_POSE_PATH, ROBOT_VIS_PATH
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_batches_of_different_objects_are_not_merged(tmp_path, monkeypatch):
+    uploaded = []
+    gate = threading.Event()
+    def upload(self, batch):
+        gate.wait()
+        uploaded.append(dict(batch))
+        return True
+    monkeypatch.setattr(ResultPublisher, 'upload', upload)
+    publisher = ResultPublisher(pose_address=None)
+
+    publish = lambda name, data: publisher.publish({ROBOT_POSE_PATH: write(tmp_path, name, data), ROBOT_VIS_PATH: write(tmp_path, name + '.png', data)}, object_name=name[0])
+    publish('a0', b'a0')      # 上传线程拿走后卡在 gate 上，下面几批在队列里积压
+    while publisher.queue.qsize():
+        time.sleep(0.001)
+    publish('a1', b'a1')
+    publish('b0', b'b0')      # 物体 b 紧跟在 a 后面，a1 的位姿不能被 b0 覆盖
+    publish('b1', b'b1')
+    publish('a2', b'a2')
+    gate.set()
+    publisher.close()
+
+    assert [batch[ROBOT_POSE_PATH] for batch in uploaded] == [b'a0', b'a1', b'b1', b'a2']
+    assert all(batch[ROBOT_VIS_PATH] == batch[ROBOT_POSE_PATH] for batch in uploaded)
+    assert publisher.stats['skipped'] == 2   # b0 的两个文件被 b1 替换
+
+
+def test_pose_pushed_over_socket(tmp_path):
+    address = str(tmp_path / 'pose.sock')
+    server = result_publisher.socket.socket(result_publisher.socket.AF_UNIX, result_publisher.socket.SOCK_STREAM)
+    server.bind(address)
+    server.listen(1)
+    pusher = result_publisher.PosePusher(address)
+    pose = np.arange(16, dtype=float).reshape(4, 4)
+    assert pusher.push(pose, object_name='cup', instance=1)
+    conn, _ = server.accept()
+    with conn, conn.makefile('r') as f:
+        msg = result_publisher.json.loads(f.readline())
+    pusher.close_socket()
+    server.close()
+    assert msg['object'] == 'cup' and msg['instance'] == 1
+    assert np.allclose(np.asarray(msg['pose']).reshape(4, 4), pose)
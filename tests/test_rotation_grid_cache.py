@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pytest
+estimater = pytest.importorskip('estimater')
+
+
+SYMMETRY_TFS = np.stack([np.eye(4), np.diag([1.0,-1,-1,1])])   # 180 degrees about x
+
+
+def test_lru_returns_copies():
+  cache = estimater.RotationGridCache(cache_dir='', max_size=2)
+  assert cache.cache_dir is None
+  rot_grid = cache.get(40, 60, SYMMETRY_TFS)
+  np.testing.assert_array_equal(rot_grid, estimater.make_rotation_grid_poses(40, 60, SYMMETRY_TFS))
+  rot_grid[:] = 0
+  assert np.abs(cache.get(40, 60, SYMMETRY_TFS)).sum()>0
+  cache.get(40, 60, np.where(SYMMETRY_TFS==0, -0.0, SYMMETRY_TFS)+1e-9)   # Same key: rounded, and -0.0 has other bytes than 0.0
+  assert (cache.hits, cache.misses)==(2,1)
+  cache.get(40, 30, SYMMETRY_TFS)
+  cache.get(42, 60, SYMMETRY_TFS)
+  assert len(cache.lru)==2
+  cache.get(40, 60, SYMMETRY_TFS)
+  assert cache.misses==4
+
+
+def test_written_by_rename(tmp_path):
+  cache = estimater.RotationGridCache(cache_dir=str(tmp_path))
+  rot_grid = cache.get(40, 60, SYMMETRY_TFS)
+  key = estimater.RotationGridCache.make_key(40, 60, SYMMETRY_TFS)
+  assert os.listdir(cache.cache_dir)==[f'{key}.npy']   # No temporary file left behind
+  np.testing.assert_array_equal(np.load(f'{cache.cache_dir}/{key}.npy'), rot_grid)
+
+  with open(f'{cache.cache_dir}/{key}.npy', 'wb') as ff:   # Truncated by a crash of a writer not using the rename
+    ff.write(b'\x93NUMPY')
+  other = estimater.RotationGridCache(cache_dir=str(tmp_path))
+  np.testing.assert_array_equal(other.get(40, 60, SYMMETRY_TFS), rot_grid)
+  assert (other.disk_hits, other.misses)==(0,1)
+  np.testing.assert_array_equal(np.load(f'{cache.cache_dir}/{key}.npy'), rot_grid)   # Rewritten
+
+
+def test_version_bump(tmp_path, monkeypatch):
+  estimater.RotationGridCache(cache_dir=str(tmp_path)).get(40, 60, SYMMETRY_TFS)
+  old_file = f'{tmp_path}/rot_grid/{estimater.RotationGridCache.make_key(40, 60, SYMMETRY_TFS)}.npy'
+
+  monkeypatch.setattr(estimater.RotationGridCache, 'version', estimater.RotationGridCache.version+1)
+  cache = estimater.RotationGridCache(cache_dir=str(tmp_path))
+  cache.get(40, 60, SYMMETRY_TFS)
+  assert (cache.disk_hits, cache.misses)==(0,1)
+  assert len(os.listdir(cache.cache_dir))==2
+  assert os.path.exists(old_file)
@@ -0,0 +1,37 @@
+import threading
+import warnings
+import pytest
+torch = pytest.importorskip('torch')
+Utils = pytest.importorskip('Utils')
+
+
+def test_restored_after_use():
+  to, as_tensor, showwarning = torch.Tensor.to, torch.as_tensor, warnings.showwarning
+  with Utils.SyncCounter():
+    with Utils.SyncCounter():
+      assert torch.Tensor.to is not to
+    assert torch.Tensor.to is not to   # Still patched for the outer counter
+  assert torch.Tensor.to is to and torch.as_tensor is as_tensor and warnings.showwarning is showwarning
+  assert len(Utils.SyncCounter.active)==0
+
+
+def test_restored_on_error():
+  to = torch.Tensor.to
+  with pytest.raises(ValueError):
+    with Utils.SyncCounter():
+      raise ValueError
+  assert torch.Tensor.to is to
+  assert len(Utils.SyncCounter.active)==0
+
+
+def test_counts_own_thread_only():
+  if not torch.cuda.is_available():
+    pytest.skip('copies are only counted between host and cuda')
+  x = torch.zeros(10, device='cuda')
+  with Utils.SyncCounter() as counter:
+    thread = threading.Thread(target=lambda: x.cpu())
+    thread.start()
+    thread.join()
+    assert counter.n_d2h==0
+    x.cpu()
+  assert counter.n_d2h==1